@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import copy
+import threading
 import time
 
 from elasticsearch import Elasticsearch
@@ -7,6 +8,60 @@ from elasticsearch import RequestsHttpConnection
 from elasticsearch.client import _make_path
 from elasticsearch.client import query_params
 from elasticsearch.exceptions import TransportError
+from requests.adapters import HTTPAdapter
+
+from elastalert.serializer import get_serializer
+
+
+class PooledRequestsHttpConnection(RequestsHttpConnection):
+    """ :class:`RequestsHttpConnection` whose session keeps at most ``pool_maxsize`` connections to its host.
+    Threads that need a connection while all of them are in use wait for one to be released. With ``http_compress``,
+    the session asks for gzip compressed responses. """
+
+    def __init__(self, pool_maxsize=None, http_compress=False, **kwargs):
+        super(PooledRequestsHttpConnection, self).__init__(**kwargs)
+        if http_compress:
+            self.session.headers['accept-encoding'] = 'gzip, deflate'
+        if pool_maxsize:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True)
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+
+
+class ClusterVersionCache(object):
+    """ Process-wide cache of the version each cluster reports, so clients connecting to the same cluster only ask
+    it once. Entries expire after ``ttl`` seconds and can be dropped explicitly with :meth:`refresh`. """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.versions = {}
+
+    def get(self, key):
+        """ Returns the cached version for the cluster, or None if it is not cached or has expired. """
+        with self.lock:
+            entry = self.versions.get(key)
+        if entry is None:
+            return None
+        version, fetched_at = entry
+        if time.time() - fetched_at >= self.ttl:
+            return None
+        return version
+
+    def set(self, key, version):
+        with self.lock:
+            self.versions[key] = (version, time.time())
+
+    def refresh(self, key=None):
+        """ Drops the cached version of a cluster, or of every cluster if no key is given. """
+        with self.lock:
+            if key is None:
+                self.versions.clear()
+            else:
+                self.versions.pop(key, None)
+
+
+es_version_cache = ClusterVersionCache()
 
 
 class ElasticSearchClient(Elasticsearch):
@@ -24,7 +79,10 @@ class ElasticSearchClient(Elasticsearch):
                                                   verify_certs=conf['verify_certs'],
                                                   ca_certs=conf['ca_certs'],
                                                   ssl_show_warn=conf['ssl_show_warn'],
-                                                  connection_class=RequestsHttpConnection,
+                                                  connection_class=PooledRequestsHttpConnection,
+                                                  pool_maxsize=conf.get('es_pool_maxsize'),
+                                                  http_compress=conf.get('es_http_compress', False),
+                                                  serializer=get_serializer(conf.get('es_json_serializer', 'orjson')),
                                                   http_auth=conf['http_auth'],
                                                   headers=conf['headers'],
                                                   timeout=conf['es_conn_timeout'],
@@ -32,7 +90,8 @@ class ElasticSearchClient(Elasticsearch):
                                                   client_cert=conf['client_cert'],
                                                   client_key=conf['client_key'])
         self._conf = copy.copy(conf)
-        self._es_version = None
+        self._cluster_key = (conf.get('es_host'), tuple(conf.get('es_hosts') or ()), conf['es_port'],
+                             conf['es_url_prefix'], conf['use_ssl'])
 
     @property
     def conf(self):
@@ -44,24 +103,33 @@ class ElasticSearchClient(Elasticsearch):
     @property
     def es_version(self):
         """
-        Returns the reported version from the Elasticsearch server.
+        Returns the reported version from the Elasticsearch server. The version is shared by every client connecting
+        to the same cluster through :data:`es_version_cache`, so it is only requested again once the cache expires.
         """
-        if self._es_version is None:
+        es_version = es_version_cache.get(self._cluster_key)
+        if es_version is None:
             for retry in range(3):
                 try:
                     esinfo = self.info()['version']
                     if esinfo.get('distribution') == "opensearch":
                         # OpenSearch is based on Elasticsearch 7.10.2, currently only v1.0.0 exists
                         # https://opensearch.org/
-                        self._es_version = "7.10.2"
+                        es_version = "7.10.2"
                     else:
-                        self._es_version = esinfo['number']
+                        es_version = esinfo['number']
                     break
                 except TransportError:
                     if retry == 2:
                         raise
                     time.sleep(3)
-        return self._es_version
+            es_version_cache.set(self._cluster_key, es_version)
+        return es_version
+
+    def refresh_es_version(self):
+        """
+        Drops the cached version of the cluster, so that it is requested again on next use.
+        """
+        es_version_cache.refresh(self._cluster_key)
 
     def is_atleastfive(self):
         """
@@ -95,6 +163,20 @@ class ElasticSearchClient(Elasticsearch):
         """
         return int(self.es_version.split(".")[0]) >= 7
 
+    def is_atleastseventwo(self):
+        """
+        Returns True when the Elasticsearch server version >= 7.2
+        """
+        major, minor = list(map(int, self.es_version.split(".")[:2]))
+        return major > 7 or (major == 7 and minor >= 2)
+
+    def is_atleastseventwelve(self):
+        """
+        Returns True when the Elasticsearch server version >= 7.12
+        """
+        major, minor = list(map(int, self.es_version.split(".")[:2]))
+        return major > 7 or (major == 7 and minor >= 12)
+
     def resolve_writeback_index(self, writeback_index, doc_type):
         """ In ES6, you cannot have multiple _types per index,
         therefore we use self.writeback_index as the prefix for the actual
@@ -111,6 +193,55 @@ class ElasticSearchClient(Elasticsearch):
             return writeback_index + '_error'
         return writeback_index
 
+    @query_params("expand_wildcards", "ignore_unavailable", "keep_alive", "preference", "routing")
+    def open_point_in_time(self, index, params=None):
+        """
+        Open a point in time that can be used in subsequent searches.
+        `<https://www.elastic.co/guide/en/elasticsearch/reference/7.12/point-in-time-api.html>`_
+        :arg index: A comma-separated list of index names to open point in time
+        :arg keep_alive: Specific the time to live for the point in time
+        :arg ignore_unavailable: Whether specified concrete indices should be
+            ignored when unavailable (missing or closed)
+        """
+        return self.transport.perform_request(
+            "POST", _make_path(index, "_pit"), params=params
+        )
+
+    @query_params()
+    def close_point_in_time(self, pit_id, params=None):
+        """
+        Close a point in time.
+        `<https://www.elastic.co/guide/en/elasticsearch/reference/7.12/point-in-time-api.html>`_
+        :arg pit_id: The id of the point in time to close
+        """
+        return self.transport.perform_request(
+            "DELETE", "/_pit", params=params, body={"id": pit_id}
+        )
+
+    @query_params(
+        "_source",
+        "_source_excludes",
+        "_source_includes",
+        "allow_partial_search_results",
+        "size",
+        "track_total_hits",
+    )
+    def search_point_in_time(self, body=None, params=None):
+        """
+        Execute a search against a point in time. The request body must contain
+        the ``pit`` section, the indices are taken from the point in time.
+        `<https://www.elastic.co/guide/en/elasticsearch/reference/7.12/paginate-search-results.html>`_
+        :arg body: The search definition using the Query DSL
+        :arg _source_includes: A list of fields to extract and return from the
+            _source field
+        :arg size: Number of hits to return (default: 10)
+        :arg track_total_hits: Indicate if the number of documents that match
+            the query should be tracked
+        """
+        return self.transport.perform_request(
+            "POST", "/_search", params=params, body=body
+        )
+
     @query_params(
         "_source",
         "_source_exclude",
@@ -1,10 +1,9 @@
 import datetime
-import json
 
 import requests
 from requests import RequestException
 
-from elastalert.alerts import Alerter, DateTimeEncoder
+from elastalert.alerts import Alerter
 from elastalert.util import lookup_es_key, EAException, elastalert_logger, resolve_string, ts_to_dt
 
 
@@ -112,7 +111,7 @@ class AlertaAlerter(Alerter):
         }
 
         try:
-            payload = json.dumps(alerta_payload_dict, cls=DateTimeEncoder)
+            payload = self.serialize_payload(alerta_payload_dict)
         except Exception as e:
             raise Exception("Error building Alerta request: %s" % e)
         return payload
@@ -66,7 +66,7 @@ class AlertmanagerAlerter(Alerter):
 
                 response = requests.post(
                     url,
-                    data=json.dumps([payload], cls=DateTimeEncoder),
+                    data=self.serialize_payload([payload]),
                     headers=headers,
                     verify=verify,
                     proxies=proxies,
@@ -1,7 +1,6 @@
-import json
 import subprocess
 
-from elastalert.alerts import Alerter, DateTimeEncoder
+from elastalert.alerts import Alerter
 from elastalert.util import elastalert_logger, resolve_string, EAException
 
 
@@ -34,8 +33,8 @@ class CommandAlerter(Alerter):
             subp = subprocess.Popen(command, stdin=subprocess.PIPE, shell=self.shell)
 
             if self.rule.get('pipe_match_json'):
-                match_json = json.dumps(matches, cls=DateTimeEncoder) + '\n'
-                stdout, stderr = subp.communicate(input=match_json.encode())
+                match_json = self.serialize_payload(matches) + b'\n'
+                stdout, stderr = subp.communicate(input=match_json)
             elif self.rule.get('pipe_alert_text'):
                 alert_text = self.create_alert_body(matches)
                 stdout, stderr = subp.communicate(input=alert_text.encode())
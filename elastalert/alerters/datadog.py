@@ -1,9 +1,8 @@
-import json
 
 import requests
 from requests import RequestException
 
-from elastalert.alerts import Alerter, DateTimeEncoder
+from elastalert.alerts import Alerter
 from elastalert.util import EAException, elastalert_logger
 
 
@@ -28,7 +27,7 @@ class DatadogAlerter(Alerter):
             'text': self.create_alert_body(matches)
         }
         try:
-            response = requests.post(url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers)
+            response = requests.post(url, data=self.serialize_payload(payload), headers=headers)
             response.raise_for_status()
         except RequestException as e:
             raise EAException('Error posting event to Datadog: %s' % e)
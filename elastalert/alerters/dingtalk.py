@@ -1,11 +1,10 @@
-import json
 import warnings
 
 import requests
 from requests import RequestException
 from requests.auth import HTTPProxyAuth
 
-from elastalert.alerts import Alerter, DateTimeEncoder
+from elastalert.alerts import Alerter
 from elastalert.util import EAException, elastalert_logger
 
 
@@ -80,8 +79,8 @@ class DingTalkAlerter(Alerter):
                 payload['actionCard']['btns'] = self.dingtalk_btns
 
         try:
-            response = requests.post(self.dingtalk_webhook_url, data=json.dumps(payload,
-                                     cls=DateTimeEncoder), headers=headers, proxies=proxies, auth=auth)
+            response = requests.post(self.dingtalk_webhook_url, data=self.serialize_payload(payload),
+                                     headers=headers, proxies=proxies, auth=auth)
             warnings.resetwarnings()
             response.raise_for_status()
         except RequestException as e:
@@ -1,4 +1,3 @@
-import json
 import warnings
 
 import requests
@@ -55,7 +54,8 @@ class DiscordAlerter(Alerter):
         data["embeds"].append(embed)
 
         try:
-            response = requests.post(self.discord_webhook_url, data=json.dumps(data), headers=headers, proxies=proxies, auth=auth)
+            response = requests.post(self.discord_webhook_url, data=self.serialize_payload(data),
+                                     headers=headers, proxies=proxies, auth=auth)
             warnings.resetwarnings()
             response.raise_for_status()
         except RequestException as e:
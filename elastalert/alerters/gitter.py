@@ -1,9 +1,8 @@
-import json
 
 import requests
 from requests import RequestException
 
-from elastalert.alerts import Alerter, DateTimeEncoder
+from elastalert.alerts import Alerter
 from elastalert.util import EAException, elastalert_logger
 
 
@@ -31,7 +30,7 @@ class GitterAlerter(Alerter):
 
         try:
             response = requests.post(self.gitter_webhook_url,
-                                     data=json.dumps(payload, cls=DateTimeEncoder),
+                                     data=self.serialize_payload(payload),
                                      headers=headers,
                                      proxies=proxies)
             response.raise_for_status()
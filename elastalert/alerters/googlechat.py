@@ -1,4 +1,3 @@
-import json
 
 import requests
 from requests import RequestException
@@ -85,7 +84,7 @@ class GoogleChatAlerter(Alerter):
         headers = {'content-type': 'application/json'}
         for url in self.googlechat_webhook_url:
             try:
-                response = requests.post(url, data=json.dumps(message), headers=headers)
+                response = requests.post(url, data=self.serialize_payload(message), headers=headers)
                 response.raise_for_status()
             except RequestException as e:
                 raise EAException("Error posting to google chat: {}".format(e))
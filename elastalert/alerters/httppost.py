@@ -1,9 +1,8 @@
-import json
 
 import requests
 from requests import RequestException
 
-from elastalert.alerts import Alerter, DateTimeEncoder
+from elastalert.alerts import Alerter
 from elastalert.util import lookup_es_key, EAException, elastalert_logger
 
 
@@ -48,7 +47,7 @@ class HTTPPostAlerter(Alerter):
             proxies = {'https': self.post_proxy} if self.post_proxy else None
             for url in self.post_url:
                 try:
-                    response = requests.post(url, data=json.dumps(payload, cls=DateTimeEncoder),
+                    response = requests.post(url, data=self.serialize_payload(payload),
                                              headers=headers, proxies=proxies, timeout=self.timeout,
                                              verify=verify)
                     response.raise_for_status()
@@ -1,9 +1,8 @@
 import copy
-import json
 import requests
 import warnings
 
-from elastalert.alerts import Alerter, DateTimeEncoder
+from elastalert.alerts import Alerter
 from elastalert.util import elastalert_logger, lookup_es_key, EAException
 from requests import RequestException
 
@@ -148,7 +147,7 @@ class MattermostAlerter(Alerter):
                     requests.urllib3.disable_warnings()
 
                 response = requests.post(
-                    url, data=json.dumps(payload, cls=DateTimeEncoder),
+                    url, data=self.serialize_payload(payload),
                     headers=headers, verify=not self.mattermost_ignore_ssl_errors,
                     proxies=proxies)
 
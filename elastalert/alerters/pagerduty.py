@@ -1,8 +1,7 @@
-import json
 import requests
 
 from elastalert.util import EAException, lookup_es_key, elastalert_logger
-from elastalert.alerts import Alerter, DateTimeEncoder
+from elastalert.alerts import Alerter
 from requests import RequestException
 
 
@@ -93,7 +92,7 @@ class PagerDutyAlerter(Alerter):
         try:
             response = requests.post(
                 self.url,
-                data=json.dumps(payload, cls=DateTimeEncoder, ensure_ascii=False),
+                data=self.serialize_payload(payload),
                 headers=headers,
                 proxies=proxies
             )
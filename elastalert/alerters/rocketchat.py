@@ -1,11 +1,10 @@
 # -*- coding: utf-8 -*-
 import copy
-import json
 import requests
 from requests.exceptions import RequestException
 import warnings
 
-from elastalert.alerts import Alerter, DateTimeEncoder
+from elastalert.alerts import Alerter
 from elastalert.util import EAException, elastalert_logger, lookup_es_key
 
 
@@ -103,7 +102,7 @@ class RocketChatAlerter(Alerter):
                         requests.packages.urllib3.disable_warnings()
                     payload['channel'] = channel_override
                     response = requests.post(
-                        url, data=json.dumps(payload, cls=DateTimeEncoder),
+                        url, data=self.serialize_payload(payload),
                         headers=headers,
                         verify=verify,
                         proxies=proxies,
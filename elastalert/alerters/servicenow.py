@@ -1,9 +1,8 @@
-import json
 
 import requests
 from requests import RequestException
 
-from elastalert.alerts import Alerter, BasicMatchString, DateTimeEncoder
+from elastalert.alerts import Alerter, BasicMatchString
 from elastalert.util import EAException, elastalert_logger
 
 
@@ -59,7 +58,7 @@ class ServiceNowAlerter(Alerter):
                 self.servicenow_rest_url,
                 auth=(self.rule['username'], self.rule['password']),
                 headers=headers,
-                data=json.dumps(payload, cls=DateTimeEncoder),
+                data=self.serialize_payload(payload),
                 proxies=proxies
             )
             response.raise_for_status()
@@ -1,6 +1,5 @@
-import boto3
-
 from elastalert.alerts import Alerter
+from elastalert.auth import get_aws_client
 from elastalert.util import lookup_es_key, EAException, elastalert_logger
 
 
@@ -60,16 +59,15 @@ class SesAlerter(Alerter):
 
         try:
             if self.aws_profile != '':
-                session = boto3.Session(profile_name=self.aws_profile)
+                client = get_aws_client('ses', profile_name=self.aws_profile)
             else:
-                session = boto3.Session(
+                client = get_aws_client(
+                    'ses',
                     aws_access_key_id=self.aws_access_key_id,
                     aws_secret_access_key=self.aws_secret_access_key,
                     region_name=self.aws_region
                 )
 
-            client = session.client('ses')
-
             client.send_email(
                 Source=self.from_addr,
                 Destination={
@@ -1,9 +1,8 @@
 import copy
-import json
 import requests
 import warnings
 
-from elastalert.alerts import Alerter, DateTimeEncoder
+from elastalert.alerts import Alerter
 from elastalert.util import elastalert_logger, EAException, lookup_es_key
 from requests.exceptions import RequestException
 
@@ -162,7 +161,7 @@ class SlackAlerter(Alerter):
                         requests.packages.urllib3.disable_warnings()
                     payload['channel'] = channel_override
                     response = requests.post(
-                        url, data=json.dumps(payload, cls=DateTimeEncoder),
+                        url, data=self.serialize_payload(payload),
                         headers=headers, verify=verify,
                         proxies=proxies,
                         timeout=self.slack_timeout)
@@ -1,6 +1,5 @@
-import boto3
-
 from elastalert.alerts import Alerter
+from elastalert.auth import get_aws_client
 from elastalert.util import elastalert_logger, EAException
 
 
@@ -25,15 +24,15 @@ class SnsAlerter(Alerter):
 
         try:
             if self.profile is None:
-                session = boto3.Session(
+                sns_client = get_aws_client(
+                    'sns',
                     aws_access_key_id=self.sns_aws_access_key_id,
-                    aws_secret_access_key=self.sns_aws_access_key_id,
+                    aws_secret_access_key=self.sns_aws_secret_access_key,
                     region_name=self.sns_aws_region
                 )
             else:
-                session = boto3.Session(profile_name=self.profile)
+                sns_client = get_aws_client('sns', profile_name=self.profile)
 
-            sns_client = session.client('sns')
             sns_client.publish(
                 TopicArn=self.sns_topic_arn,
                 Message=body,
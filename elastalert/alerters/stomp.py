@@ -1,5 +1,4 @@
 import datetime
-import json
 import time
 
 import stomp
@@ -69,7 +68,7 @@ class StompAlerter(Alerter):
             conn.connect(self.stomp_login, self.stomp_password)
             # Ensures that the CONNECTED frame is received otherwise, the disconnect call will fail.
             time.sleep(1)
-            conn.send(self.stomp_destination, json.dumps(fullmessage))
+            conn.send(self.stomp_destination, self.serialize_payload(fullmessage))
             conn.disconnect()
         except Exception as e:
             raise EAException("Error posting to Stomp: %s" % e)
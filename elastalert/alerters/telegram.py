@@ -1,11 +1,10 @@
-import json
 import warnings
 
 import requests
 from requests import RequestException
 from requests.auth import HTTPProxyAuth
 
-from elastalert.alerts import Alerter, BasicMatchString, DateTimeEncoder
+from elastalert.alerts import Alerter, BasicMatchString
 from elastalert.util import EAException, elastalert_logger
 
 
@@ -46,7 +45,7 @@ class TelegramAlerter(Alerter):
         }
 
         try:
-            response = requests.post(self.url, data=json.dumps(payload, cls=DateTimeEncoder), headers=headers, proxies=proxies, auth=auth)
+            response = requests.post(self.url, data=self.serialize_payload(payload), headers=headers, proxies=proxies, auth=auth)
             warnings.resetwarnings()
             response.raise_for_status()
         except RequestException as e:
@@ -1,4 +1,3 @@
-import json
 import time
 import uuid
 
@@ -109,7 +108,7 @@ class HiveAlerter(Alerter):
         proxies = connection_details.get('hive_proxies', {'http': '', 'https': ''})
         verify = connection_details.get('hive_verify', False)
 
-        alert_body = json.dumps(alert_config, indent=4, sort_keys=True)
+        alert_body = self.serialize_payload(alert_config)
         req = f'{hive_host}:{hive_port}/api/alert'
         headers = {'Content-Type': 'application/json',
                    'Authorization': f'Bearer {api_key}'}
@@ -6,6 +6,7 @@ import os
 from jinja2 import Template
 from texttable import Texttable
 
+from elastalert.serializer import get_serializer
 from elastalert.util import EAException, lookup_es_key
 from elastalert.yaml import read_yaml
 
@@ -143,6 +144,10 @@ class Alerter(object):
         self.pipeline = None
         self.resolve_rule_references(self.rule)
 
+    def serialize_payload(self, payload):
+        """ Encodes the payload sent by the alerter as UTF-8 JSON, with the serializer chosen by es_json_serializer. """
+        return get_serializer(self.rule.get('es_json_serializer', 'orjson')).dumps(payload).encode('utf-8')
+
     def resolve_rule_references(self, root):
         # Support referencing other top-level rule properties to avoid redundant copy/paste
         if type(root) == list:
@@ -1,8 +1,77 @@
 # -*- coding: utf-8 -*-
+import collections
 import os
+import threading
+
 import boto3
 from aws_requests_auth.aws_auth import AWSRequestsAuth
 
+# boto3 sessions, credentials and clients shared by every caller in the process, see get_aws_session
+aws_sessions = {}
+aws_credentials = {}
+aws_clients = {}
+# aws_lock only guards aws_key_locks. Each entry is created under the lock of its own key, so that resolving
+# credentials, which may call the instance metadata service or STS, does not hold up unrelated callers.
+aws_lock = threading.Lock()
+aws_key_locks = collections.defaultdict(threading.Lock)
+
+
+def get_aws_key_lock(key):
+    """ Returns the lock guarding the cache entry for key. """
+    with aws_lock:
+        return aws_key_locks[key]
+
+
+def clear_aws_cache():
+    """ Drops the shared sessions, credentials and clients, so that they are created again on next use. """
+    with aws_lock:
+        aws_sessions.clear()
+        aws_credentials.clear()
+        aws_clients.clear()
+        aws_key_locks.clear()
+
+
+def get_aws_session(profile_name=None, region_name=None, aws_access_key_id=None, aws_secret_access_key=None):
+    """ Returns the boto3 session for the profile, region and keys, creating it on first use.
+    Sessions are not thread safe, use :func:`get_aws_credentials` and :func:`get_aws_client` to share them. """
+    key = (profile_name, region_name, aws_access_key_id, aws_secret_access_key)
+    with get_aws_key_lock(('session',) + key):
+        session = aws_sessions.get(key)
+        if session is None:
+            session = boto3.session.Session(profile_name=profile_name, region_name=region_name,
+                                            aws_access_key_id=aws_access_key_id,
+                                            aws_secret_access_key=aws_secret_access_key)
+            aws_sessions[key] = session
+    return session
+
+
+def get_aws_credentials(profile_name=None, region_name=None):
+    """ Returns the shared credentials of the profile and the session's region. STS and instance profile
+    credentials are refreshable and renew themselves when they are about to expire. """
+    key = (profile_name, region_name)
+    session = get_aws_session(profile_name, region_name)
+    with get_aws_key_lock(('credentials',) + key):
+        if aws_credentials.get(key) is None:
+            credentials = session.get_credentials()
+            if credentials is None:
+                # Nothing to share yet, look for credentials again next time
+                return None, session.region_name
+            aws_credentials[key] = (credentials, session.region_name)
+        return aws_credentials[key]
+
+
+def get_aws_client(service_name, profile_name=None, region_name=None, aws_access_key_id=None,
+                   aws_secret_access_key=None):
+    """ Returns a shared boto3 client for the service. boto3 clients are thread safe. """
+    key = (service_name, profile_name, region_name, aws_access_key_id, aws_secret_access_key)
+    session = get_aws_session(profile_name, region_name, aws_access_key_id, aws_secret_access_key)
+    with get_aws_key_lock(('client',) + key):
+        client = aws_clients.get(key)
+        if client is None:
+            client = session.client(service_name)
+            aws_clients[key] = client
+    return client
+
 
 class RefeshableAWSRequestsAuth(AWSRequestsAuth):
     """
@@ -53,10 +122,10 @@ class Auth(object):
         if not aws_region and not os.environ.get('AWS_DEFAULT_REGION'):
             return None
 
-        session = boto3.session.Session(profile_name=profile_name, region_name=aws_region)
+        credentials, region_name = get_aws_credentials(profile_name, aws_region)
 
         return RefeshableAWSRequestsAuth(
-            refreshable_credential=session.get_credentials(),
+            refreshable_credential=credentials,
             aws_host=host,
-            aws_region=session.region_name,
+            aws_region=region_name,
             aws_service='es')
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import threading
+
+from elastalert.util import elastalert_logger
+from elastalert.util import ts_now
+
+
+class ClusterMembership(object):
+    """ Tracks the live ElastAlert instances sharing the same rules and which of them owns each rule. Instances
+    hold a lease in the writeback index which they renew with every heartbeat. Rules are assigned to the live
+    instances by rendezvous hashing of the rule name, so when an instance joins or its lease expires only the
+    rules it gains or loses change owner. """
+
+    def __init__(self, instance_id, shard=None):
+        """
+        :param instance_id: The identifier of this instance, unique within the cluster.
+        :param shard: Instances only share rules with instances in the same shard, such as the same worker
+            process index of the process execution engine.
+        """
+        self.instance_id = instance_id
+        self.shard = shard
+        self.lock = threading.Lock()
+        self.instances = [instance_id]
+        self.changed_at = ts_now()
+        self.lease_expires = None
+
+    def renewed(self, lease_expires):
+        """ Records that the lease of this instance was renewed until lease_expires. """
+        self.lease_expires = lease_expires
+
+    def update(self, instances):
+        """ Sets the instances which currently hold a lease. This instance is always a member. """
+        instances = sorted(set(instances) | {self.instance_id})
+        with self.lock:
+            if instances == self.instances:
+                return False
+            elastalert_logger.info('Cluster members changed from %s to %s' % (self.instances, instances))
+            self.instances = instances
+            self.changed_at = ts_now()
+            return True
+
+    def owner(self, rule_name):
+        """ Returns the instance owning the rule with the given name. """
+        with self.lock:
+            instances = self.instances
+        return max(instances, key=lambda instance: hashlib.sha1(('%s:%s' % (instance, rule_name)).encode('utf-8')).digest())
+
+    def owns(self, rule_name):
+        """ Returns whether this instance owns the rule. An instance whose lease could not be renewed owns no rules,
+        since the other instances may already have taken them over. """
+        if self.lease_expires is None or ts_now() >= self.lease_expires:
+            return False
+        return self.owner(rule_name) == self.instance_id
@@ -74,7 +74,13 @@ def load_conf(args, defaults=None, overwrites=None):
 
     conf.setdefault('max_query_size', 10000)
     conf.setdefault('scroll_keepalive', '30s')
-    conf.setdefault('max_scrolling_count', 990) # Avoid stack overflow in run_query, note that 1000 is Python's stack limit
+    conf.setdefault('max_scrolling_count', 0)
+    conf.setdefault('hits_chunk_size', 1000)
+    conf.setdefault('use_point_in_time', True)
+    conf.setdefault('use_msearch', False)
+    conf.setdefault('msearch_max_size', 100)
+    conf.setdefault('share_queries', False)
+    conf.setdefault('consolidate_queries', False)
     conf.setdefault('disable_rules_on_error', True)
     conf.setdefault('scan_subdirectories', True)
     conf.setdefault('rules_loader', 'file')
@@ -92,6 +98,26 @@ def load_conf(args, defaults=None, overwrites=None):
             conf['old_query_limit'] = datetime.timedelta(**conf['old_query_limit'])
         else:
             conf['old_query_limit'] = datetime.timedelta(weeks=1)
+        if 'msearch_wait_time' in conf:
+            conf['msearch_wait_time'] = datetime.timedelta(**conf['msearch_wait_time'])
+        else:
+            conf['msearch_wait_time'] = datetime.timedelta(milliseconds=50)
+        if 'es_version_cache_ttl' in conf:
+            conf['es_version_cache_ttl'] = datetime.timedelta(**conf['es_version_cache_ttl'])
+        else:
+            conf['es_version_cache_ttl'] = datetime.timedelta(hours=1)
+        if 'schedule_spread' in conf:
+            conf['schedule_spread'] = datetime.timedelta(**conf['schedule_spread'])
+        else:
+            conf['schedule_spread'] = datetime.timedelta(minutes=1)
+        if 'cluster_heartbeat_interval' in conf:
+            conf['cluster_heartbeat_interval'] = datetime.timedelta(**conf['cluster_heartbeat_interval'])
+        else:
+            conf['cluster_heartbeat_interval'] = datetime.timedelta(seconds=30)
+        if 'cluster_lease_duration' in conf:
+            conf['cluster_lease_duration'] = datetime.timedelta(**conf['cluster_lease_duration'])
+        else:
+            conf['cluster_lease_duration'] = datetime.timedelta(seconds=90)
     except (KeyError, TypeError) as e:
         raise EAException('Invalid time format used: %s' % e)
 
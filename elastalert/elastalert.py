@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 import argparse
+import concurrent.futures
 import copy
 import datetime
+import functools
+import hashlib
+import itertools
 import json
 import logging
+import multiprocessing
+import multiprocessing.connection
 import os
-import random
 import signal
+import socket
 import sys
 import threading
 import time
@@ -21,6 +27,7 @@ import statsd
 
 import dateutil.tz
 import pytz
+from apscheduler.events import EVENT_JOB_MISSED
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor
 from croniter import croniter
@@ -29,19 +36,27 @@ from elasticsearch.exceptions import ElasticsearchException
 from elasticsearch.exceptions import NotFoundError
 from elasticsearch.exceptions import TransportError
 
+from elastalert import es_version_cache
 from elastalert import kibana
 from elastalert.alerters.debug import DebugAlerter
+from elastalert.cluster import ClusterMembership
 from elastalert.config import load_conf
 from elastalert.enhancements import DropMatchException
 from elastalert.kibana_discover import generate_kibana_discover_url
 from elastalert.kibana_external_url_formatter import create_kibana_external_url_formatter
+from elastalert.msearch import cluster_key
+from elastalert.msearch import MultiSearchBatcher
+from elastalert.query_template import QueryTemplate
 from elastalert.prometheus_wrapper import PrometheusWrapper
+from elastalert.rule_queue import RuleQueue
 from elastalert.ruletypes import FlatlineRule
-from elastalert.util import (add_raw_postfix, cronite_datetime_to_timestamp, dt_to_ts, dt_to_unix, EAException,
-                             elastalert_logger, elasticsearch_client, format_index, lookup_es_key, parse_deadline,
-                             parse_duration, pretty_ts, replace_dots_in_field_names, seconds, set_es_key,
-                             should_scrolling_continue, total_seconds, ts_add, ts_now, ts_to_dt, unix_to_dt,
-                             ts_utc_to_tz)
+from elastalert.ruletypes import FrequencyRule
+from elastalert.shared_query import SharedQueryCache
+from elastalert.util import (add_raw_postfix, build_es_conn_config, chunks, conn_config_key,
+                             cronite_datetime_to_timestamp, dt_to_ts, dt_to_unix, dt_to_unixms, EAException, elastalert_logger,
+                             elasticsearch_client, format_index, lookup_es_key, parse_deadline, parse_duration,
+                             pretty_ts, replace_dots_in_field_names, seconds, set_es_key, should_scrolling_continue,
+                             total_seconds, ts_add, ts_now, ts_to_dt, unix_to_dt, ts_utc_to_tz)
 
 
 class ElastAlerter(object):
@@ -52,6 +67,18 @@ class ElastAlerter(object):
 
     thread_data = threading.local()
 
+    # The parts of search responses the engine reads, passed as filter_path so that Elasticsearch leaves out the rest.
+    # Filtered responses also leave out empty arrays and objects, such as the hits of a search that found nothing.
+    hits_filter_path = ['_scroll_id', 'pit_id', '_shards.failures', 'hits.total', 'hits.hits._id', 'hits.hits._index',
+                        'hits.hits._type', 'hits.hits._source', 'hits.hits.fields', 'hits.hits.sort',
+                        'hits.hits.matched_queries']
+    aggregations_filter_path = ['aggregations', 'hits.total']
+
+    # Seconds before a failed worker process is restarted, doubled with each failure in a row
+    worker_restart_delay = 1
+    worker_restart_max_delay = 300
+    source_filter_path = ['hits.hits._source']
+
     def parse_args(self, args):
         parser = argparse.ArgumentParser()
         parser.add_argument(
@@ -95,8 +122,11 @@ class ElastAlerter(object):
         parser.add_argument('--prometheus_port', type=int, dest='prometheus_port', help='Enables Prometheus metrics on specified port.')
         self.args = parser.parse_args(args)
 
-    def __init__(self, args):
+    def __init__(self, args, worker_index=None):
         self.es_clients = {}
+        self.es_clients_lock = threading.Lock()
+        self.cli_args = args
+        self.worker_index = worker_index
         self.parse_args(args)
         self.debug = self.args.debug
         self.verbose = self.args.verbose
@@ -124,17 +154,39 @@ class ElastAlerter(object):
             tracer.addHandler(logging.FileHandler(self.args.es_debug_trace))
 
         self.conf = load_conf(self.args)
+        self.execution_engine = self.conf.get('execution_engine', 'thread')
+        self.max_threads = self.conf.get('max_threads', 10)
+        self.rule_queue = RuleQueue()
+        self.schedule_spread = self.conf.get('schedule_spread', datetime.timedelta(minutes=1))
+        self.worker_processes = self.conf.get('worker_processes', os.cpu_count() or 1)
+        self.max_worker_restarts = self.conf.get('max_worker_restarts', 10)
+        self.workers = {}
+        # With the process engine, this process only supervises the workers unless it is one of them. Silencing
+        # and running a single rule always happen in this process.
+        self.is_supervisor = (self.execution_engine == 'process' and self.worker_index is None
+                              and not self.args.silence and not self.args.rule)
         self.rules_loader = self.conf['rules_loader']
-        self.rules = self.rules_loader.load(self.conf, self.args)
+        if self.is_supervisor:
+            self.rules = []
+        elif self.worker_index is not None:
+            self.rules = self.rules_loader.load(self.conf, self.args, rule_filter=self.owns_rule_file)
+        else:
+            self.rules = self.rules_loader.load(self.conf, self.args)
 
         print(len(self.rules), 'rules loaded')
 
         self.max_query_size = self.conf['max_query_size']
         self.scroll_keepalive = self.conf['scroll_keepalive']
+        self.hits_chunk_size = self.conf.get('hits_chunk_size', 1000)
+        self.msearch_batcher = MultiSearchBatcher(
+            total_seconds(self.conf.get('msearch_wait_time', datetime.timedelta(milliseconds=50))),
+            self.conf.get('msearch_max_size', 100))
+        self.shared_queries = SharedQueryCache()
         self.writeback_index = self.conf['writeback_index']
         self.run_every = self.conf['run_every']
         self.alert_time_limit = self.conf['alert_time_limit']
         self.old_query_limit = self.conf['old_query_limit']
+        es_version_cache.ttl = total_seconds(self.conf.get('es_version_cache_ttl', datetime.timedelta(hours=1)))
         self.disable_rules_on_error = self.conf['disable_rules_on_error']
         self.notify_email = self.conf.get('notify_email', [])
         self.from_addr = self.conf.get('from_addr', 'ElastAlert')
@@ -142,22 +194,44 @@ class ElastAlerter(object):
         self.max_aggregation = self.conf.get('max_aggregation', 10000)
         self.buffer_time = self.conf['buffer_time']
         self.silence_cache = {}
-        self.rule_hashes = self.rules_loader.get_hashes(self.conf, self.args.rule)
+        self.rule_hashes = self.get_rule_hashes()
         self.starttime = self.args.start
         self.disabled_rules = []
         self.replace_dots_in_field_names = self.conf.get('replace_dots_in_field_names', False)
         self.thread_data.alerts_sent = 0
         self.thread_data.num_hits = 0
         self.thread_data.num_dupes = 0
-        executors = {
-            'default': ThreadPoolExecutor(max_workers=self.conf.get('max_threads', 10)),
-        }
         job_defaults = {
             'misfire_grace_time': self.conf.get('misfire_grace_time', 5),
             'coalesce': True,
             'max_instances': 1
         }
-        self.scheduler = BackgroundScheduler(executors=executors, job_defaults=job_defaults)
+        if self.execution_engine in ('thread', 'process'):
+            # The scheduler only queues rules which are due, max_threads rule threads take them from rule_queue.
+            # Each worker process of the process engine does this for its shard of the rules. Queueing a rule returns
+            # at once, and has its own thread so that slow pending alert or config change checks do not delay it
+            # past misfire_grace_time.
+            executors = {
+                'default': ThreadPoolExecutor(max_workers=2),
+                'rules': ThreadPoolExecutor(max_workers=1),
+                # The cluster heartbeat has its own thread, so a slow config change check does not let its lease lapse
+                'cluster': ThreadPoolExecutor(max_workers=1),
+            }
+            self.scheduler = BackgroundScheduler(executors=executors, job_defaults=job_defaults)
+            self.scheduler.add_listener(self.log_missed_job, EVENT_JOB_MISSED)
+        else:
+            raise EAException('Unknown execution_engine %s, must be thread or process' % (self.execution_engine))
+        self.cluster = None
+        self.cluster_heartbeat_interval = self.conf.get('cluster_heartbeat_interval', datetime.timedelta(seconds=30))
+        self.cluster_lease_duration = self.conf.get('cluster_lease_duration', datetime.timedelta(seconds=90))
+        if self.conf.get('cluster_mode') and not (self.is_supervisor or self.debug or self.args.silence or self.args.rule):
+            instance_id = self.conf.get('cluster_instance_id', '%s-%d' % (socket.gethostname(), os.getpid()))
+            shard = None
+            if self.worker_index is not None:
+                # Workers of the process engine only share rules with the same worker on the other instances
+                instance_id = '%s-worker-%d' % (instance_id, self.worker_index)
+                shard = '%d/%d' % (self.worker_index, self.worker_processes)
+            self.cluster = ClusterMembership(instance_id, shard)
         self.string_multi_field_name = self.conf.get('string_multi_field_name', False)
         self.statsd_instance_tag = self.conf.get('statsd_instance_tag', '')
         self.statsd_host = self.conf.get('statsd_host', '')
@@ -167,6 +241,9 @@ class ElastAlerter(object):
             self.statsd = None
         self.add_metadata_alert = self.conf.get('add_metadata_alert', False)
         self.prometheus_port = self.args.prometheus_port
+        if self.prometheus_port and self.worker_index is not None:
+            # Each worker process serves the metrics of its own rules on a port of its own
+            self.prometheus_port += self.worker_index
         self.show_disabled_rules = self.conf.get('show_disabled_rules', True)
         self.pretty_ts_format = self.conf.get('custom_pretty_ts_format')
 
@@ -230,6 +307,26 @@ class ElastAlerter(object):
             query['sort'] = [{timestamp_field: {'order': 'desc' if desc else 'asc'}}]
         return query
 
+    def get_rule_query(self, rule, starttime=None, endtime=None, sort=True, desc=False, extra_filters=None):
+        """ Returns the query for a rule's filters between starttime and endtime, see get_query. The query is
+        rendered from the template compiled by init_rule if it is still up to date with the rule.
+
+        :param extra_filters: Filters to apply in addition to the rule's own filters.
+        """
+        template = rule.get('query_template')
+        if template is not None and template.matches(rule):
+            return template.render(starttime, endtime, sort=sort, desc=desc, extra_filters=extra_filters)
+        return self.get_query(
+            rule['filter'] + extra_filters if extra_filters else rule['filter'],
+            starttime,
+            endtime,
+            sort=sort,
+            timestamp_field=rule['timestamp_field'],
+            to_ts_func=rule['dt_to_ts'],
+            desc=desc,
+            five=rule['five']
+        )
+
     def get_terms_query(self, query, rule, size, field, five=False):
         """ Takes a query generated by get_query and outputs a aggregation query """
         query_element = query['query']
@@ -252,9 +349,40 @@ class ElastAlerter(object):
         query_element = query['query']
         if 'sort' in query_element:
             query_element.pop('sort')
+        template = rule.get('query_template')
+        # Only the aggregation for the latest bucket_offset_delta is kept, since the offset changes every run when
+        # the bucket interval is not synced to the run schedule
+        cache_key = (query_key, terms_size, timestamp_field)
+        offset_delta = rule.get('bucket_offset_delta')
+        cached = template.aggregations.get(cache_key) if template is not None else None
+        if cached is not None and cached[0] == offset_delta:
+            aggs_element = cached[1]
+        else:
+            aggs_element = self.build_aggregation(rule, query_key, terms_size, timestamp_field)
+            if template is not None:
+                template.aggregations[cache_key] = (offset_delta, aggs_element)
+
+        if not rule['five']:
+            query_element['filtered'].update({'aggs': aggs_element})
+            aggs_query = {'aggs': query_element}
+        else:
+            aggs_query = query
+            aggs_query['aggs'] = aggs_element
+        return aggs_query
+
+    @staticmethod
+    def build_aggregation(rule, query_key, terms_size, timestamp_field='@timestamp'):
+        """ Builds the aggregations of a metric aggregation query, bucketed by interval and query_key. """
         metric_agg_element = rule['aggregation_query_element']
 
+        # A bucket_selector can only filter the buckets of a multi-bucket parent aggregation
         bucket_interval_period = rule.get('bucket_interval_period')
+        bucket_selector = rule.get('aggregation_bucket_selector')
+        if bucket_selector and (bucket_interval_period is not None or query_key is not None):
+            metric_agg_element = dict(metric_agg_element, **bucket_selector)
+        else:
+            bucket_selector = None
+
         if bucket_interval_period is not None:
             aggs_element = {
                 'interval_aggs': {
@@ -271,17 +399,17 @@ class ElastAlerter(object):
 
         if query_key is not None:
             for idx, key in reversed(list(enumerate(query_key.split(',')))):
+                child_aggs = aggs_element
+                if bucket_selector and (idx < len(query_key.split(',')) - 1 or bucket_interval_period is not None):
+                    # Drop the buckets whose own sub-buckets were all filtered out
+                    child_name, = child_aggs.keys()
+                    child_aggs = dict(child_aggs, non_empty_selector={'bucket_selector': {
+                        'buckets_path': {'count': '%s._bucket_count' % (child_name)},
+                        'script': 'params.count > 0'}})
                 aggs_element = {'bucket_aggs': {'terms': {'field': key, 'size': terms_size,
                                                           'min_doc_count': rule.get('min_doc_count', 1)},
-                                                'aggs': aggs_element}}
-
-        if not rule['five']:
-            query_element['filtered'].update({'aggs': aggs_element})
-            aggs_query = {'aggs': query_element}
-        else:
-            aggs_query = query
-            aggs_query['aggs'] = aggs_element
-        return aggs_query
+                                                'aggs': child_aggs}}
+        return aggs_element
 
     def get_index_start(self, index, timestamp_field='@timestamp'):
         """ Query for one result sorted by timestamp to find the beginning of the index.
@@ -306,72 +434,252 @@ class ElastAlerter(object):
         return res['hits']['hits'][0][timestamp_field]
 
     @staticmethod
-    def process_hits(rule, hits):
-        """ Update the _source field for each hit received from ES based on the rule configuration.
+    def process_hit(rule, hit):
+        """ Update the _source field of a single hit received from ES based on the rule configuration.
 
         This replaces timestamps with datetime objects,
         folds important fields into _source and creates compound query_keys.
 
-        :return: A list of processed _source dictionaries.
+        :return: The processed _source dictionary.
         """
+        # Merge fields and _source
+        hit.setdefault('_source', {})
+        for key, value in list(hit.get('fields', {}).items()):
+            # Fields are returned as lists, assume any with length 1 are not arrays in _source
+            # Except sometimes they aren't lists. This is dependent on ES version
+            hit['_source'].setdefault(key, value[0] if type(value) is list and len(value) == 1 else value)
+
+        # Convert the timestamp to a datetime
+        ts = lookup_es_key(hit['_source'], rule['timestamp_field'])
+        if not ts and not rule["_source_enabled"]:
+            raise EAException(
+                "Error: No timestamp was found for hit. '_source_enabled' is set to false, check your mappings for stored fields"
+            )
 
-        processed_hits = []
-        for hit in hits:
-            # Merge fields and _source
-            hit.setdefault('_source', {})
-            for key, value in list(hit.get('fields', {}).items()):
-                # Fields are returned as lists, assume any with length 1 are not arrays in _source
-                # Except sometimes they aren't lists. This is dependent on ES version
-                hit['_source'].setdefault(key, value[0] if type(value) is list and len(value) == 1 else value)
-
-            # Convert the timestamp to a datetime
-            ts = lookup_es_key(hit['_source'], rule['timestamp_field'])
-            if not ts and not rule["_source_enabled"]:
-                raise EAException(
-                    "Error: No timestamp was found for hit. '_source_enabled' is set to false, check your mappings for stored fields"
-                )
+        set_es_key(hit['_source'], rule['timestamp_field'], rule['ts_to_dt'](ts))
+        set_es_key(hit, rule['timestamp_field'], lookup_es_key(hit['_source'], rule['timestamp_field']))
 
-            set_es_key(hit['_source'], rule['timestamp_field'], rule['ts_to_dt'](ts))
-            set_es_key(hit, rule['timestamp_field'], lookup_es_key(hit['_source'], rule['timestamp_field']))
+        # Tack metadata fields into _source
+        for field in ['_id', '_index', '_type']:
+            if field in hit:
+                hit['_source'][field] = hit[field]
 
-            # Tack metadata fields into _source
-            for field in ['_id', '_index', '_type']:
-                if field in hit:
-                    hit['_source'][field] = hit[field]
+        if rule.get('consolidated_query'):
+            # Remember which rules' filters the hit matched, see get_consolidated_hits
+            hit['_source']['_matched_queries'] = hit.get('matched_queries', [])
 
-            if rule.get('compound_query_key'):
-                values = [lookup_es_key(hit['_source'], key) for key in rule['compound_query_key']]
-                hit['_source'][rule['query_key']] = ', '.join([str(value) for value in values])
+        if rule.get('compound_query_key'):
+            values = [lookup_es_key(hit['_source'], key) for key in rule['compound_query_key']]
+            hit['_source'][rule['query_key']] = ', '.join([str(value) for value in values])
 
-            if rule.get('compound_aggregation_key'):
-                values = [lookup_es_key(hit['_source'], key) for key in rule['compound_aggregation_key']]
-                hit['_source'][rule['aggregation_key']] = ', '.join([str(value) for value in values])
+        if rule.get('compound_aggregation_key'):
+            values = [lookup_es_key(hit['_source'], key) for key in rule['compound_aggregation_key']]
+            hit['_source'][rule['aggregation_key']] = ', '.join([str(value) for value in values])
 
-            processed_hits.append(hit['_source'])
+        return hit['_source']
 
-        return processed_hits
+    @staticmethod
+    def process_hits(rule, hits):
+        """ Update the _source field for each hit received from ES based on the rule configuration.
+
+        :return: A list of processed _source dictionaries.
+        """
+        return [ElastAlerter.process_hit(rule, hit) for hit in hits]
+
+    @staticmethod
+    def stream_hits(rule, hits):
+        """ Lazily process a page of hits received from ES, yielding one processed _source dictionary at a time.
+        Hits are removed from the page as they are consumed, so the raw response can be freed while the
+        page is passed on to the rule type. """
+        hits.reverse()
+        for _ in range(len(hits)):
+            yield ElastAlerter.process_hit(rule, hits.pop())
 
     def get_hits(self, rule, starttime, endtime, index, scroll=False):
         """ Query Elasticsearch for the given rule and return the results.
+        With share_queries enabled, the results of a single page query are shared with every other
+        rule whose query has the same fingerprint, see get_query_fingerprint. With consolidate_queries
+        enabled, one query is run for every rule searching the same index, see get_consolidated_hits.
+
         :param rule: The rule configuration.
         :param starttime: The earliest time to query.
         :param endtime: The latest time to query.
-        :return: A list of hits, bounded by rule['max_query_size'] (or self.max_query_size).
+        :param scroll: If true, fetch the next page of a query started by a previous call.
+        :return: An iterable of processed hits, or None if the query failed.
         """
+        if scroll:
+            return self.query_hits(rule, starttime, endtime, index, scroll)
+        if rule.get('consolidate_queries') and rule['five']:
+            return self.get_consolidated_hits(rule, starttime, endtime)
+        if not rule.get('share_queries'):
+            return self.query_hits(rule, starttime, endtime, index)
+
+        key = self.get_query_fingerprint(rule, starttime, endtime, index)
+        future, leader = self.shared_queries.claim(key, rule['run_every'].total_seconds())
+        if not leader:
+            hits = future.result()
+            if hits is None:
+                # The leader's query failed or needed more than one page, run it for this rule alone
+                return self.query_hits(rule, starttime, endtime, index)
+            self.thread_data.num_hits += len(hits)
+            self.thread_data.total_hits = len(hits)
+            lt = rule.get('use_local_time')
+            elastalert_logger.info("Queried rule %s from %s to %s: %s / %s hits (shared)" % (
+                rule['name'],
+                pretty_ts(starttime, lt, self.pretty_ts_format),
+                pretty_ts(endtime, lt, self.pretty_ts_format),
+                self.thread_data.num_hits,
+                len(hits)
+            ))
+            if 'doc_type' not in rule and len(hits):
+                rule['doc_type'] = hits[0]['_type']
+            # Rule types and enhancements may change nested fields, so every rule gets its own copy
+            return [copy.deepcopy(hit) for hit in hits]
+
+        hits = None
+        try:
+            data = self.query_hits(rule, starttime, endtime, index)
+            if data is None or self.has_more_hits(rule):
+                return data
+            hits = list(data)
+            return [copy.deepcopy(hit) for hit in hits]
+        finally:
+            future.set_result(hits)
+
+    def get_query_fingerprint(self, rule, starttime, endtime, index):
+        """ Hashes everything that determines the processed hits returned for a rule's query: the cluster, the
+        generated query and the way the hits are processed. Rules with the same fingerprint can share a query. """
+        query = self.get_rule_query(rule, starttime, endtime)
+        fingerprint = self.get_hit_processing_settings(rule)
+        fingerprint.update({
+            'cluster': cluster_key(self.thread_data.current_es),
+            'index': index,
+            'query': query,
+            'include': rule['include'],
+            'size': rule.get('max_query_size', self.max_query_size),
+        })
+        return hashlib.sha1(json.dumps(fingerprint, sort_keys=True, default=str).encode('utf-8')).hexdigest()
 
-        query = self.get_query(
-            rule['filter'],
-            starttime,
-            endtime,
-            timestamp_field=rule['timestamp_field'],
-            to_ts_func=rule['dt_to_ts'],
-            five=rule['five'],
-        )
+    @staticmethod
+    def get_hit_processing_settings(rule):
+        """ Returns the rule settings that process_hit depends on. """
+        return dict((key, rule.get(key)) for key in ['_source_enabled', 'timestamp_field', 'timestamp_type',
+                                                     'timestamp_format', 'timestamp_format_expr', 'query_key',
+                                                     'compound_query_key', 'aggregation_key', 'compound_aggregation_key'])
+
+    def get_consolidation_key(self, rule):
+        """ Rules with the same consolidation key search the same index on the same cluster and schedule, with the
+        same query_delay, and process hits the same way, so their queries can be consolidated into one. The key is
+        computed once per rule, when the rule is initialized, and kept in rule['consolidation_key']. """
+        if 'consolidation_key' not in rule:
+            key = self.get_hit_processing_settings(rule)
+            key.update({
+                'cluster': conn_config_key(build_es_conn_config(rule)),
+                'index': rule['index'],
+                'use_strftime_index': rule.get('use_strftime_index'),
+                'search_extra_index': rule.get('search_extra_index'),
+                'run_every': rule.get('run_every', self.run_every).total_seconds(),
+                'query_delay': total_seconds(rule['query_delay']) if rule.get('query_delay') else 0,
+                'size': rule.get('max_query_size', self.max_query_size),
+            })
+            rule['consolidation_key'] = json.dumps(key, sort_keys=True, default=str)
+        return rule['consolidation_key']
+
+    def get_consolidated_hits(self, rule, starttime, endtime):
+        """ Query Elasticsearch once for every rule with consolidate_queries that has the same consolidation key.
+        Each rule's filters become a named clause of the query and hits are routed back to the rules using
+        matched_queries, with each rule's own time window re-applied. Rules whose window is not covered by the
+        consolidated query, or whose consolidated query does not fit in a single page, are queried on their own.
+
+        :return: An iterable of processed hits, or None if the query failed.
+        """
+        group_key = self.get_consolidation_key(rule)
+        key = hashlib.sha1(('%s %s' % (group_key, endtime)).encode('utf-8')).hexdigest()
+        future, leader = self.shared_queries.claim(key, rule['run_every'].total_seconds())
+        if leader:
+            result = None
+            try:
+                result = self.query_consolidated_hits(rule, group_key, starttime, endtime)
+            finally:
+                future.set_result(result)
+        else:
+            result = future.result()
+
+        if result is None or starttime < result['starttime'] or endtime > result['endtime']:
+            return self.query_hits(rule, starttime, endtime, self.get_index(rule, starttime, endtime))
+
+        hits = [copy.deepcopy(hit) for hit, names in result['hits']
+                if rule['name'] in names and starttime < lookup_es_key(hit, rule['timestamp_field']) <= endtime]
+        self.thread_data.num_hits += len(hits)
+        self.thread_data.total_hits = len(hits)
+        lt = rule.get('use_local_time')
+        elastalert_logger.info("Queried rule %s from %s to %s: %s / %s hits (consolidated)" % (
+            rule['name'],
+            pretty_ts(starttime, lt, self.pretty_ts_format),
+            pretty_ts(endtime, lt, self.pretty_ts_format),
+            self.thread_data.num_hits,
+            len(hits)
+        ))
+        if 'doc_type' not in rule and len(hits):
+            rule['doc_type'] = hits[0]['_type']
+        return hits
+
+    def query_consolidated_hits(self, rule, group_key, starttime, endtime):
+        """ Runs the consolidated query for the rules sharing group_key, covering the widest window any of them
+        queries when running continuously.
+
+        :return: A dictionary with the window queried and a list of processed hits with the names of the rules they
+            matched, or None if the results cannot be shared.
+        """
+        members = [member for member in list(self.rules) if member.get('consolidate_queries') and member.get('five')
+                   and member is not rule and self.get_consolidation_key(member) == group_key]
+        members.append(rule)
+        union_start = min([starttime] + [endtime - self.get_segment_size(member) for member in members])
+        includes = set()
+        for member in members:
+            includes.update(member['include'])
+        named_filters = [{'bool': {'filter': member['filter'], '_name': member['name']}} for member in members]
+
+        group_rule = self.copy_rule_for_query(rule)
+        group_rule['filter'] = [{'bool': {'should': named_filters, 'minimum_should_match': 1}}]
+        group_rule['include'] = ['*'] if '*' in includes else sorted(includes)
+        group_rule['consolidated_query'] = True
+
+        # The caller counts the hits routed to its own rule
+        num_hits = self.thread_data.num_hits
+        data = self.query_hits(group_rule, union_start, endtime, self.get_index(rule, union_start, endtime))
+        more_hits = data is not None and self.has_more_hits(group_rule)
+        self.thread_data.num_hits = num_hits
+        # The group rule is never paged further, so release its scroll or point in time right away
+        self.clear_pagination(group_rule)
+        if data is None:
+            return None
+        if more_hits:
+            elastalert_logger.info("Consolidated query for %d rules with rule %s did not fit in a single page, "
+                                   "querying the rules separately" % (len(members), rule['name']))
+            return None
+        hits = [(hit, hit.pop('_matched_queries', [])) for hit in data]
+        return {'starttime': union_start, 'endtime': endtime, 'hits': hits}
+
+    def query_hits(self, rule, starttime, endtime, index, scroll=False):
+        """ Query Elasticsearch for the given rule and return the results.
+        Results are paginated with a point in time and search_after where the cluster supports it,
+        falling back to a scroll otherwise. Pass scroll=True to fetch the page following the previous call.
+
+        :param rule: The rule configuration.
+        :param starttime: The earliest time to query.
+        :param endtime: The latest time to query.
+        :param scroll: If true, fetch the next page of a query started by a previous call.
+        :return: An iterator over the processed hits, bounded by rule['max_query_size'] (or self.max_query_size).
+        """
+
+        query = self.get_rule_query(rule, starttime, endtime)
         if self.thread_data.current_es.is_atleastsixsix():
             extra_args = {'_source_includes': rule['include']}
         else:
             extra_args = {'_source_include': rule['include']}
         scroll_keepalive = rule.get('scroll_keepalive', self.scroll_keepalive)
+        size = rule.get('max_query_size', self.max_query_size)
         if not rule.get('_source_enabled'):
             if rule['five']:
                 query['stored_fields'] = rule['include']
@@ -380,20 +688,31 @@ class ElastAlerter(object):
             extra_args = {}
 
         try:
-            if scroll:
-                res = self.thread_data.current_es.scroll(scroll_id=rule['scroll_id'], scroll=scroll_keepalive)
+            res = None
+            if not scroll and self.use_msearch(rule):
+                res = self.search_batched_page(rule, query, index, size)
+
+            if res is not None:
+                pass
+            elif self.use_point_in_time(rule):
+                res = self.search_point_in_time(rule, query, index, size, scroll_keepalive, scroll, extra_args)
+            elif scroll:
+                res = self.thread_data.current_es.scroll(scroll_id=rule['scroll_id'], scroll=scroll_keepalive,
+                                                         filter_path=self.hits_filter_path)
             else:
                 res = self.thread_data.current_es.search(
                     scroll=scroll_keepalive,
                     index=index,
-                    size=rule.get('max_query_size', self.max_query_size),
+                    size=size,
                     body=query,
                     ignore_unavailable=True,
+                    filter_path=self.hits_filter_path,
                     **extra_args
                 )
                 if '_scroll_id' in res:
                     rule['scroll_id'] = res['_scroll_id']
 
+            if not scroll:
                 if self.thread_data.current_es.is_atleastseven():
                     self.thread_data.total_hits = int(res['hits']['total']['value'])
                 else:
@@ -416,7 +735,7 @@ class ElastAlerter(object):
                 e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
             self.handle_error('Error running query: %s' % (e), {'rule': rule['name'], 'query': query})
             return None
-        hits = res['hits']['hits']
+        hits = self.get_response_hits(res)
         self.thread_data.num_hits += len(hits)
         lt = rule.get('use_local_time')
         status_log = "Queried rule %s from %s to %s: %s / %s hits" % (
@@ -426,17 +745,113 @@ class ElastAlerter(object):
             self.thread_data.num_hits,
             len(hits)
         )
-        if self.thread_data.total_hits > rule.get('max_query_size', self.max_query_size):
+        if self.thread_data.total_hits > size:
             elastalert_logger.info("%s (scrolling..)" % status_log)
         else:
             elastalert_logger.info(status_log)
 
-        hits = self.process_hits(rule, hits)
-
         # Record doc_type for use in get_top_counts
         if 'doc_type' not in rule and len(hits):
             rule['doc_type'] = hits[0]['_type']
-        return hits
+        return self.stream_hits(rule, hits)
+
+    @staticmethod
+    def get_response_hits(res):
+        """ Returns the hits of a search response, which are left out of responses filtered with filter_path
+        when there are none. """
+        return res.get('hits', {}).get('hits', [])
+
+    def use_msearch(self, rule):
+        """ Returns True if the rule's searches should be batched with those of other rules running against the
+        same cluster into a single _msearch request. Only supported from Elasticsearch 6 onwards. """
+        if not rule.get('use_msearch', False):
+            return False
+        return self.thread_data.current_es.is_atleastsix()
+
+    def batched_search(self, rule, index, body):
+        """ Runs a search for the rule as part of the next _msearch request sent to its cluster. """
+        header = {'ignore_unavailable': True}
+        if rule.get('doc_type') and not self.thread_data.current_es.is_atleastseven():
+            header['type'] = rule['doc_type']
+        return self.msearch_batcher.search(self.thread_data.current_es, index, body, **header)
+
+    def search_batched_page(self, rule, query, index, size):
+        """ Fetches the first page of hits for the rule through _msearch. Batched searches cannot be paginated,
+        so None is returned when the page does not contain every hit and the query has to be run on its own. """
+        body = dict(query, size=size)
+        if rule.get('_source_enabled'):
+            body['_source'] = rule['include']
+        if self.thread_data.current_es.is_atleastseven():
+            body['track_total_hits'] = True
+            res = self.batched_search(rule, index, body)
+            total_hits = int(res['hits']['total']['value'])
+        else:
+            res = self.batched_search(rule, index, body)
+            total_hits = int(res['hits']['total'])
+        if total_hits > len(res['hits']['hits']):
+            return None
+        return res
+
+    def use_point_in_time(self, rule):
+        """ Returns True if hits for this rule should be paginated using a point in time and search_after
+        instead of a scroll. Point in time searches are only available from Elasticsearch 7.12 onwards, where
+        the implicit _shard_doc tiebreaker makes search_after on the timestamp sort unambiguous. """
+        if not rule.get('use_point_in_time', True):
+            return False
+        return self.thread_data.current_es.is_atleastseventwelve()
+
+    def search_point_in_time(self, rule, query, index, size, keep_alive, search_after, extra_args):
+        """ Runs one page of a point in time search for the rule. The first page opens the point in time,
+        later pages resume after the sort values of the last hit of the previous page.
+
+        :param search_after: If true, continue from the previous page instead of opening a new point in time.
+        :return: The search response.
+        """
+        es_client = self.thread_data.current_es
+        if not search_after:
+            rule['pit_id'] = es_client.open_point_in_time(index=index, keep_alive=keep_alive, ignore_unavailable=True)['id']
+            query['track_total_hits'] = True
+        else:
+            query['search_after'] = rule['search_after']
+            query['track_total_hits'] = False
+        query['pit'] = {'id': rule['pit_id'], 'keep_alive': keep_alive}
+
+        res = es_client.search_point_in_time(body=query, size=size, filter_path=self.hits_filter_path, **extra_args)
+
+        # The point in time id may change between requests, always use the most recent one
+        rule['pit_id'] = res.get('pit_id', rule['pit_id'])
+        hits = self.get_response_hits(res)
+        if len(hits) == size:
+            rule['search_after'] = hits[-1]['sort']
+        else:
+            rule.pop('search_after', None)
+        return res
+
+    def has_more_hits(self, rule):
+        """ Returns True if a paginated query for the rule has more pages left to fetch. """
+        if rule.get('composite_after'):
+            return should_scrolling_continue(rule)
+        if not rule.get('scroll_id') and not rule.get('search_after'):
+            return False
+        return self.thread_data.num_hits < self.thread_data.total_hits and should_scrolling_continue(rule)
+
+    def clear_pagination(self, rule):
+        """ Releases any scroll or point in time context held open for the rule. """
+        if 'scroll_id' in rule:
+            scroll_id = rule.pop('scroll_id')
+            try:
+                self.thread_data.current_es.clear_scroll(scroll_id=scroll_id)
+            except NotFoundError:
+                pass
+
+        rule.pop('search_after', None)
+        rule.pop('composite_after', None)
+        if 'pit_id' in rule:
+            pit_id = rule.pop('pit_id')
+            try:
+                self.thread_data.current_es.close_point_in_time(pit_id)
+            except NotFoundError:
+                pass
 
     def get_hits_count(self, rule, starttime, endtime, index):
         """ Query Elasticsearch for the count of results and returns a list of timestamps
@@ -448,19 +863,18 @@ class ElastAlerter(object):
         :param endtime: The latest time to query.
         :return: A dictionary mapping timestamps to number of hits for that time period.
         """
-        query = self.get_query(
-            rule['filter'],
-            starttime,
-            endtime,
-            timestamp_field=rule['timestamp_field'],
-            sort=False,
-            to_ts_func=rule['dt_to_ts'],
-            five=rule['five']
-        )
+        query = self.get_rule_query(rule, starttime, endtime, sort=False)
 
         es_client = self.thread_data.current_es
         try:
-            if es_client.is_atleastsixtwo():
+            if self.use_msearch(rule):
+                body = dict(query, size=0)
+                if es_client.is_atleastseven():
+                    body['track_total_hits'] = True
+                    res = {'count': self.batched_search(rule, index, body)['hits']['total']['value']}
+                else:
+                    res = {'count': self.batched_search(rule, index, body)['hits']['total']}
+            elif es_client.is_atleastsixtwo():
                 res = es_client.count(
                     index=index,
                     body=query,
@@ -489,8 +903,75 @@ class ElastAlerter(object):
         )
         return {endtime: res['count']}
 
-    def get_hits_terms(self, rule, starttime, endtime, index, key, qk=None, size=None):
-        rule_filter = copy.copy(rule['filter'])
+    def get_hits_count_histogram(self, rule, starttime, segment_ends, index):
+        """ Query Elasticsearch for the count of results in each segment between starttime and the last of the
+        segment_ends, using a single date_histogram aggregation with one bucket per segment.
+
+        :param rule: The rule configuration dictionary.
+        :param starttime: The earliest time to query.
+        :param segment_ends: The end times of the consecutive, equally sized segments to count.
+        :return: A list of dictionaries mapping each segment's end time to its number of hits, in time order.
+        """
+        endtime = segment_ends[-1]
+        query = self.get_rule_query(rule, starttime, endtime, sort=False)
+        interval_ms = int(total_seconds(segment_ends[0] - starttime) * 1000)
+        # Histogram buckets include their start and exclude their end, while segments exclude their start and
+        # include their end, as the range query does. Buckets are shifted by a millisecond, the precision of date
+        # fields, so that each one covers exactly one segment, including a document at the very end of the last.
+        first_ms = dt_to_unixms(starttime) + 1
+        es_client = self.thread_data.current_es
+        histogram = {
+            'field': rule['timestamp_field'],
+            'offset': '%dms' % (first_ms % interval_ms),
+            'min_doc_count': 0,
+            'extended_bounds': {'min': first_ms, 'max': dt_to_unixms(endtime)},
+        }
+        histogram['fixed_interval' if es_client.is_atleastseventwo() else 'interval'] = '%dms' % (interval_ms)
+        query['aggs'] = {'counts': {'date_histogram': histogram}}
+
+        try:
+            if es_client.is_atleastsixtwo():
+                res = es_client.search(index=index, body=query, size=0, ignore_unavailable=True)
+            else:
+                res = es_client.deprecated_search(index=index, doc_type=rule['doc_type'], body=query, size=0,
+                                                  ignore_unavailable=True)
+        except ElasticsearchException as e:
+            # Elasticsearch sometimes gives us GIGANTIC error messages
+            # (so big that they will fill the entire terminal buffer)
+            if len(str(e)) > 1024:
+                e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
+            self.handle_error('Error running count histogram query: %s' % (e), {'rule': rule['name'], 'query': query})
+            return None
+
+        buckets = res.get('aggregations', {}).get('counts', {}).get('buckets', [])
+        counts = dict((bucket['key'], bucket['doc_count']) for bucket in buckets)
+        data = []
+        segment_start = starttime
+        for segment_end in segment_ends:
+            data.append({segment_end: counts.get(dt_to_unixms(segment_start) + 1, 0)})
+            segment_start = segment_end
+
+        total = sum(counts.values())
+        self.thread_data.num_hits += total
+        lt = rule.get('use_local_time')
+        elastalert_logger.info(
+            "Queried rule %s from %s to %s: %s hits in %s segments" % (
+                rule['name'], pretty_ts(starttime, lt, self.pretty_ts_format),
+                pretty_ts(endtime, lt, self.pretty_ts_format), total, len(segment_ends))
+        )
+        return data
+
+    def use_count_histogram(self, rule, segment_ends):
+        """ Count segments can be backfilled with a single date_histogram query when catching up on more than
+        one segment of a rule whose timestamp field is mapped as a date. """
+        return (rule.get('use_count_query') and rule.get('count_histogram_backfill') and rule['five']
+                and len(segment_ends) > 1 and not rule.get('query_timezone')
+                and rule.get('timestamp_type', 'iso') in ('iso', 'custom'))
+
+    @staticmethod
+    def get_query_key_filters(rule, qk=None):
+        """ Returns the filters restricting a query to events with the query_key value qk, if it is given. """
+        rule_filter = []
         if qk:
             qk_list = qk.split(",")
             end = None
@@ -500,28 +981,18 @@ class ElastAlerter(object):
                 end = '.raw'
 
             if len(qk_list) == 1:
-                qk = qk_list[0]
-                filter_key = rule['query_key']
-                if rule.get('raw_count_keys', True) and not rule['query_key'].endswith(end):
-                    filter_key = add_raw_postfix(filter_key, rule['five'])
-                rule_filter.extend([{'term': {filter_key: qk}}])
+                filter_keys = [rule['query_key']]
             else:
                 filter_keys = rule['compound_query_key']
-                for i in range(len(filter_keys)):
-                    key_with_postfix = filter_keys[i]
-                    if rule.get('raw_count_keys', True) and not key.endswith(end):
-                        key_with_postfix = add_raw_postfix(key_with_postfix, rule['five'])
-                    rule_filter.extend([{'term': {key_with_postfix: qk_list[i]}}])
-
-        base_query = self.get_query(
-            rule_filter,
-            starttime,
-            endtime,
-            timestamp_field=rule['timestamp_field'],
-            sort=False,
-            to_ts_func=rule['dt_to_ts'],
-            five=rule['five']
-        )
+            for filter_key, value in zip(filter_keys, qk_list):
+                if rule.get('raw_count_keys', True) and not filter_key.endswith(end):
+                    filter_key = add_raw_postfix(filter_key, rule['five'])
+                rule_filter.append({'term': {filter_key: value}})
+        return rule_filter
+
+    def get_hits_terms(self, rule, starttime, endtime, index, key, qk=None, size=None):
+        base_query = self.get_rule_query(rule, starttime, endtime, sort=False,
+                                         extra_filters=self.get_query_key_filters(rule, qk))
         if size is None:
             size = rule.get('terms_size', 50)
         query = self.get_terms_query(base_query, rule, size, key, rule['five'])
@@ -533,11 +1004,15 @@ class ElastAlerter(object):
                     doc_type=rule['doc_type'],
                     body=query,
                     search_type='count',
-                    ignore_unavailable=True
+                    ignore_unavailable=True,
+                    filter_path=self.aggregations_filter_path
                 )
+            elif self.use_msearch(rule):
+                res = self.batched_search(rule, index, dict(query, size=0))
             else:
                 res = self.thread_data.current_es.deprecated_search(index=index, doc_type=rule['doc_type'],
-                                                                    body=query, size=0, ignore_unavailable=True)
+                                                                    body=query, size=0, ignore_unavailable=True,
+                                                                    filter_path=self.aggregations_filter_path)
         except ElasticsearchException as e:
             # Elasticsearch sometimes gives us GIGANTIC error messages
             # (so big that they will fill the entire terminal buffer)
@@ -561,17 +1036,39 @@ class ElastAlerter(object):
         )
         return {endtime: buckets}
 
+    def get_hits_top_counts(self, rule, starttime, endtime, index, keys, qk=None, size=None):
+        """ Runs a single query with a terms aggregation for each of the keys.
+
+        :return: A dictionary mapping each key to its terms buckets, or None if the query failed.
+        """
+        query = self.get_rule_query(rule, starttime, endtime, sort=False,
+                                    extra_filters=self.get_query_key_filters(rule, qk))
+        query['aggs'] = {}
+        for i, key in enumerate(keys):
+            query['aggs']['counts_%d' % i] = {'terms': {'field': key,
+                                                        'size': size,
+                                                        'min_doc_count': rule.get('min_doc_count', 1)}}
+
+        try:
+            if self.use_msearch(rule):
+                res = self.batched_search(rule, index, dict(query, size=0))
+            else:
+                res = self.thread_data.current_es.deprecated_search(index=index, doc_type=rule.get('doc_type'),
+                                                                    body=query, size=0, ignore_unavailable=True)
+        except ElasticsearchException as e:
+            # Elasticsearch sometimes gives us GIGANTIC error messages
+            # (so big that they will fill the entire terminal buffer)
+            if len(str(e)) > 1024:
+                e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
+            self.handle_error('Error running top counts query: %s' % (e), {'rule': rule['name'], 'query': query})
+            return None
+
+        if 'aggregations' not in res:
+            return dict((key, []) for key in keys)
+        return dict((key, res['aggregations']['counts_%d' % i]['buckets']) for i, key in enumerate(keys))
+
     def get_hits_aggregation(self, rule, starttime, endtime, index, query_key, term_size=None):
-        rule_filter = copy.copy(rule['filter'])
-        base_query = self.get_query(
-            rule_filter,
-            starttime,
-            endtime,
-            timestamp_field=rule['timestamp_field'],
-            sort=False,
-            to_ts_func=rule['dt_to_ts'],
-            five=rule['five']
-        )
+        base_query = self.get_rule_query(rule, starttime, endtime, sort=False)
         if term_size is None:
             term_size = rule.get('terms_size', 50)
         query = self.get_aggregation_query(base_query, rule, query_key, term_size, rule['timestamp_field'])
@@ -582,11 +1079,15 @@ class ElastAlerter(object):
                     doc_type=rule.get('doc_type'),
                     body=query,
                     search_type='count',
-                    ignore_unavailable=True
+                    ignore_unavailable=True,
+                    filter_path=self.aggregations_filter_path
                 )
+            elif self.use_msearch(rule):
+                res = self.batched_search(rule, index, dict(query, size=0))
             else:
                 res = self.thread_data.current_es.deprecated_search(index=index, doc_type=rule.get('doc_type'),
-                                                                    body=query, size=0, ignore_unavailable=True)
+                                                                    body=query, size=0, ignore_unavailable=True,
+                                                                    filter_path=self.aggregations_filter_path)
         except ElasticsearchException as e:
             if len(str(e)) > 1024:
                 e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
@@ -606,17 +1107,119 @@ class ElastAlerter(object):
 
         return {endtime: payload}
 
+    def use_composite_paging(self, rule):
+        """ Terms queries and aggregation queries split by query_key can be paged through with a composite
+        aggregation when the rule sets composite_page_size. Terms queries split into frequency_bucket_interval
+        sized time buckets always are. """
+        if not rule['five'] or rule.get('use_count_query'):
+            return False
+        if rule.get('use_terms_query') and rule.get('frequency_bucket_interval'):
+            return True
+        if not rule.get('composite_page_size'):
+            return False
+        return bool(rule.get('use_terms_query') or (rule.get('aggregation_query_element') and rule.get('query_key')))
+
+    @staticmethod
+    def use_frequency_histogram(rule):
+        """ A frequency rule with a single query_key which does not attach related events only needs the number of
+        events for each query_key value over time. If frequency_bucket_interval is set, it is queried as a terms
+        query split into time buckets instead of downloading every event. """
+        return bool(rule.get('frequency_bucket_interval') and type(rule['type']) is FrequencyRule
+                    and rule.get('query_key') and 'compound_query_key' not in rule and not rule.get('attach_related')
+                    and not rule.get('use_count_query') and rule.get('five'))
+
+    def get_hits_composite(self, rule, starttime, endtime, index):
+        """ Fetches one page of a terms or aggregation query which buckets by query_key with a composite
+        aggregation. If there are more pages to fetch, the composite key to continue after is stored in
+        rule['composite_after'], see has_more_hits.
+
+        :return: The page of buckets in the same form as get_hits_terms or get_hits_aggregation would return them.
+        """
+        query = self.get_rule_query(rule, starttime, endtime, sort=False)
+        if rule.get('use_terms_query'):
+            fields = [rule['query_key']]
+        else:
+            fields = rule['query_key'].split(',')
+        size = rule.get('composite_page_size', 1000)
+        sources = [{'key_%d' % i: {'terms': {'field': field}}} for i, field in enumerate(fields)]
+        bucket_interval = rule.get('frequency_bucket_interval') if rule.get('use_terms_query') else None
+        if bucket_interval:
+            interval_ms = int(total_seconds(bucket_interval) * 1000)
+            histogram = {'field': rule['timestamp_field']}
+            histogram['fixed_interval' if self.thread_data.current_es.is_atleastseventwo() else 'interval'] = '%dms' % (interval_ms)
+            sources.insert(0, {'interval_key': {'date_histogram': histogram}})
+        composite = {'size': size, 'sources': sources}
+        if rule.get('composite_after'):
+            composite['after'] = rule['composite_after']
+        query['aggs'] = {'composite_aggs': {'composite': composite}}
+        if not rule.get('use_terms_query'):
+            query['aggs']['composite_aggs']['aggs'] = self.build_aggregation(rule, None, None, rule['timestamp_field'])
+
+        try:
+            if self.use_msearch(rule):
+                res = self.batched_search(rule, index, dict(query, size=0))
+            else:
+                res = self.thread_data.current_es.deprecated_search(index=index, doc_type=rule.get('doc_type'),
+                                                                    body=query, size=0, ignore_unavailable=True)
+        except ElasticsearchException as e:
+            # Elasticsearch sometimes gives us GIGANTIC error messages
+            # (so big that they will fill the entire terminal buffer)
+            if len(str(e)) > 1024:
+                e = str(e)[:1024] + '... (%d characters removed)' % (len(str(e)) - 1024)
+            self.handle_error('Error running composite query: %s' % (e), {'rule': rule['name'], 'query': query})
+            return None
+
+        rule.pop('composite_after', None)
+        if 'aggregations' not in res:
+            return {}
+        buckets = res['aggregations']['composite_aggs']['buckets']
+        if len(buckets) == size and res['aggregations']['composite_aggs'].get('after_key'):
+            rule['composite_after'] = res['aggregations']['composite_aggs']['after_key']
+        min_doc_count = rule.get('min_doc_count', 1)
+        buckets = [bucket for bucket in buckets if bucket['doc_count'] >= min_doc_count]
+
+        self.thread_data.num_hits += len(buckets)
+        lt = rule.get('use_local_time')
+        elastalert_logger.info(
+            'Queried rule %s from %s to %s: %s buckets' % (
+                rule['name'], pretty_ts(starttime, lt, self.pretty_ts_format),
+                pretty_ts(endtime, lt, self.pretty_ts_format), len(buckets))
+        )
+        if bucket_interval:
+            # Each time bucket is counted at its end, so buckets are passed on in time order
+            data = {}
+            for bucket in buckets:
+                timestamp = min(unix_to_dt((bucket['key']['interval_key'] + interval_ms) / 1000.0), endtime)
+                data.setdefault(timestamp, []).append({'key': bucket['key']['key_0'], 'doc_count': bucket['doc_count']})
+            return data
+        if rule.get('use_terms_query'):
+            return {endtime: [{'key': bucket['key']['key_0'], 'doc_count': bucket['doc_count']} for bucket in buckets]}
+        return {endtime: {'bucket_aggs': {'buckets': self.nest_composite_buckets(buckets, len(fields))}}}
+
+    @staticmethod
+    def nest_composite_buckets(buckets, depth, level=0):
+        """ Converts the buckets of a composite aggregation over depth keys into nested bucket_aggs buckets, the
+        form a terms aggregation for each key would have returned them in. """
+        if level == depth - 1:
+            return [dict(bucket, key=bucket['key']['key_%d' % level]) for bucket in buckets]
+        nested = []
+        for key, group in itertools.groupby(buckets, lambda bucket: bucket['key']['key_%d' % level]):
+            group = list(group)
+            nested.append({'key': key,
+                           'doc_count': sum(bucket['doc_count'] for bucket in group),
+                           'bucket_aggs': {'buckets': ElastAlerter.nest_composite_buckets(group, depth, level + 1)}})
+        return nested
+
     def remove_duplicate_events(self, data, rule):
-        new_events = []
+        """ Yields the events from data which have not already been seen by the rule. """
         for event in data:
             if event['_id'] in rule['processed_hits']:
+                self.thread_data.num_dupes += 1
                 continue
 
             # Remember the new data's IDs
             rule['processed_hits'][event['_id']] = lookup_es_key(event, rule['timestamp_field'])
-            new_events.append(event)
-
-        return new_events
+            yield event
 
     def remove_old_events(self, rule):
         # Anything older than the buffer time we can forget
@@ -633,8 +1236,11 @@ class ElastAlerter(object):
                 remove.append(_id)
         list(map(rule['processed_hits'].pop, remove))
 
-    def run_query(self, rule, start=None, end=None, scroll=False):
+    def run_query(self, rule, start=None, end=None):
         """ Query for the rule and pass all of the results to the RuleType instance.
+        Paginated results are fetched one page at a time until every hit has been
+        passed on or max_scrolling_count is reached. Each page is processed lazily and
+        passed to the RuleType in chunks of at most hits_chunk_size documents.
 
         :param rule: The rule configuration.
         :param start: The earliest time to query.
@@ -646,57 +1252,114 @@ class ElastAlerter(object):
         if end is None:
             end = ts_now()
 
+        for data in self.query_pages(rule, start, end):
+            # There was an exception while querying
+            if data is None:
+                return False
+            self.add_query_data(rule, data)
+        return True
+
+    def query_pages(self, rule, start, end):
+        """ Query for the rule, yielding the results one page at a time. If a query fails, None is yielded
+        and no more pages follow. Any pagination context is cleared once the generator is exhausted or closed.
+
+        :param rule: The rule configuration.
+        :param start: The earliest time to query.
+        :param end: The latest time to query.
+        """
         if rule.get('query_timezone'):
             elastalert_logger.info("Query start and end time converting UTC to query_timezone : {}".format(rule.get('query_timezone')))
             start = ts_utc_to_tz(start, rule.get('query_timezone'))
             end = ts_utc_to_tz(end, rule.get('query_timezone'))
 
-        # Reset hit counter and query
-        rule_inst = rule['type']
-        rule['scrolling_cycle'] = rule.get('scrolling_cycle', 0) + 1
         index = self.get_index(rule, start, end)
+        rule['scrolling_cycle'] = 0
+        scroll = False
+        try:
+            while True:
+                rule['scrolling_cycle'] = rule.get('scrolling_cycle', 0) + 1
+                if rule.get('use_count_query'):
+                    data = self.get_hits_count(rule, start, end, index)
+                elif self.use_composite_paging(rule):
+                    data = self.get_hits_composite(rule, start, end, index)
+                elif rule.get('use_terms_query'):
+                    data = self.get_hits_terms(rule, start, end, index, rule['query_key'])
+                elif rule.get('aggregation_query_element'):
+                    data = self.get_hits_aggregation(rule, start, end, index, rule.get('query_key', None))
+                else:
+                    data = self.get_hits(rule, start, end, index, scroll)
+
+                yield data
+                if data is None or not self.has_more_hits(rule):
+                    break
+                scroll = True
+        finally:
+            self.clear_pagination(rule)
+
+    def add_query_data(self, rule, data):
+        """ Passes one page of query results to the RuleType instance. """
+        rule_inst = rule['type']
         if rule.get('use_count_query'):
-            data = self.get_hits_count(rule, start, end, index)
-        elif rule.get('use_terms_query'):
-            data = self.get_hits_terms(rule, start, end, index, rule['query_key'])
-        elif rule.get('aggregation_query_element'):
-            data = self.get_hits_aggregation(rule, start, end, index, rule.get('query_key', None))
-        else:
-            data = self.get_hits(rule, start, end, index, scroll)
             if data:
-                old_len = len(data)
-                data = self.remove_duplicate_events(data, rule)
-                self.thread_data.num_dupes += old_len - len(data)
-
-        # There was an exception while querying
-        if data is None:
-            return False
-        elif data:
-            if rule.get('use_count_query'):
                 rule_inst.add_count_data(data)
-            elif rule.get('use_terms_query'):
+        elif rule.get('use_terms_query'):
+            if data:
                 rule_inst.add_terms_data(data)
-            elif rule.get('aggregation_query_element'):
+        elif rule.get('aggregation_query_element'):
+            if data:
                 rule_inst.add_aggregation_data(data)
-            else:
-                rule_inst.add_data(data)
+        else:
+            chunk_size = rule.get('hits_chunk_size', self.hits_chunk_size)
+            for events in chunks(self.remove_duplicate_events(data, rule), chunk_size):
+                rule_inst.add_data(events)
 
+    @staticmethod
+    def copy_rule_for_query(rule):
+        """ Returns a shallow copy of the rule without its pagination state, so a query can be run for it
+        without interfering with the rule's own queries. """
+        query_rule = dict(rule)
+        for key in ['scroll_id', 'pit_id', 'search_after', 'composite_after']:
+            query_rule.pop(key, None)
+        return query_rule
+
+    def fetch_segment(self, rule, start, end):
+        """ Runs every query for one segment of a rule's window, for use from a prefetch thread.
+
+        :return: A tuple of the list of result pages, or None if a query failed, and the number of hits.
+        """
+        self.thread_data.current_es = self.get_elasticsearch_client(rule)
+        self.thread_data.num_hits = 0
+        self.thread_data.total_hits = 0
+        segment_rule = self.copy_rule_for_query(rule)
+        pages = []
+        for data in self.query_pages(segment_rule, start, end):
+            if data is None:
+                return None, self.thread_data.num_hits
+            is_hits = not (rule.get('use_count_query') or rule.get('use_terms_query') or rule.get('aggregation_query_element'))
+            pages.append(list(data) if is_hits else data)
+        if 'doc_type' in segment_rule:
+            rule.setdefault('doc_type', segment_rule['doc_type'])
+        return pages, self.thread_data.num_hits
+
+    def prefetch_segments(self, rule, segment_ends):
+        """ Fetches the segments of a rule's window concurrently, keeping at most segment_prefetch segments in
+        flight, and yields each segment's end time and results in time order. See fetch_segment. """
+        depth = rule['segment_prefetch']
+        segments = zip([rule['starttime']] + segment_ends[:-1], segment_ends)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=depth)
         try:
-            if rule.get('scroll_id') and self.thread_data.num_hits < self.thread_data.total_hits and should_scrolling_continue(rule):
-                if not self.run_query(rule, start, end, scroll=True):
-                    return False
-        except RuntimeError:
-            # It's possible to scroll far enough to hit max recursive depth
-            pass
-
-        if 'scroll_id' in rule:
-            scroll_id = rule.pop('scroll_id')
-            try:
-                self.thread_data.current_es.clear_scroll(scroll_id=scroll_id)
-            except NotFoundError:
-                pass
-
-        return True
+            pending = []
+            for start, end in segments:
+                pending.append((end, executor.submit(self.fetch_segment, rule, start, end)))
+                if len(pending) == depth:
+                    end, future = pending.pop(0)
+                    yield end, future.result()
+            for end, future in pending:
+                yield end, future.result()
+        finally:
+            # Segments which have not started are cancelled, the running ones are waited for so that no query
+            # outlives the run once a segment has failed or the caller has stopped early
+            executor.shutdown(wait=True, cancel_futures=True)
 
     def get_starttime(self, rule):
         """ Query ES for the last time we ran this rule.
@@ -716,15 +1379,19 @@ class ElastAlerter(object):
             if self.writeback_es.is_atleastsixtwo():
                 if self.writeback_es.is_atleastsixsix():
                     res = self.writeback_es.search(index=index, size=1, body=query,
-                                                   _source_includes=['endtime', 'rule_name'])
+                                                   _source_includes=['endtime', 'rule_name'],
+                                                   filter_path=self.source_filter_path)
                 else:
                     res = self.writeback_es.search(index=index, size=1, body=query,
-                                                   _source_include=['endtime', 'rule_name'])
+                                                   _source_include=['endtime', 'rule_name'],
+                                                   filter_path=self.source_filter_path)
             else:
                 res = self.writeback_es.deprecated_search(index=index, doc_type=doc_type,
-                                                          size=1, body=query, _source_include=['endtime', 'rule_name'])
-            if res['hits']['hits']:
-                endtime = ts_to_dt(res['hits']['hits'][0]['_source']['endtime'])
+                                                          size=1, body=query, _source_include=['endtime', 'rule_name'],
+                                                          filter_path=self.source_filter_path)
+            hits = self.get_response_hits(res)
+            if hits:
+                endtime = ts_to_dt(hits[0]['_source']['endtime'])
 
                 if ts_now() - endtime < self.old_query_limit:
                     return endtime
@@ -812,6 +1479,29 @@ class ElastAlerter(object):
         else:
             return self.run_every
 
+    def use_adaptive_segment_size(self, rule):
+        """ Adaptive segment sizes are only used for plain queries, whose segments do not need to line up with run_every,
+        and not while prefetching segments, which needs every segment to be known in advance. """
+        if not rule.get('adaptive_segment_size') or rule.get('segment_prefetch', 0) > 0:
+            return False
+        return not rule.get('use_count_query') and not rule.get('use_terms_query') and not rule.get('aggregation_query_element')
+
+    def get_adaptive_segment_size(self, rule, segment_size, total_hits):
+        """ Returns the size of the next segment, scaled from the size of the previous one so that it would have
+        contained segment_target_hits hits. The size can at most double per segment and stays within
+        segment_size_min and segment_size_max.
+
+        :param segment_size: The size of the previous segment.
+        :param total_hits: The number of hits in the previous segment, or None if there was none.
+        """
+        if total_hits is not None:
+            target = rule.get('segment_target_hits', rule.get('max_query_size', self.max_query_size))
+            factor = min(float(target) / total_hits, 2.0) if total_hits else 2.0
+            segment_size = datetime.timedelta(seconds=segment_size.total_seconds() * factor)
+        minimum = rule.get('segment_size_min', datetime.timedelta(minutes=1))
+        maximum = rule.get('segment_size_max', datetime.timedelta(days=1))
+        return max(minimum, min(maximum, segment_size))
+
     def get_query_key_value(self, rule, match):
         # get the value for the match's query_key (or none) to form the key used for the silence_cache.
         # Flatline ruletype sets "key" instead of the actual query_key
@@ -878,13 +1568,26 @@ class ElastAlerter(object):
         elastalert_logger.debug("Enhanced filter with {} terms: {}".format(listname, str(query_str_filter)))
 
     def get_elasticsearch_client(self, rule):
-        key = rule['name']
-        es_client = self.es_clients.get(key)
-        if es_client is None:
-            es_client = elasticsearch_client(rule)
-            self.es_clients[key] = es_client
+        """ Returns the client for the cluster the rule queries. Rules with the same effective connection
+        config share a client, and with it the client's connection pool. """
+        key = conn_config_key(build_es_conn_config(rule))
+        with self.es_clients_lock:
+            es_client = self.es_clients.get(key)
+            if es_client is None:
+                es_client = elasticsearch_client(rule)
+                self.es_clients[key] = es_client
         return es_client
 
+    def remove_unused_es_clients(self):
+        """ Drops clients that none of the loaded rules connect with anymore. """
+        if not self.es_clients:
+            return
+        keys = set(conn_config_key(build_es_conn_config(rule)) for rule in self.rules)
+        with self.es_clients_lock:
+            for key in list(self.es_clients.keys()):
+                if key not in keys:
+                    self.es_clients.pop(key)
+
     def run_rule(self, rule, endtime, starttime=None):
         """ Run a rule for a given time period, including querying and alerting on results.
 
@@ -924,14 +1627,59 @@ class ElastAlerter(object):
 
         tmp_endtime = rule['starttime']
 
-        while endtime - rule['starttime'] > segment_size:
+        segment_ends = []
+        adaptive = self.use_adaptive_segment_size(rule)
+        while not adaptive and endtime - tmp_endtime > segment_size:
             tmp_endtime = tmp_endtime + segment_size
-            if not self.run_query(rule, rule['starttime'], tmp_endtime):
+            segment_ends.append(tmp_endtime)
+
+        if adaptive:
+            segment_size = self.get_adaptive_segment_size(rule, segment_size, None)
+            while endtime - rule['starttime'] > segment_size:
+                tmp_endtime = rule['starttime'] + segment_size
+                self.thread_data.total_hits = 0
+                if not self.run_query(rule, rule['starttime'], tmp_endtime):
+                    return 0
+                self.thread_data.cumulative_hits += self.thread_data.num_hits
+                self.thread_data.num_hits = 0
+                rule['starttime'] = tmp_endtime
+                rule['type'].garbage_collect(tmp_endtime)
+                segment_size = self.get_adaptive_segment_size(rule, segment_size, self.thread_data.total_hits)
+        elif self.use_count_histogram(rule, segment_ends):
+            # Catching up, count every segment with a single query
+            index = self.get_index(rule, rule['starttime'], segment_ends[-1])
+            counts = self.get_hits_count_histogram(rule, rule['starttime'], segment_ends, index)
+            if counts is None:
                 return 0
+            for data in counts:
+                self.add_query_data(rule, data)
+                segment_end, = data.keys()
+                rule['starttime'] = segment_end
+                rule['type'].garbage_collect(segment_end)
             self.thread_data.cumulative_hits += self.thread_data.num_hits
             self.thread_data.num_hits = 0
-            rule['starttime'] = tmp_endtime
-            rule['type'].garbage_collect(tmp_endtime)
+        elif rule.get('segment_prefetch', 0) > 0 and len(segment_ends) > 1:
+            # Catching up, fetch the segments concurrently but hand them to the rule type in order
+            prefetched = self.prefetch_segments(rule, segment_ends)
+            try:
+                for segment_end, (pages, num_hits) in prefetched:
+                    if pages is None:
+                        return 0
+                    for data in pages:
+                        self.add_query_data(rule, data)
+                    self.thread_data.cumulative_hits += num_hits
+                    rule['starttime'] = segment_end
+                    rule['type'].garbage_collect(segment_end)
+            finally:
+                prefetched.close()
+        else:
+            for segment_end in segment_ends:
+                if not self.run_query(rule, rule['starttime'], segment_end):
+                    return 0
+                self.thread_data.cumulative_hits += self.thread_data.num_hits
+                self.thread_data.num_hits = 0
+                rule['starttime'] = segment_end
+                rule['type'].garbage_collect(segment_end)
 
         if rule.get('aggregation_query_element'):
             if endtime - tmp_endtime == segment_size:
@@ -1034,7 +1782,11 @@ class ElastAlerter(object):
             self.scheduler.remove_job(job_id=new_rule['name'])
 
         try:
-            self.modify_rule_for_ES5(new_rule)
+            rule_es = self.get_elasticsearch_client(new_rule)
+            if not new:
+                # A changed rule may have been edited for an upgraded cluster, so ask the cluster for its version again
+                rule_es.refresh_es_version()
+            self.modify_rule_for_ES5(new_rule, rule_es)
         except TransportError as e:
             elastalert_logger.warning('Error connecting to Elasticsearch for rule {}. '
                                       'The rule has been disabled.'.format(new_rule['name']))
@@ -1043,6 +1795,9 @@ class ElastAlerter(object):
 
         self.enhance_filter(new_rule)
 
+        if self.use_frequency_histogram(new_rule):
+            new_rule['use_terms_query'] = True
+
         # Change top_count_keys to .raw
         if 'top_count_keys' in new_rule and new_rule.get('raw_count_keys', True):
             if self.string_multi_field_name:
@@ -1092,21 +1847,36 @@ class ElastAlerter(object):
                 continue
             new_rule[prop] = rule[prop]
 
-        job = self.scheduler.add_job(self.handle_rule_execution, 'interval',
+        if new_rule.get('consolidate_queries'):
+            self.get_consolidation_key(new_rule)
+
+        new_rule['query_template'] = QueryTemplate(new_rule['filter'], new_rule.get('timestamp_field', '@timestamp'),
+                                                   new_rule.get('dt_to_ts', dt_to_ts), new_rule.get('five', False))
+
+        job = self.scheduler.add_job(self.enqueue_rule, 'interval',
                                      args=[new_rule],
                                      seconds=new_rule['run_every'].total_seconds(),
                                      id=new_rule['name'],
                                      name="Rule: %s" % (new_rule['name']),
                                      max_instances=1,
-                                     jitter=5)
-        job.modify(next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=random.randint(0, 15)))
+                                     executor='rules')
+        job.modify(next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=self.get_schedule_offset(new_rule)))
 
         return new_rule
 
+    def get_schedule_offset(self, rule):
+        """ Returns how many seconds after being loaded a rule first runs. Rules are spread over schedule_spread, or
+        over their run_every if it is shorter, by a hash of their name, so their start times stay the same across
+        restarts and rules on the same schedule do not all query at once. """
+        spread = min(total_seconds(self.schedule_spread), total_seconds(rule['run_every']))
+        fraction = int(hashlib.sha1(rule['name'].encode('utf-8')).hexdigest(), 16) % 10000 / 10000.0
+        return spread * fraction
+
     @staticmethod
-    def modify_rule_for_ES5(new_rule):
-        # Get ES version per rule
-        rule_es = elasticsearch_client(new_rule)
+    def modify_rule_for_ES5(new_rule, rule_es=None):
+        # Get ES version per rule, requesting it only once per cluster
+        if rule_es is None:
+            rule_es = elasticsearch_client(new_rule)
         if rule_es.is_atleastfive():
             new_rule['five'] = True
         else:
@@ -1122,10 +1892,106 @@ class ElastAlerter(object):
                 new_filters.append(es_filter)
         new_rule['filter'] = new_filters
 
+    def send_cluster_heartbeat(self):
+        """ Renews the lease of this instance in the writeback index and updates the cluster members from the
+        leases which have not expired. """
+        now = ts_now()
+        lease_expires = now + self.cluster_lease_duration
+        body = {'cluster_instance': self.cluster.instance_id,
+                'cluster_shard': self.cluster.shard,
+                'lease_expires': dt_to_ts(lease_expires),
+                '@timestamp': dt_to_ts(now)}
+        query = {'filter': {'range': {'lease_expires': {'gt': dt_to_ts(now)}}}}
+        if self.writeback_es.is_atleastfive():
+            query = {'query': {'bool': query}}
+        doc_id = 'cluster_instance_%s' % (self.cluster.instance_id)
+
+        try:
+            doc_type = 'elastalert_status'
+            index = self.writeback_es.resolve_writeback_index(self.writeback_index, doc_type)
+            if self.writeback_es.is_atleastsixtwo():
+                self.writeback_es.index(index=index, id=doc_id, body=body)
+                res = self.writeback_es.search(index=index, body=query, size=1000, filter_path=self.source_filter_path)
+            else:
+                self.writeback_es.index(index=index, doc_type=doc_type, id=doc_id, body=body)
+                res = self.writeback_es.deprecated_search(index=index, doc_type=doc_type, body=query, size=1000,
+                                                          filter_path=self.source_filter_path)
+        except ElasticsearchException as e:
+            self.handle_error('Error sending cluster heartbeat: %s' % (e))
+            return
+        self.cluster.renewed(lease_expires)
+        instances = [hit['_source']['cluster_instance'] for hit in self.get_response_hits(res)
+                     if hit['_source'].get('cluster_shard') == self.cluster.shard]
+        self.cluster.update(instances)
+
+    def release_cluster_lease(self):
+        """ Deletes the lease of this instance on shutdown, so that the other instances take over its rules with
+        their next heartbeat instead of once the lease expires. """
+        if not self.cluster or self.cluster.lease_expires is None:
+            return
+        self.cluster.renewed(None)
+        doc_id = 'cluster_instance_%s' % (self.cluster.instance_id)
+        try:
+            index = self.writeback_es.resolve_writeback_index(self.writeback_index, 'elastalert_status')
+            if self.writeback_es.is_atleastsixtwo():
+                self.writeback_es.delete(index=index, id=doc_id)
+            else:
+                self.writeback_es.delete(index=index, doc_type='elastalert_status', id=doc_id)
+        except ElasticsearchException as e:
+            self.handle_error('Error releasing cluster lease: %s' % (e))
+
+    def owns_rule(self, rule):
+        """ Returns whether this instance runs the rule. Without cluster_mode, every loaded rule is run. In cluster
+        mode, a rule this instance has just become the owner of only runs once the previous owner has had two
+        heartbeats to notice. This does not change the rule, see take_over_rule. """
+        if not self.cluster:
+            return True
+        if not self.cluster.owns(rule['name']):
+            return False
+        return rule.get('cluster_owned') or ts_now() - self.cluster.changed_at >= self.cluster_heartbeat_interval * 2
+
+    def take_over_rule(self, rule):
+        """ Records that this instance released or acquired the rule and returns whether to run it. An acquired rule
+        continues from the last run the previous owner wrote to elastalert_status. Only called from
+        handle_rule_execution, so the rule is not running while its state is reset. """
+        if not self.cluster:
+            return True
+        if not self.cluster.owns(rule['name']):
+            if rule.get('cluster_owned'):
+                elastalert_logger.info('Released rule %s to %s' % (rule['name'], self.cluster.owner(rule['name'])))
+            rule['cluster_owned'] = False
+            return False
+        if not self.owns_rule(rule):
+            return False
+        if not rule.get('cluster_owned'):
+            for key in ('starttime', 'previous_endtime', 'minimum_starttime'):
+                rule.pop(key, None)
+            rule['processed_hits'] = {}
+            rule['cluster_owned'] = True
+            elastalert_logger.info('Acquired rule %s' % (rule['name']))
+        return True
+
+    def owns_rule_file(self, rule_file):
+        """ Returns whether the rules from rule_file run in this process. With the process engine, the rule files
+        are sharded across the worker processes by a stable hash of their name, and the supervisor runs none. """
+        if self.is_supervisor:
+            return False
+        if self.worker_index is None:
+            return True
+        shard = int(hashlib.sha1(str(rule_file).encode('utf-8')).hexdigest(), 16) % self.worker_processes
+        return shard == self.worker_index
+
+    def get_rule_hashes(self):
+        """ Returns the hashes of the rule files which run in this process. """
+        if self.is_supervisor:
+            return {}
+        rule_hashes = self.rules_loader.get_hashes(self.conf, self.args.rule)
+        return {rule_file: hash_value for rule_file, hash_value in rule_hashes.items() if self.owns_rule_file(rule_file)}
+
     def load_rule_changes(self):
         """ Using the modification times of rule config files, syncs the running rules
             to match the files in rules_folder by removing, adding or reloading rules. """
-        new_rule_hashes = self.rules_loader.get_hashes(self.conf, self.args.rule)
+        new_rule_hashes = self.get_rule_hashes()
 
         # Check each current rule for changes
         for rule_file, hash_value in self.rule_hashes.items():
@@ -1205,14 +2071,16 @@ class ElastAlerter(object):
                     continue
                 if self.init_rule(new_rule):
                     elastalert_logger.info('Loaded new rule %s' % (rule_file))
-                    if new_rule['name'] in self.es_clients:
-                        self.es_clients.pop(new_rule['name'])
                     self.rules.append(new_rule)
 
         self.rule_hashes = new_rule_hashes
+        self.remove_unused_es_clients()
 
     def start(self):
         """ Periodically go through each rule and run it """
+        if self.is_supervisor:
+            self.supervise_workers()
+            return
         if self.starttime:
             if self.starttime == 'NOW':
                 self.starttime = ts_now()
@@ -1236,6 +2104,15 @@ class ElastAlerter(object):
                                seconds=self.run_every.total_seconds(),
                                id='_internal_handle_config_change',
                                name='Internal: Handle Config Change')
+        if self.cluster:
+            self.send_cluster_heartbeat()
+            self.scheduler.add_job(self.send_cluster_heartbeat, 'interval',
+                                   seconds=self.cluster_heartbeat_interval.total_seconds(),
+                                   id='_internal_cluster_heartbeat',
+                                   name='Internal: Cluster Heartbeat',
+                                   executor='cluster')
+        for i in range(self.max_threads):
+            threading.Thread(target=self.run_queued_rules, name='elastalert-rule-%d' % (i), daemon=True).start()
         self.scheduler.start()
         while self.running:
             next_run = datetime.datetime.utcnow() + self.run_every
@@ -1245,6 +2122,7 @@ class ElastAlerter(object):
                 endtime = ts_to_dt(self.args.end)
 
                 if next_run.replace(tzinfo=dateutil.tz.tzutc()) > endtime:
+                    self.release_cluster_lease()
                     exit(0)
 
             if next_run < datetime.datetime.utcnow():
@@ -1258,6 +2136,74 @@ class ElastAlerter(object):
             sleep_duration = total_seconds(next_run - datetime.datetime.utcnow())
             self.sleep_for(sleep_duration)
 
+    def supervise_workers(self):
+        """ Runs worker_processes processes, each running its own shard of the rules end to end. A worker which
+        fails is restarted after a delay which doubles with each failure in a row, and the supervisor gives up
+        once a worker fails more than max_worker_restarts times in a row. Returns once every worker has exited
+        cleanly, for instance when --end is reached. """
+        self.running = True
+        elastalert_logger.info("Starting %d worker processes" % (self.worker_processes))
+        failures = dict.fromkeys(range(self.worker_processes), 0)
+        started = {}
+        restart_at = {}
+        for worker_index in range(self.worker_processes):
+            self.workers[worker_index] = self.start_worker(worker_index)
+            started[worker_index] = time.monotonic()
+        while self.running and (self.workers or restart_at):
+            timeout = None
+            if restart_at:
+                timeout = max(0, min(restart_at.values()) - time.monotonic())
+            multiprocessing.connection.wait([worker.sentinel for worker in self.workers.values()], timeout)
+            for worker_index, worker in list(self.workers.items()):
+                if worker.is_alive():
+                    continue
+                worker.join()
+                self.workers.pop(worker_index)
+                if worker.exitcode == 0:
+                    continue
+                # A worker which ran for longer than the longest delay is not failing in a loop
+                if time.monotonic() - started[worker_index] > self.worker_restart_max_delay:
+                    failures[worker_index] = 0
+                failures[worker_index] += 1
+                if failures[worker_index] > self.max_worker_restarts:
+                    self.stop_workers()
+                    raise EAException('Worker process %d failed %d times in a row, giving up' % (
+                        worker_index, failures[worker_index]))
+                delay = min(self.worker_restart_delay * 2 ** (failures[worker_index] - 1), self.worker_restart_max_delay)
+                elastalert_logger.error('Worker process %d exited with code %s, restarting it in %s seconds' % (
+                    worker_index, worker.exitcode, delay))
+                restart_at[worker_index] = time.monotonic() + delay
+            for worker_index, due in list(restart_at.items()):
+                if due <= time.monotonic():
+                    restart_at.pop(worker_index)
+                    self.workers[worker_index] = self.start_worker(worker_index)
+                    started[worker_index] = time.monotonic()
+        self.stop_workers()
+
+    def stop_workers(self, timeout=10):
+        """ Interrupts the worker processes so that they release their cluster leases and exit, and waits for
+        them. Workers which have not exited after timeout seconds are terminated. """
+        workers = list(self.workers.values())
+        self.workers = {}
+        for worker in workers:
+            if worker.is_alive():
+                try:
+                    os.kill(worker.pid, signal.SIGINT)
+                except ProcessLookupError:
+                    pass
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            worker.join(max(0, deadline - time.monotonic()))
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+
+    def start_worker(self, worker_index):
+        worker = multiprocessing.Process(target=run_worker, args=(self.cli_args, worker_index),
+                                         name='elastalert-worker-%d' % (worker_index), daemon=True)
+        worker.start()
+        return worker
+
     def wait_until_responsive(self, timeout, clock=timeit.default_timer):
         """Wait until ElasticSearch becomes responsive (or too much time passes)."""
 
@@ -1313,7 +2259,55 @@ class ElastAlerter(object):
             elastalert_logger.info(
                 "Background configuration change check run at %s" % (pretty_ts(ts_now(), ts_format=self.pretty_ts_format)))
 
+    def enqueue_rule(self, rule):
+        """ Queues a rule which is due to run for the rule threads. """
+        if not self.rule_queue.put(rule, self.get_overdue_seconds(rule)):
+            elastalert_logger.warning('Skipping scheduled run of %s, its previous run is still queued or running. '
+                                      'Rules in the queue are up to %d seconds behind.' % (rule['name'], self.rule_queue.lag()))
+
+    def log_missed_job(self, event):
+        """ Logs a scheduled run which the scheduler skipped because it started more than misfire_grace_time late. """
+        elastalert_logger.warning('Missed scheduled run of %s at %s, it started more than misfire_grace_time late' % (
+            event.job_id, event.scheduled_run_time))
+
+    def get_overdue_seconds(self, rule):
+        """ Returns how long, in seconds, the rule has been due to run: run_every after its previous run, which
+        queried up to query_delay before it ran. Runs skipped while the rule was still running count too. """
+        if 'previous_endtime' not in rule:
+            return 0
+        due = rule['previous_endtime'] + rule.get('query_delay', datetime.timedelta(0)) + rule['run_every']
+        return max(0, total_seconds(ts_now() - due))
+
+    def run_queued_rules(self):
+        """ Runs the most urgent queued rule, one at a time, until ElastAlert is stopped. """
+        while self.running:
+            rule, lag = self.rule_queue.get(timeout=1)
+            if rule is None:
+                continue
+            try:
+                # Skip rules which were removed or reloaded while they were queued
+                if not any(loaded_rule is rule for loaded_rule in self.rules):
+                    continue
+                rule['schedule_lag'] = lag
+                if self.statsd:
+                    try:
+                        self.statsd.gauge(
+                            'rule.schedule_lag', lag,
+                            tags={"elastalert_instance": self.statsd_instance_tag, "rule_name": rule['name']})
+                        self.statsd.gauge(
+                            'scheduler.queue_depth', len(self.rule_queue),
+                            tags={"elastalert_instance": self.statsd_instance_tag})
+                    except BaseException as e:
+                        elastalert_logger.error("unable to send metrics:\n%s" % str(e))
+                self.handle_rule_execution(rule)
+            except Exception as e:
+                self.handle_uncaught_exception(e, rule)
+            finally:
+                self.rule_queue.done(rule)
+
     def handle_rule_execution(self, rule):
+        if not self.take_over_rule(rule):
+            return
         self.thread_data.alerts_sent = 0
         next_run = datetime.datetime.utcnow() + rule['run_every']
         # Set endtime based on the rule's delay
@@ -1328,6 +2322,11 @@ class ElastAlerter(object):
         else:
             endtime = ts_now()
 
+        if (rule.get('share_queries') or rule.get('consolidate_queries')) and not (hasattr(self.args, 'end') and self.args.end):
+            # Line up the query windows of rules running on the same schedule so their queries can be shared
+            run_every = max(int(rule['run_every'].total_seconds()), 1)
+            endtime = unix_to_dt(dt_to_unix(endtime) // run_every * run_every)
+
         # Apply rules based on execution time limits
         if rule.get('limit_execution'):
             rule['next_starttime'] = None
@@ -1398,6 +2397,7 @@ class ElastAlerter(object):
     def stop(self):
         """ Stop an ElastAlert runner that's been started """
         self.running = False
+        self.release_cluster_lease()
 
     def get_disabled_rules(self):
         """ Return disabled rules """
@@ -1476,7 +2476,7 @@ class ElastAlerter(object):
                    'dashboard': db_js}
 
         # Upload
-        es = elasticsearch_client(rule)
+        es = self.get_elasticsearch_client(rule)
         # TODO: doc_type = _doc for elastic >= 6
         res = es.index(index='kibana-int',
                        doc_type='temp',
@@ -1491,7 +2491,7 @@ class ElastAlerter(object):
 
     def get_dashboard(self, rule, db_name):
         """ Download dashboard which matches use_kibana_dashboard from Elasticsearch. """
-        es = elasticsearch_client(rule)
+        es = self.get_elasticsearch_client(rule)
         if not db_name:
             raise EAException("use_kibana_dashboard undefined")
         query = {'query': {'term': {'_id': db_name}}}
@@ -1569,6 +2569,10 @@ class ElastAlerter(object):
 
                 start = ts_to_dt(lookup_es_key(match, rule['timestamp_field'])) - timeframe
                 end = ts_to_dt(lookup_es_key(match, rule['timestamp_field'])) + datetime.timedelta(minutes=10)
+                # Round the window out to whole minutes so matches close together can share the counts
+                start = start.replace(second=0, microsecond=0)
+                if end.second or end.microsecond:
+                    end = end.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
                 keys = rule.get('top_count_keys')
                 counts = self.get_top_counts(rule, start, end, keys, qk=qk)
                 match.update(counts)
@@ -1768,8 +2772,12 @@ class ElastAlerter(object):
                 # Original rule is missing, keep alert for later if rule reappears
                 continue
 
+            # Leave the alert to the instance running the rule
+            if not self.owns_rule(rule):
+                continue
+
             # Set current_es for top_count_keys query
-            self.thread_data.current_es = elasticsearch_client(rule)
+            self.thread_data.current_es = self.get_elasticsearch_client(rule)
 
             # Send the alert unless it's a future alert
             if ts_now() > ts_to_dt(alert_time):
@@ -2005,20 +3013,24 @@ class ElastAlerter(object):
             if self.writeback_es.is_atleastsixtwo():
                 if self.writeback_es.is_atleastsixsix():
                     res = self.writeback_es.search(index=index, size=1, body=query,
-                                                   _source_includes=['until', 'exponent'])
+                                                   _source_includes=['until', 'exponent'],
+                                                   filter_path=self.source_filter_path)
                 else:
                     res = self.writeback_es.search(index=index, size=1, body=query,
-                                                   _source_include=['until', 'exponent'])
+                                                   _source_include=['until', 'exponent'],
+                                                   filter_path=self.source_filter_path)
             else:
                 res = self.writeback_es.deprecated_search(index=index, doc_type=doc_type,
-                                                          size=1, body=query, _source_include=['until', 'exponent'])
+                                                          size=1, body=query, _source_include=['until', 'exponent'],
+                                                          filter_path=self.source_filter_path)
         except ElasticsearchException as e:
             self.handle_error("Error while querying for alert silence status: %s" % (e), {'rule': rule_name})
 
             return False
-        if res['hits']['hits']:
-            until_ts = res['hits']['hits'][0]['_source']['until']
-            exponent = res['hits']['hits'][0]['_source'].get('exponent', 0)
+        hits = self.get_response_hits(res)
+        if hits:
+            until_ts = hits[0]['_source']['until']
+            exponent = hits[0]['_source'].get('exponent', 0)
             if rule_name not in list(self.silence_cache.keys()):
                 self.silence_cache[rule_name] = (ts_to_dt(until_ts), exponent)
             else:
@@ -2089,21 +3101,38 @@ class ElastAlerter(object):
 
     def get_top_counts(self, rule, starttime, endtime, keys, number=None, qk=None):
         """ Counts the number of events for each unique value for each key field.
-        Returns a dictionary with top_events_<key> mapped to the top 5 counts for each key. """
-        all_counts = {}
+        Returns a dictionary with top_events_<key> mapped to the top 5 counts for each key.
+        Results are cached per rule, so matches with the same query key value and window reuse them. Windows which
+        end in the future are not cached, as events may still arrive in them. """
         if not number:
             number = rule.get('top_count_number', 5)
+        cache = rule.setdefault('top_counts_cache', {})
+        cache_key = (qk, starttime, endtime, tuple(keys), number)
+        if cache_key in cache:
+            return copy.deepcopy(cache[cache_key])
+
+        index = self.get_index(rule, starttime, endtime)
+        all_counts = {}
+        complete = True
+        if rule.get('five') and keys:
+            buckets_by_key = self.get_hits_top_counts(rule, starttime, endtime, index, keys, qk, number)
+            complete = buckets_by_key is not None
         for key in keys:
-            index = self.get_index(rule, starttime, endtime)
+            if rule.get('five'):
+                buckets = buckets_by_key.get(key) if buckets_by_key is not None else None
+            else:
+                hits_terms = self.get_hits_terms(rule, starttime, endtime, index, key, qk, number)
+                if hits_terms is None:
+                    buckets = None
+                    complete = False
+                else:
+                    buckets = list(hits_terms.values())[0]
+                    # get_hits_terms adds to num_hits, but we don't want to count these
+                    self.thread_data.num_hits -= len(buckets)
 
-            hits_terms = self.get_hits_terms(rule, starttime, endtime, index, key, qk, number)
-            if hits_terms is None:
+            if buckets is None:
                 top_events_count = {}
             else:
-                buckets = list(hits_terms.values())[0]
-
-                # get_hits_terms adds to num_hits, but we don't want to count these
-                self.thread_data.num_hits -= len(buckets)
                 terms = {}
                 for bucket in buckets:
                     terms[bucket['key']] = bucket['doc_count']
@@ -2114,6 +3143,10 @@ class ElastAlerter(object):
             # Save a dict with the top 5 events by key
             all_counts['top_events_%s' % (key)] = top_events_count
 
+        if complete and endtime <= ts_now():
+            if len(cache) >= 100:
+                cache.clear()
+            cache[cache_key] = copy.deepcopy(all_counts)
         return all_counts
 
     def next_alert_time(self, rule, name, timestamp):
@@ -2142,19 +3175,38 @@ class ElastAlerter(object):
         return timestamp + wait, exponent
 
 
-def handle_signal(signal, frame):
+def handle_signal(signal, frame, client=None):
     elastalert_logger.info('SIGINT received, stopping ElastAlert...')
+    if client is not None:
+        client.release_cluster_lease()
+        # Don't leave the worker processes of the process engine running without their supervisor
+        client.stop_workers()
     # use os._exit to exit immediately and avoid someone catching SystemExit
     os._exit(0)
 
 
+def run_worker(args, worker_index):
+    """ Entry point of the worker processes of the process execution engine """
+    signal.signal(signal.SIGINT, handle_signal)
+    client = ElastAlerter(args, worker_index=worker_index)
+    signal.signal(signal.SIGINT, functools.partial(handle_signal, client=client))
+
+    if client.prometheus_port and not client.debug:
+        p = PrometheusWrapper(client)
+        p.start()
+
+    client.start()
+
+
 def main(args=None):
     signal.signal(signal.SIGINT, handle_signal)
     if not args:
         args = sys.argv[1:]
     client = ElastAlerter(args)
+    signal.signal(signal.SIGINT, functools.partial(handle_signal, client=client))
 
-    if client.prometheus_port and not client.debug:
+    # With the process engine, the workers serve the metrics of their rules
+    if client.prometheus_port and not client.debug and not client.is_supervisor:
         p = PrometheusWrapper(client)
         p.start()
 
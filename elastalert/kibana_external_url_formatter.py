@@ -1,4 +1,3 @@
-import boto3
 import os
 from urllib.parse import parse_qsl, urlencode, urljoin, urlparse, urlsplit, urlunsplit
 
@@ -6,7 +5,7 @@ import requests
 from requests import RequestException
 from requests.auth import AuthBase, HTTPBasicAuth
 
-from elastalert.auth import RefeshableAWSRequestsAuth
+from elastalert.auth import get_aws_credentials, RefeshableAWSRequestsAuth
 from elastalert.util import EAException
 
 def append_security_tenant(url, security_tenant):
@@ -103,11 +102,7 @@ def create_kibana_auth(kibana_url, rule) -> AuthBase:
     if aws_region:
 
         aws_profile = rule.get('profile')
-        session = boto3.session.Session(
-            profile_name=aws_profile,
-            region_name=aws_region
-        )
-        credentials = session.get_credentials()
+        credentials, _ = get_aws_credentials(aws_profile, aws_region)
 
         kibana_host = urlparse(kibana_url).hostname
 
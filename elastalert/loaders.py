@@ -10,6 +10,7 @@ import yaml
 import yaml.scanner
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
+from jinja2 import meta
 from jinja2 import Template
 
 import elastalert.alerters.alerta
@@ -143,11 +144,12 @@ class RulesLoader(object):
 
         self.base_config = copy.deepcopy(conf)
 
-    def load(self, conf, args=None):
+    def load(self, conf, args=None, rule_filter=None):
         """
         Discover and load all the rules as defined in the conf and args.
         :param dict conf: Configuration dict
         :param dict args: Arguments dict
+        :param rule_filter: Optional function of a rule file name, only rule files for which it returns True are loaded
         :return: List of rules
         :rtype: list
         """
@@ -157,6 +159,8 @@ class RulesLoader(object):
         # Load each rule configuration file
         rules = []
         rule_files = self.get_names(conf, use_rule)
+        if rule_filter is not None:
+            rule_files = [rule_file for rule_file in rule_files if rule_filter(rule_file)]
         for rule_file in rule_files:
             try:
                 rule = self.load_configuration(rule_file, conf, args)
@@ -295,6 +299,12 @@ class RulesLoader(object):
                 rule['query_delay'] = datetime.timedelta(**rule['query_delay'])
             if 'buffer_time' in rule:
                 rule['buffer_time'] = datetime.timedelta(**rule['buffer_time'])
+            if 'segment_size_min' in rule:
+                rule['segment_size_min'] = datetime.timedelta(**rule['segment_size_min'])
+            if 'segment_size_max' in rule:
+                rule['segment_size_max'] = datetime.timedelta(**rule['segment_size_max'])
+            if 'frequency_bucket_interval' in rule:
+                rule['frequency_bucket_interval'] = datetime.timedelta(**rule['frequency_bucket_interval'])
             if 'run_every' in rule:
                 rule['run_every'] = datetime.timedelta(**rule['run_every'])
             if 'bucket_interval' in rule:
@@ -312,6 +322,11 @@ class RulesLoader(object):
         except (KeyError, TypeError) as e:
             raise EAException('Invalid time format used: %s' % e)
 
+        # use_cardinality_aggregation replaces buffer_time by timeframe, which is only worth a warning when the
+        # rule sets buffer_time itself rather than inheriting it from config.yaml
+        if rule.get('use_cardinality_aggregation') and 'timeframe' in rule and 'buffer_time' not in rule:
+            rule['buffer_time'] = rule['timeframe']
+
         # Set defaults, copy defaults from config.yaml
         for key, val in list(self.base_config.items()):
             rule.setdefault(key, val)
@@ -391,13 +406,21 @@ class RulesLoader(object):
         elif 'compare_key' in rule:
             rule['compound_compare_key'] = [rule['compare_key']]
         # Add QK, CK and timestamp to include
-        include = rule.get('include', ['*'])
+        include = rule.get('include')
+        if include is None:
+            include = ['*']
+            if rule.get('derive_include'):
+                referenced_fields = self.get_referenced_fields(rule)
+                if referenced_fields is not None:
+                    include = sorted(referenced_fields)
         if 'query_key' in rule:
             include.append(rule['query_key'])
         if 'compound_query_key' in rule:
             include += rule['compound_query_key']
         if 'compound_aggregation_key' in rule:
             include += rule['compound_aggregation_key']
+        elif 'aggregation_key' in rule:
+            include.append(rule['aggregation_key'])
         if 'compare_key' in rule:
             include.append(rule['compare_key'])
         if 'compound_compare_key' in rule:
@@ -451,6 +474,96 @@ class RulesLoader(object):
             else:
                 rule["jinja_template"] = Template(str(rule.get('alert_text', '')))
 
+    # Options of the built in rule types naming the fields they read from each document
+    rule_type_field_options = {
+        'frequency': [],
+        'any': [],
+        'spike': ['field_value'],
+        'blacklist': [],
+        'whitelist': [],
+        'change': [],
+        'flatline': [],
+        'new_term': ['fields'],
+        'cardinality': ['cardinality_field'],
+        'metric_aggregation': [],
+        'percentage_match': [],
+        'spike_aggregation': [],
+    }
+
+    # Options ending in _field or _fields which get_referenced_fields reads, or which do not name a document field
+    known_field_options = frozenset([
+        'timestamp_field', 'cardinality_field', 'alert_on_missing_field', 'summary_table_fields', 'http_post2_raw_fields',
+        'alertmanager_fields', 'email_from_field', 'ses_email_from_field', 'slack_alert_fields',
+        'rocket_chat_alert_fields', 'mattermost_msg_fields',
+    ])
+
+    def get_referenced_fields(self, rule):
+        """ Returns the document fields that the rule's type, alert text and alerters refer to, for use as include
+        when derive_include is set. The query, compare and aggregation keys and the timestamp field are added to
+        include separately. Returns None if the rule needs whole documents, for example because it uses match
+        enhancements, a custom rule type, an unknown option ending in _field or _fields or the whole match in a Jinja
+        template or HTTP POST payload. """
+        if rule.get('match_enhancements') or rule['type'] not in self.rule_type_field_options:
+            return None
+        # Any other option naming a field may be read from the match by an alerter
+        if any(option.endswith(('_field', '_fields')) and option not in self.known_field_options for option in rule):
+            return None
+
+        fields = set()
+
+        def add_fields(value):
+            if isinstance(value, str):
+                fields.add(value)
+            elif isinstance(value, list):
+                for item in value:
+                    add_fields(item)
+
+        for option in self.rule_type_field_options[rule['type']]:
+            add_fields(rule.get(option))
+
+        for option, value in rule.items():
+            if option.endswith('_args'):
+                add_fields(value)
+        add_fields(list(rule.get('alert_text_kw', {}).keys()))
+        add_fields(rule.get('summary_table_fields'))
+        add_fields(list(rule.get('http_post_payload', {}).values()))
+        add_fields(list(rule.get('http_post2_raw_fields', {}).values()))
+        add_fields(list(rule.get('alertmanager_fields', {}).values()))
+        add_fields(rule.get('email_from_field'))
+        add_fields(rule.get('ses_email_from_field'))
+        for option in ('slack_alert_fields', 'rocket_chat_alert_fields', 'mattermost_msg_fields'):
+            for value in rule.get(option) or []:
+                if isinstance(value, dict):
+                    add_fields(value.get('args') if option == 'mattermost_msg_fields' else value.get('value'))
+        for value in rule.get('opsgenie_details', {}).values():
+            if isinstance(value, dict):
+                add_fields(value.get('field'))
+
+        alerts = rule.get('alert', [])
+        alerts = [alerts] if isinstance(alerts, str) else alerts
+        alert_names = [alert if isinstance(alert, str) else list(alert.keys())[0] for alert in alerts]
+        if 'post' in alert_names and rule.get('http_post_all_values', not rule.get('http_post_payload')):
+            return None
+        if 'post2' in alert_names and rule.get('http_post2_all_values', not rule.get('http_post2_payload')):
+            return None
+
+        templates = []
+        if rule.get('alert_text_type') == 'alert_text_jinja':
+            if rule.get('jinja_template_path'):
+                templates.append(self.jinja_environment.loader.get_source(self.jinja_environment,
+                                                                          rule['jinja_template_path'])[0])
+            else:
+                templates.append(str(rule.get('alert_text', '')))
+        for key, value in rule.get('http_post2_payload', {}).items():
+            templates += [str(key), str(value)]
+        for template in templates:
+            variables = meta.find_undeclared_variables(self.jinja_environment.parse(template))
+            if rule['jinja_root_name'] in variables:
+                return None
+            fields.update(variables)
+
+        return fields
+
     def load_modules(self, rule, args=None):
         """ Loads things that could be modules. Enhancements, alerts and rule type. """
         # Set match enhancements
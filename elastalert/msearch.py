@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import threading
+from concurrent.futures import Future
+
+from elasticsearch.exceptions import TransportError
+
+from elastalert.util import conn_config_key
+from elastalert.util import elastalert_logger
+
+
+def cluster_key(es_client):
+    """ Returns a hashable key identifying the cluster and credentials an ElasticSearchClient talks to.
+    Searches are only batched together when they would have been sent with the same connection settings. """
+    return conn_config_key(es_client.conf)
+
+
+class MultiSearchBatcher(object):
+    """ Collects the searches that rules send to the same cluster within a short window of each other and
+    sends them to Elasticsearch as a single _msearch request. Each caller blocks until the batch has been
+    sent and gets back the response to its own search. """
+
+    def __init__(self, wait_time, max_size):
+        """
+        :param wait_time: How long, in seconds, the first search of a batch waits for other searches to join it.
+        :param max_size: The maximum number of searches sent in a single _msearch request.
+        """
+        self.wait_time = wait_time
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def search(self, es_client, index, body, **header):
+        """ Adds a search to the current batch for the client's cluster and waits for its response.
+
+        :param es_client: The ElasticSearchClient the search would otherwise have been sent with.
+        :param index: The index or indices to search.
+        :param body: The search definition.
+        :param header: Extra _msearch header options, such as ignore_unavailable.
+        :return: The search response.
+        :raises TransportError: If Elasticsearch returned an error for this search.
+        """
+        future = Future()
+        header['index'] = index
+        key = cluster_key(es_client)
+        with self.lock:
+            batch = self.pending.get(key)
+            if batch is None:
+                batch = self.pending[key] = []
+                timer = threading.Timer(self.wait_time, self.flush, args=(key, batch))
+                timer.daemon = True
+                timer.start()
+            batch.append((es_client, header, body, future))
+            full = len(batch) >= self.max_size
+        if full:
+            self.flush(key, batch)
+        return future.result()
+
+    def flush(self, key, batch):
+        """ Sends a batch of searches, unless it has already been sent, and hands each caller its response. """
+        with self.lock:
+            if self.pending.get(key) is not batch:
+                return
+            del self.pending[key]
+
+        es_client = batch[0][0]
+        body = []
+        for _, header, search_body, _ in batch:
+            body.append(header)
+            body.append(search_body)
+
+        elastalert_logger.debug("Sending %d searches in a single _msearch request" % len(batch))
+        try:
+            res = es_client.msearch(body=body)
+        except Exception as e:
+            for _, _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        responses = res.get('responses', [])
+        for i, (_, _, _, future) in enumerate(batch):
+            response = responses[i] if i < len(responses) else {'error': 'No response was returned for this search'}
+            if 'error' in response:
+                error = response['error']
+                error_type = error.get('type', error) if isinstance(error, dict) else error
+                future.set_exception(TransportError(response.get('status', 'N/A'), error_type, error))
+            else:
+                future.set_result(response)
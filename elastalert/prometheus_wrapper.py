@@ -22,6 +22,9 @@ class PrometheusWrapper:
         self.prom_alerts_not_sent = prometheus_client.Counter('elastalert_alerts_not_sent', 'Number of alerts not sent', ['rule_name'])
         self.prom_errors = prometheus_client.Counter('elastalert_errors', 'Number of errors for rule')
         self.prom_alerts_silenced = prometheus_client.Counter('elastalert_alerts_silenced', 'Number of silenced alerts', ['rule_name'])
+        self.prom_schedule_lag = prometheus_client.Gauge('elastalert_schedule_lag', 'Seconds rule was overdue to start', ['rule_name'])
+        self.prom_queue_depth = prometheus_client.Gauge('elastalert_scheduler_queue_depth', 'Number of rules waiting for a thread')
+        self.prom_queue_depth.set_function(lambda: len(client.rule_queue))
 
     def start(self):
         prometheus_client.start_http_server(self.prometheus_port)
@@ -30,6 +33,7 @@ class PrometheusWrapper:
         """ Increment counter every time rule is run """
         try:
             self.prom_scrapes.labels(rule['name']).inc()
+            self.prom_schedule_lag.labels(rule['name']).set(rule.get('schedule_lag', 0))
         finally:
             return self.run_rule(rule, endtime, starttime)
 
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from elastalert.util import dt_to_ts
+
+
+class QueryTemplate(object):
+    """ The parts of a rule's query that stay the same between runs, compiled once when the rule is initialised.
+    Rendering the template for a time range builds the same query as ElastAlerter.get_query, without copying
+    the rule's filters. Aggregations derived from the rule's configuration are cached on the template. """
+
+    def __init__(self, filters, timestamp_field='@timestamp', to_ts_func=dt_to_ts, five=False):
+        self.filters = filters
+        self.timestamp_field = timestamp_field
+        self.to_ts_func = to_ts_func
+        self.five = five
+        self.aggregations = {}
+
+    def matches(self, rule):
+        """ Returns True if the template is still up to date with the rule's filters and settings. """
+        return (self.filters is rule['filter'] and self.timestamp_field == rule['timestamp_field']
+                and self.to_ts_func is rule['dt_to_ts'] and self.five == rule['five'])
+
+    def render(self, starttime=None, endtime=None, sort=True, desc=False, extra_filters=None):
+        """ Returns a query dict for the time range, see ElastAlerter.get_query.
+
+        :param extra_filters: Filters to apply in addition to the rule's own filters.
+        """
+        starttime = self.to_ts_func(starttime)
+        endtime = self.to_ts_func(endtime)
+        if starttime and endtime:
+            must = [{'range': {self.timestamp_field: {'gt': starttime, 'lte': endtime}}}]
+            must.extend(self.filters)
+        else:
+            must = list(self.filters)
+        if extra_filters:
+            must.extend(extra_filters)
+        es_filters = {'filter': {'bool': {'must': must}}}
+        if self.five:
+            query = {'query': {'bool': es_filters}}
+        else:
+            query = {'query': {'filtered': es_filters}}
+        if sort:
+            # A new sort for every query, so that callers changing a query do not change the next ones
+            query['sort'] = [{self.timestamp_field: {'order': 'desc' if desc else 'asc'}}]
+        return query
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+
+class RuleQueue(object):
+    """ Holds the rules which are due to run until a rule thread is free. The most urgent rule is taken first: the
+    one which has been overdue the longest, weighted by its schedule_priority. High priority rules therefore do not
+    wait behind slow low priority rules, while low priority rules still run once they are far enough behind. A rule
+    is queued at most once, and not while it is running. """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.condition = threading.Condition()
+        self.queued = {}
+        self.running = set()
+
+    def __len__(self):
+        with self.condition:
+            return len(self.queued)
+
+    def put(self, rule, overdue=0):
+        """ Queues a rule which is due to run. overdue is how long, in seconds, the rule was already overdue when
+        it was queued, for instance because earlier runs were skipped while it was still running. Returns False if the
+        rule is already queued or running. """
+        with self.condition:
+            if rule['name'] in self.queued or rule['name'] in self.running:
+                return False
+            self.queued[rule['name']] = (self.clock() - overdue, rule)
+            self.condition.notify()
+            return True
+
+    def get(self, timeout=None):
+        """ Takes the most urgent rule, waiting up to timeout seconds for a rule to be queued.
+
+        :return: A tuple of the rule and how long, in seconds, it was overdue, or (None, None) on timeout. The
+            caller must call done once the rule has run.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.queued, timeout):
+                return None, None
+            now = self.clock()
+            name = max(self.queued, key=lambda name: self.urgency(self.queued[name], now))
+            due, rule = self.queued.pop(name)
+            self.running.add(name)
+            return rule, now - due
+
+    def done(self, rule):
+        """ Marks a rule taken with get as finished, so that it can be queued again. """
+        with self.condition:
+            self.running.discard(rule['name'])
+
+    def lag(self):
+        """ Returns how long, in seconds, the most overdue queued rule has been overdue. """
+        with self.condition:
+            if not self.queued:
+                return 0
+            return self.clock() - min(due for due, _ in self.queued.values())
+
+    @staticmethod
+    def urgency(entry, now):
+        due, rule = entry
+        return (now - due) * rule.get('schedule_priority', 1), -due
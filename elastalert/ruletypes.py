@@ -729,29 +729,43 @@ class NewTermsRule(RuleType):
                 else:
                     field_name['field'] = field
 
+            composite_page_size = self.rules.get('composite_page_size')
+            if composite_page_size:
+                terms_fields = field if isinstance(field, list) else [field]
+                if self.rules.get('use_keyword_postfix', True):
+                    terms_fields = [add_raw_postfix(sub_field, self.is_five_or_above()) for sub_field in terms_fields]
+
             # Query the entire time range in small chunks
             while tmp_start < end:
                 if self.rules.get('use_strftime_index'):
                     index = format_index(self.rules['index'], tmp_start, tmp_end)
                 else:
                     index = self.rules['index']
-                res = self.es.search(body=query, index=index, ignore_unavailable=True, timeout='50s')
-                if 'aggregations' in res:
-                    buckets = res['aggregations']['filtered']['values']['buckets']
+                if composite_page_size:
+                    # Page through every term instead of asking for all of them at once
+                    values = self.get_composite_terms(index, time_filter, terms_fields, composite_page_size)
                     if type(field) == list:
-                        # For composite keys, make the lookup based on all fields
-                        # Make it a tuple since it can be hashed and used in dictionary lookups
-                        for bucket in buckets:
-                            # We need to walk down the hierarchy and obtain the value at each level
-                            self.seen_values[tuple(field)] += self.flatten_aggregation_hierarchy(bucket)
+                        self.seen_values[tuple(field)] += values
                     else:
-                        keys = [bucket['key'] for bucket in buckets]
-                        self.seen_values[field] += keys
+                        self.seen_values[field] += [value for value, in values]
                 else:
-                    if type(field) == list:
-                        self.seen_values.setdefault(tuple(field), [])
+                    res = self.es.search(body=query, index=index, ignore_unavailable=True, timeout='50s')
+                    if 'aggregations' in res:
+                        buckets = res['aggregations']['filtered']['values']['buckets']
+                        if isinstance(field, list):
+                            # For composite keys, make the lookup based on all fields
+                            # Make it a tuple since it can be hashed and used in dictionary lookups
+                            for bucket in buckets:
+                                # We need to walk down the hierarchy and obtain the value at each level
+                                self.seen_values[tuple(field)] += self.flatten_aggregation_hierarchy(bucket)
+                        else:
+                            keys = [bucket['key'] for bucket in buckets]
+                            self.seen_values[field] += keys
                     else:
-                        self.seen_values.setdefault(field, [])
+                        if isinstance(field, list):
+                            self.seen_values.setdefault(tuple(field), [])
+                        else:
+                            self.seen_values.setdefault(field, [])
                 if tmp_start == tmp_end:
                     break
                 tmp_start = tmp_end
@@ -775,6 +789,31 @@ class NewTermsRule(RuleType):
                 self.seen_values[key] = list(set(values))
                 elastalert_logger.info('Found %s unique values for %s' % (len(set(values)), key))
 
+    def get_composite_terms(self, index, time_filter, fields, size):
+        """ Pages through a composite aggregation over fields to get every existing combination of their terms,
+        fetching at most size terms per request.
+
+        :return: A list of tuples of terms, one term per field.
+        """
+        sources = [{'key_%d' % i: {'terms': {'field': field}}} for i, field in enumerate(fields)]
+        composite = {'size': size, 'sources': sources}
+        query = {'query': {'bool': {'filter': [{'range': time_filter}] + list(self.rules.get('filter', []))}},
+                 'aggs': {'values': {'composite': composite}},
+                 'size': 0}
+        values = []
+        while True:
+            res = self.es.search(body=query, index=index, ignore_unavailable=True, timeout='50s')
+            if 'aggregations' not in res:
+                break
+            buckets = res['aggregations']['values']['buckets']
+            for bucket in buckets:
+                values.append(tuple(bucket['key']['key_%d' % i] for i in range(len(fields))))
+            after_key = res['aggregations']['values'].get('after_key')
+            if len(buckets) < size or not after_key:
+                break
+            composite['after'] = after_key
+        return values
+
     def flatten_aggregation_hierarchy(self, root, hierarchy_tuple=()):
         """ For nested aggregations, the results come back in the following format:
             {
@@ -918,13 +957,7 @@ class NewTermsRule(RuleType):
                         self.seen_values[field].append(bucket['key'])
 
     def is_five_or_above(self):
-        esinfo = self.es.info()['version']
-        if esinfo.get('distribution') == "opensearch":
-            # OpenSearch is based on Elasticsearch 7.10.2, currently only v1.0.0 exists
-            # https://opensearch.org/
-            return True
-        else:
-            return int(esinfo['number'][0]) >= 5
+        return self.es.is_atleastfive()
 
 
 class CardinalityRule(RuleType):
@@ -940,6 +973,48 @@ class CardinalityRule(RuleType):
         self.cardinality_cache = {}
         self.first_event = {}
         self.timeframe = self.rules['timeframe']
+        if self.rules.get('use_cardinality_aggregation'):
+            # Every run queries the whole timeframe, see ElastAlerter.set_starttime
+            if self.rules.get('allow_buffer_time_overlap') is False:
+                raise EAException("use_cardinality_aggregation requires allow_buffer_time_overlap")
+            if self.rules.get('buffer_time', self.timeframe) != self.timeframe:
+                elastalert_logger.warning("Rule %s uses use_cardinality_aggregation, so its buffer_time of %s is replaced "
+                                          "by its timeframe of %s" % (self.rules.get('name'), self.rules['buffer_time'],
+                                                                      self.timeframe))
+            if self.rules.get('query_key'):
+                # Page through every query_key value instead of only the top terms_size of them
+                self.rules.setdefault('composite_page_size', 1000)
+            self.rules['buffer_time'] = self.timeframe
+            self.rules['allow_buffer_time_overlap'] = True
+            self.rules['aggregation_query_element'] = self.generate_aggregation_query()
+
+    def generate_aggregation_query(self):
+        return {'cardinality_value': {'cardinality': {'field': self.cardinality_field}}}
+
+    def add_aggregation_data(self, payload):
+        """ Gets called when use_cardinality_aggregation is set, with the cardinality of cardinality_field over
+        the last timeframe, per query_key if it is set. """
+        for timestamp, payload_data in payload.items():
+            if 'bucket_aggs' in payload_data:
+                self.unwrap_term_buckets(timestamp, payload_data['bucket_aggs']['buckets'])
+            else:
+                self.check_aggregated_cardinality(timestamp, None, payload_data['cardinality_value']['value'])
+
+    def unwrap_term_buckets(self, timestamp, term_buckets, keys=()):
+        for term_data in term_buckets:
+            if 'bucket_aggs' in term_data:
+                self.unwrap_term_buckets(timestamp, term_data['bucket_aggs']['buckets'], keys + (term_data['key'],))
+            else:
+                query_key = ','.join([str(key) for key in keys + (term_data['key'],)])
+                self.check_aggregated_cardinality(timestamp, query_key, term_data['cardinality_value']['value'])
+
+    def check_aggregated_cardinality(self, timestamp, query_key, cardinality):
+        if (cardinality > self.rules.get('max_cardinality', float('inf')) or
+                cardinality < self.rules.get('min_cardinality', float('-inf'))):
+            event = {self.ts_field: timestamp}
+            if query_key is not None:
+                event[self.rules['query_key']] = query_key
+            self.add_match(event)
 
     def add_data(self, data):
         qk = self.rules.get('query_key')
@@ -1075,6 +1150,8 @@ class MetricAggregationRule(BaseAggregationRule):
             raise EAException("percentile_range must be specified for percentiles aggregation")
 
         self.rules['aggregation_query_element'] = self.generate_aggregation_query()
+        if self.rules.get('threshold_pushdown') and self.rules['metric_agg_type'] in self.allowed_aggregations:
+            self.rules['aggregation_bucket_selector'] = self.generate_bucket_selector()
 
     def get_match_str(self, match):
         metric_format_string = self.rules.get('metric_format_string', None)
@@ -1093,6 +1170,21 @@ class MetricAggregationRule(BaseAggregationRule):
             query[self.metric_key][self.rules['metric_agg_type']]['percents'] = [self.rules['percentile_range']]
         return query
 
+    def generate_bucket_selector(self):
+        """ Returns a bucket_selector aggregation which drops the buckets that do not cross a threshold, so that
+        Elasticsearch only returns the buckets which crossed one. They are still checked by crossed_thresholds. """
+        conditions = []
+        params = {}
+        if 'max_threshold' in self.rules:
+            conditions.append('params.value > params.max_threshold')
+            params['max_threshold'] = self.rules['max_threshold']
+        if 'min_threshold' in self.rules:
+            conditions.append('params.value < params.min_threshold')
+            params['min_threshold'] = self.rules['min_threshold']
+        return {'threshold_selector': {'bucket_selector': {
+            'buckets_path': {'value': self.metric_key},
+            'script': {'source': ' || '.join(conditions), 'params': params}}}}
+
     def check_matches(self, timestamp, query_key, aggregation_data):
         if "compound_query_key" in self.rules:
             self.check_matches_recursive(timestamp, query_key, aggregation_data, self.rules['compound_query_key'], dict())
@@ -1257,6 +1349,8 @@ class PercentageMatchRule(BaseAggregationRule):
         self.min_denominator = self.rules.get('min_denominator', 0)
         self.match_bucket_filter = self.rules['match_bucket_filter']
         self.rules['aggregation_query_element'] = self.generate_aggregation_query()
+        if self.rules.get('threshold_pushdown'):
+            self.rules['aggregation_bucket_selector'] = self.generate_bucket_selector()
 
     def get_match_str(self, match):
         percentage_format_string = self.rules.get('percentage_format_string', None)
@@ -1284,6 +1378,31 @@ class PercentageMatchRule(BaseAggregationRule):
             }
         }
 
+    def generate_bucket_selector(self):
+        """ Returns a bucket_script aggregation computing the match percentage and a bucket_selector aggregation
+        which drops the buckets where it is within the limits, so that Elasticsearch only returns the buckets
+        which violate them. They are still checked by percentage_violation. """
+        conditions = []
+        params = {'min_denominator': self.min_denominator}
+        if 'max_percentage' in self.rules:
+            conditions.append('params.percentage > params.max_percentage')
+            params['max_percentage'] = self.rules['max_percentage']
+        if 'min_percentage' in self.rules:
+            conditions.append('params.percentage < params.min_percentage')
+            params['min_percentage'] = self.rules['min_percentage']
+        counts_path = {'match': "percentage_match_aggs['match_bucket']>_count",
+                       'other': "percentage_match_aggs['_other_']>_count"}
+        return {
+            'match_percentage': {'bucket_script': {
+                'buckets_path': counts_path,
+                'script': 'params.match * 100.0 / Math.max(params.match + params.other, 1)'}},
+            'percentage_selector': {'bucket_selector': {
+                'buckets_path': dict(counts_path, percentage='match_percentage'),
+                'script': {'source': 'double total = params.match + params.other; '
+                                     'total > 0 && total >= params.min_denominator && (%s)' % (' || '.join(conditions)),
+                           'params': params}}},
+        }
+
     def check_matches(self, timestamp, query_key, aggregation_data):
         match_bucket_count = aggregation_data['percentage_match_aggs']['buckets']['match_bucket']['doc_count']
         other_bucket_count = aggregation_data['percentage_match_aggs']['buckets']['_other_']['doc_count']
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from elasticsearch.compat import string_types
+from elasticsearch.exceptions import ImproperlyConfigured
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONSerializer(JSONSerializer):
+    """ Elasticsearch serializer which decodes responses and encodes requests with orjson when it is installed.
+    orjson encodes datetimes and dates natively. Without orjson, or for values orjson cannot encode, such as
+    integers wider than 64 bits, the stdlib based :class:`JSONSerializer` is used. """
+
+    def loads(self, s):
+        if orjson is None:
+            return super(FastJSONSerializer, self).loads(s)
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError as e:
+            raise SerializationError(s, e)
+
+    def dumps(self, data):
+        if orjson is None or isinstance(data, string_types):
+            return super(FastJSONSerializer, self).dumps(data)
+        try:
+            return orjson.dumps(data, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except TypeError:
+            return super(FastJSONSerializer, self).dumps(data)
+
+
+def get_serializer(name):
+    """ Returns the serializer for the es_json_serializer option, ``orjson`` or ``stdlib``. """
+    if name == 'orjson':
+        return FastJSONSerializer()
+    if name == 'stdlib':
+        return JSONSerializer()
+    raise ImproperlyConfigured('Unknown es_json_serializer %s, must be orjson or stdlib' % (name))
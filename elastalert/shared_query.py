@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from concurrent.futures import Future
+
+
+class SharedQueryCache(object):
+    """ Shares the results of identical queries between rules. The first rule to run a query becomes its leader
+    and runs it, every other rule running the same query before the result expires waits for and reuses it. """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def claim(self, key, ttl):
+        """ Looks up the result of the query identified by key.
+
+        :param key: The fingerprint of the query.
+        :param ttl: How long, in seconds, the result is kept once the query has been run.
+        :return: A tuple of a Future for the result and whether the caller is the leader. The leader must run the
+            query and set the result of the Future, which is None when the result cannot be shared.
+        """
+        now = self.clock()
+        with self.lock:
+            for expired in [k for k, (expires, _) in self.entries.items() if expires <= now]:
+                del self.entries[expired]
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry[1], False
+            future = Future()
+            self.entries[key] = (now + ttl, future)
+            return future, True
@@ -187,7 +187,7 @@ class MockElastAlerter(object):
         es_client = elasticsearch_client(conf)
 
         try:
-            ElastAlerter.modify_rule_for_ES5(conf)
+            ElastAlerter.modify_rule_for_ES5(conf, es_client)
         except EAException as ea:
             print('Invalid filter provided:', str(ea), file=sys.stderr)
             if self.args.stop_error:
@@ -414,9 +414,46 @@ def build_es_conn_config(conf):
     if 'es_url_prefix' in conf:
         parsed_conf['es_url_prefix'] = conf['es_url_prefix']
 
+    if 'es_pool_maxsize' in conf:
+        parsed_conf['es_pool_maxsize'] = conf['es_pool_maxsize']
+
+    if 'es_json_serializer' in conf:
+        parsed_conf['es_json_serializer'] = conf['es_json_serializer']
+
+    if 'es_http_compress' in conf:
+        parsed_conf['es_http_compress'] = conf['es_http_compress']
+
     return parsed_conf
 
 
+def conn_config_key(es_conn_conf):
+    """ Returns a hashable key identifying the cluster, credentials and connection settings an es_conn_config
+    connects with. Two configs with the same key can share a client. Ref. :func:`~util.build_es_conn_config` """
+    return (
+        es_conn_conf.get('es_host'),
+        tuple(es_conn_conf.get('es_hosts') or ()),
+        es_conn_conf.get('es_port'),
+        es_conn_conf.get('es_url_prefix'),
+        es_conn_conf.get('use_ssl'),
+        es_conn_conf.get('verify_certs'),
+        es_conn_conf.get('ca_certs'),
+        es_conn_conf.get('client_cert'),
+        es_conn_conf.get('client_key'),
+        es_conn_conf.get('ssl_show_warn'),
+        es_conn_conf.get('es_username'),
+        es_conn_conf.get('es_password'),
+        es_conn_conf.get('es_api_key'),
+        es_conn_conf.get('es_bearer'),
+        es_conn_conf.get('aws_region'),
+        es_conn_conf.get('profile'),
+        es_conn_conf.get('es_conn_timeout'),
+        es_conn_conf.get('send_get_body_as'),
+        es_conn_conf.get('es_pool_maxsize'),
+        es_conn_conf.get('es_http_compress'),
+        es_conn_conf.get('es_json_serializer'),
+    )
+
+
 def pytzfy(dt):
     # apscheduler requires pytz timezone objects
     # This function will replace a dateutil.tz one with a pytz one
@@ -485,12 +522,30 @@ def should_scrolling_continue(rule_conf):
     :param: rule_conf as dict
     :rtype: bool
     """
-    max_scrolling = rule_conf.get('max_scrolling_count')
+    max_scrolling = rule_conf.get('max_scrolling_count', 0)
     stop_the_scroll = 0 < max_scrolling <= rule_conf.get('scrolling_cycle')
 
     return not stop_the_scroll
 
 
+def chunks(iterable, size):
+    """
+    Splits an iterable into lists of at most size items, consuming it lazily.
+
+    :param iterable: The items to split
+    :param size: The maximum number of items in each list
+    :rtype: generator of lists
+    """
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 def _expand_string_into_dict(string, value, sep='.'):
     """
     Converts a encapsulated string-dict to a sequence of dict. Use separator (default '.') to split the string.
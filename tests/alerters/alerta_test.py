@@ -893,7 +893,7 @@ def test_get_json_payload_error():
     alert = AlertaAlerter(rule)
 
     mock_run = mock.MagicMock(side_effect=Exception)
-    with mock.patch('json.dumps', mock_run):
+    with mock.patch.object(alert, 'serialize_payload', mock_run):
 
         with pytest.raises(Exception) as e:
             alert.get_json_payload(match)
@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
-from elastalert.auth import Auth, RefeshableAWSRequestsAuth
+import os
+import threading
+from unittest import mock
+
+import boto3
+
+from elastalert.auth import Auth, get_aws_client, get_aws_credentials, RefeshableAWSRequestsAuth
 
 
 def test_auth_none():
@@ -40,3 +46,51 @@ def test_auth_aws_region():
 
     assert type(auth) == RefeshableAWSRequestsAuth
     assert auth.aws_region == 'us-east-1'
+
+
+@mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'access', 'AWS_SECRET_ACCESS_KEY': 'secret'}, clear=True)
+def test_auth_aws_credentials_shared():
+    with mock.patch('elastalert.auth.boto3.session.Session', wraps=boto3.session.Session) as session:
+        first = Auth()(host='host1:443', username=None, password=None, aws_region='us-east-1', profile_name=None)
+        second = Auth()(host='host2:443', username=None, password=None, aws_region='us-east-1', profile_name=None)
+        other = Auth()(host='host1:443', username=None, password=None, aws_region='eu-west-1', profile_name=None)
+
+    assert session.call_count == 2
+    assert first.refreshable_credential is second.refreshable_credential
+    assert first.aws_host == 'host1:443'
+    assert second.aws_host == 'host2:443'
+    assert other.aws_region == 'eu-west-1'
+    assert other.aws_access_key == 'access'
+
+
+@mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'access', 'AWS_SECRET_ACCESS_KEY': 'secret'}, clear=True)
+def test_get_aws_client_shared():
+    sns = get_aws_client('sns', region_name='us-east-1')
+    assert get_aws_client('sns', region_name='us-east-1') is sns
+    assert get_aws_client('ses', region_name='us-east-1') is not sns
+    assert get_aws_client('sns', region_name='eu-west-1') is not sns
+
+
+@mock.patch.dict(os.environ, {'AWS_ACCESS_KEY_ID': 'access', 'AWS_SECRET_ACCESS_KEY': 'secret'}, clear=True)
+def test_get_aws_credentials_slow_lookup_does_not_block():
+    # A slow lookup, such as the instance metadata service, only holds up callers of the same profile and region
+    started = threading.Event()
+    release = threading.Event()
+    get_credentials = boto3.session.Session.get_credentials
+
+    def slow_get_credentials(session):
+        if session.region_name == 'us-east-1':
+            started.set()
+            release.wait(10)
+        return get_credentials(session)
+
+    with mock.patch('boto3.session.Session.get_credentials', autospec=True, side_effect=slow_get_credentials):
+        slow = threading.Thread(target=get_aws_credentials, kwargs={'region_name': 'us-east-1'})
+        slow.start()
+        assert started.wait(10)
+        credentials, region = get_aws_credentials(region_name='eu-west-1')
+        assert region == 'eu-west-1'
+        assert credentials.access_key == 'access'
+        release.set()
+        slow.join(10)
+    assert get_aws_credentials(region_name='us-east-1')[0].access_key == 'access'
@@ -2,6 +2,9 @@
 import copy
 import datetime
 import json
+import logging
+import queue
+import signal
 import threading
 
 import elasticsearch
@@ -10,12 +13,19 @@ import pytest
 from elasticsearch.exceptions import ConnectionError
 from elasticsearch.exceptions import ElasticsearchException
 
+from elastalert.elastalert import ElastAlerter
+from elastalert.elastalert import handle_signal
+from elastalert.elastalert import main
+from elastalert.elastalert import run_worker
 from elastalert.enhancements import BaseEnhancement
 from elastalert.enhancements import DropMatchException
 from elastalert.enhancements import TimeEnhancement
 from elastalert.kibana import dashboard_temp
 from elastalert.kibana_external_url_formatter import AbsoluteKibanaExternalUrlFormatter
 from elastalert.kibana_external_url_formatter import ShortKibanaExternalUrlFormatter
+from elastalert.query_template import QueryTemplate
+from elastalert.ruletypes import FrequencyRule
+from elastalert.util import build_es_conn_config
 from elastalert.util import dt_to_ts
 from elastalert.util import dt_to_unix
 from elastalert.util import dt_to_unixms
@@ -80,9 +90,13 @@ def test_init_rule(ea):
     new_rule = ea.init_rule(new_rule, False)
     for prop in ['starttime', 'agg_matches', 'current_aggregate_id', 'processed_hits', 'minimum_starttime', 'run_every']:
         assert new_rule[prop] == ea.rules[0][prop]
+    # The version of a changed rule's cluster is requested again, through the shared client
+    rule_es = ea.get_elasticsearch_client(new_rule)
+    assert rule_es.refresh_es_version.call_count == 1
 
     # Properties are fresh
     new_rule = ea.init_rule(new_rule, True)
+    assert rule_es.refresh_es_version.call_count == 1
     new_rule.pop('starttime')
     assert 'starttime' not in new_rule
     assert new_rule['processed_hits'] == {}
@@ -100,7 +114,7 @@ def test_query(ea):
         'query': {'filtered': {
             'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': END_TIMESTAMP, 'gt': START_TIMESTAMP}}}]}}}},
         'sort': [{'@timestamp': {'order': 'asc'}}]}, index='idx', _source_include=['@timestamp'],
-        ignore_unavailable=True,
+        ignore_unavailable=True, filter_path=ElastAlerter.hits_filter_path,
         size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'])
 
 
@@ -111,7 +125,7 @@ def test_query_sixsix(ea_sixsix):
         'query': {'bool': {
             'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': END_TIMESTAMP, 'gt': START_TIMESTAMP}}}]}}}},
         'sort': [{'@timestamp': {'order': 'asc'}}]}, index='idx', _source_include=['@timestamp'],
-        ignore_unavailable=True,
+        ignore_unavailable=True, filter_path=ElastAlerter.hits_filter_path,
         size=ea_sixsix.rules[0]['max_query_size'], scroll=ea_sixsix.conf['scroll_keepalive'])
 
 
@@ -123,6 +137,7 @@ def test_query_with_fields(ea):
         'query': {'filtered': {
             'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': END_TIMESTAMP, 'gt': START_TIMESTAMP}}}]}}}},
         'sort': [{'@timestamp': {'order': 'asc'}}], 'fields': ['@timestamp']}, index='idx', ignore_unavailable=True,
+        filter_path=ElastAlerter.hits_filter_path,
         size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'])
 
 
@@ -134,7 +149,7 @@ def test_query_sixsix_with_fields(ea_sixsix):
         'query': {'bool': {
             'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': END_TIMESTAMP, 'gt': START_TIMESTAMP}}}]}}}},
         'sort': [{'@timestamp': {'order': 'asc'}}], 'stored_fields': ['@timestamp']}, index='idx',
-        ignore_unavailable=True,
+        ignore_unavailable=True, filter_path=ElastAlerter.hits_filter_path,
         size=ea_sixsix.rules[0]['max_query_size'], scroll=ea_sixsix.conf['scroll_keepalive'])
 
 
@@ -149,7 +164,7 @@ def test_query_with_unix(ea):
         body={'query': {'filtered': {
             'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': end_unix, 'gt': start_unix}}}]}}}},
             'sort': [{'@timestamp': {'order': 'asc'}}]}, index='idx', _source_include=['@timestamp'],
-        ignore_unavailable=True,
+        ignore_unavailable=True, filter_path=ElastAlerter.hits_filter_path,
         size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'])
 
 
@@ -164,7 +179,7 @@ def test_query_sixsix_with_unix(ea_sixsix):
         body={'query': {'bool': {
             'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': end_unix, 'gt': start_unix}}}]}}}},
             'sort': [{'@timestamp': {'order': 'asc'}}]}, index='idx', _source_include=['@timestamp'],
-        ignore_unavailable=True,
+        ignore_unavailable=True, filter_path=ElastAlerter.hits_filter_path,
         size=ea_sixsix.rules[0]['max_query_size'], scroll=ea_sixsix.conf['scroll_keepalive'])
 
 
@@ -179,7 +194,7 @@ def test_query_with_unixms(ea):
         body={'query': {'filtered': {
             'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': end_unix, 'gt': start_unix}}}]}}}},
             'sort': [{'@timestamp': {'order': 'asc'}}]}, index='idx', _source_include=['@timestamp'],
-        ignore_unavailable=True,
+        ignore_unavailable=True, filter_path=ElastAlerter.hits_filter_path,
         size=ea.rules[0]['max_query_size'], scroll=ea.conf['scroll_keepalive'])
 
 
@@ -194,10 +209,96 @@ def test_query_sixsix_with_unixms(ea_sixsix):
         body={'query': {'bool': {
             'filter': {'bool': {'must': [{'range': {'@timestamp': {'lte': end_unix, 'gt': start_unix}}}]}}}},
             'sort': [{'@timestamp': {'order': 'asc'}}]}, index='idx', _source_include=['@timestamp'],
-        ignore_unavailable=True,
+        ignore_unavailable=True, filter_path=ElastAlerter.hits_filter_path,
         size=ea_sixsix.rules[0]['max_query_size'], scroll=ea_sixsix.conf['scroll_keepalive'])
 
 
+def test_query_template_matches_get_query(ea):
+    rule = ea.rules[0]
+    rule['filter'] = [{'term': {'foo': 'bar'}}]
+    for five in (False, True):
+        rule['five'] = five
+        template = QueryTemplate(rule['filter'], rule['timestamp_field'], rule['dt_to_ts'], five)
+        assert template.matches(rule)
+        for sort, desc in ((True, False), (True, True), (False, False)):
+            assert template.render(START, END, sort=sort, desc=desc) == ea.get_query(
+                rule['filter'], START, END, sort=sort, timestamp_field=rule['timestamp_field'],
+                to_ts_func=rule['dt_to_ts'], desc=desc, five=five)
+        assert template.render() == ea.get_query(rule['filter'], five=five)
+        assert template.render(START, END, extra_filters=[{'term': {'baz': 'qux'}}]) == ea.get_query(
+            rule['filter'] + [{'term': {'baz': 'qux'}}], START, END, five=five)
+        # The rule's filters are never modified
+        assert rule['filter'] == [{'term': {'foo': 'bar'}}]
+        # Changing a rendered query does not change the next ones
+        template.render(START, END)['sort'][0]['@timestamp']['order'] = 'desc'
+        assert template.render(START, END)['sort'] == [{'@timestamp': {'order': 'asc'}}]
+
+
+def test_query_template_out_of_date(ea):
+    rule = ea.rules[0]
+    assert rule['query_template'].matches(rule)
+    rule['filter'] = [{'term': {'foo': 'bar'}}]
+    assert not rule['query_template'].matches(rule)
+    ea.thread_data.current_es.search.return_value = {'hits': {'total': 0, 'hits': []}}
+    ea.run_query(rule, START, END)
+    query = ea.thread_data.current_es.search.call_args[1]['body']
+    assert query['query']['filtered']['filter']['bool']['must'][1] == {'term': {'foo': 'bar'}}
+
+
+def test_aggregation_cached_by_template(ea):
+    rule = ea.rules[0]
+    rule['five'] = True
+    rule['query_template'] = QueryTemplate(rule['filter'], rule['timestamp_field'], rule['dt_to_ts'], True)
+    rule['aggregation_query_element'] = {'metric_cpu_avg': {'avg': {'field': 'cpu'}}}
+    first = ea.get_aggregation_query(ea.get_rule_query(rule, START, END, sort=False), rule, 'host', 50)
+    second = ea.get_aggregation_query(ea.get_rule_query(rule, START, END, sort=False), rule, 'host', 50)
+    assert first == second
+    assert first['aggs'] is second['aggs']
+    assert first['aggs'] == {'bucket_aggs': {'terms': {'field': 'host', 'size': 50, 'min_doc_count': 1},
+                                             'aggs': {'metric_cpu_avg': {'avg': {'field': 'cpu'}}}}}
+    assert ea.get_aggregation_query(ea.get_rule_query(rule, START, END, sort=False), rule, None, 50)['aggs'] == \
+        {'metric_cpu_avg': {'avg': {'field': 'cpu'}}}
+
+    # The bucket offset is adjusted between runs
+    rule['bucket_interval_period'] = '1m'
+    rule['bucket_offset_delta'] = 10
+    first = ea.get_aggregation_query(ea.get_rule_query(rule, START, END, sort=False), rule, None, 50)
+    rule['bucket_offset_delta'] = 20
+    second = ea.get_aggregation_query(ea.get_rule_query(rule, START, END, sort=False), rule, None, 50)
+    assert first['aggs']['interval_aggs']['date_histogram']['offset'] == '+10s'
+    assert second['aggs']['interval_aggs']['date_histogram']['offset'] == '+20s'
+    # Only the latest offset is cached
+    for offset in range(30, 100):
+        rule['bucket_offset_delta'] = offset
+        ea.get_aggregation_query(ea.get_rule_query(rule, START, END, sort=False), rule, None, 50)
+    assert len(rule['query_template'].aggregations) == 2
+
+
+def test_aggregation_bucket_selector(ea):
+    rule = ea.rules[0]
+    rule['aggregation_query_element'] = {'metric_cpu_avg': {'avg': {'field': 'cpu'}}}
+    selector = {'threshold_selector': {'bucket_selector': {'buckets_path': {'value': 'metric_cpu_avg'},
+                                                           'script': 'params.value > 1'}}}
+    rule['aggregation_bucket_selector'] = selector
+    non_empty = {'bucket_selector': {'buckets_path': {'count': 'bucket_aggs._bucket_count'}, 'script': 'params.count > 0'}}
+
+    # Without a multi-bucket aggregation to filter there is nothing to select from
+    assert ea.build_aggregation(rule, None, 50) == {'metric_cpu_avg': {'avg': {'field': 'cpu'}}}
+
+    metric_aggs = {'metric_cpu_avg': {'avg': {'field': 'cpu'}}, 'threshold_selector': selector['threshold_selector']}
+    assert ea.build_aggregation(rule, 'qk,sub_qk', 50) == {'bucket_aggs': {
+        'terms': {'field': 'qk', 'size': 50, 'min_doc_count': 1},
+        'aggs': {'bucket_aggs': {'terms': {'field': 'sub_qk', 'size': 50, 'min_doc_count': 1},
+                                 'aggs': metric_aggs},
+                 'non_empty_selector': non_empty}}}
+
+    rule['bucket_interval_period'] = '1m'
+    aggs = ea.build_aggregation(rule, 'qk', 50)
+    assert aggs['bucket_aggs']['aggs']['interval_aggs']['aggs'] == metric_aggs
+    assert aggs['bucket_aggs']['aggs']['non_empty_selector']['bucket_selector']['buckets_path'] == \
+        {'count': 'interval_aggs._bucket_count'}
+
+
 def test_no_hits(ea):
     ea.thread_data.current_es.search.return_value = {'hits': {'total': 0, 'hits': []}}
     ea.run_query(ea.rules[0], START, END)
@@ -234,6 +335,271 @@ def test_some_hits_unix(ea):
     ea.rules[0]['type'].add_data.assert_called_with([x['_source'] for x in hits_dt['hits']['hits']])
 
 
+def test_shared_query(ea):
+    ea.thread_data.current_es.conf = {'es_host': 'es', 'es_port': 14900}
+    ea.rules[0]['share_queries'] = True
+    ea.rules[0]['five'] = False
+    other_rule = copy.copy(ea.rules[0])
+    other_rule['name'] = 'othertest'
+    other_rule['processed_hits'] = {}
+    other_rule['type'] = mock.Mock()
+    hits = generate_hits([START_TIMESTAMP, END_TIMESTAMP])
+    hits_dt = generate_hits([START, END])
+    for hit in hits['hits']['hits'] + hits_dt['hits']['hits']:
+        hit['_source']['user'] = {'name': 'alice'}
+    ea.thread_data.current_es.search.return_value = hits
+
+    ea.run_query(ea.rules[0], START, END)
+    ea.rules[0]['type'].add_data.call_args[0][0][0]['user']['name'] = 'bob'
+    ea.run_query(other_rule, START, END)
+    assert ea.thread_data.current_es.search.call_count == 1
+    sources = [x['_source'] for x in hits_dt['hits']['hits']]
+    other_rule['type'].add_data.assert_called_once_with(sources)
+    # Each rule gets its own copy of the hits, nested fields included
+    assert ea.rules[0]['type'].add_data.call_args[0][0][0] is not other_rule['type'].add_data.call_args[0][0][0]
+    assert other_rule['type'].add_data.call_args[0][0][0]['user']['name'] == 'alice'
+
+    # A different query is not shared
+    other_rule['filter'] = [{'term': {'foo': 'bar'}}]
+    ea.run_query(other_rule, START, END)
+    assert ea.thread_data.current_es.search.call_count == 2
+
+
+def test_shared_query_endtime_aligned(ea):
+    ea.rules[0]['share_queries'] = True
+    ea.rules[0]['run_every'] = datetime.timedelta(minutes=1)
+    ea.rules[0]['original_starttime'] = START
+    with mock.patch('elastalert.elastalert.ts_now', return_value=ts_to_dt('2014-09-26T12:01:42Z')), \
+            mock.patch.object(ea, 'run_rule', return_value=0) as mock_run_rule:
+        ea.handle_rule_execution(ea.rules[0])
+    assert mock_run_rule.call_args[0][1] == ts_to_dt('2014-09-26T12:01:00Z')
+
+
+def test_consolidated_query(ea):
+    ea.rules[0]['consolidate_queries'] = True
+    ea.rules[0]['five'] = True
+    ea.rules[0]['buffer_time'] = END - START
+    ea.rules[0]['filter'] = [{'term': {'foo': 'a'}}]
+    other_rule = copy.copy(ea.rules[0])
+    other_rule['name'] = 'othertest'
+    other_rule['processed_hits'] = {}
+    other_rule['filter'] = [{'term': {'foo': 'b'}}]
+    other_rule['include'] = ['foo']
+    other_rule['type'] = mock.Mock()
+    ea.rules.append(other_rule)
+    early = START + datetime.timedelta(seconds=30)
+    hits = generate_hits([dt_to_ts(early), dt_to_ts(early), END_TIMESTAMP])
+    hits['hits']['hits'][0]['matched_queries'] = ['anytest']
+    hits['hits']['hits'][1]['matched_queries'] = ['othertest']
+    hits['hits']['hits'][2]['matched_queries'] = ['anytest', 'othertest']
+    hits_dt = generate_hits([early, early, END])
+    sources = [x['_source'] for x in hits_dt['hits']['hits']]
+    ea.thread_data.current_es.search.return_value = hits
+
+    ea.run_query(ea.rules[0], START, END)
+    # The second rule only queries the last part of the window, so the second hit is outside of it
+    ea.run_query(other_rule, START + datetime.timedelta(minutes=1), END)
+    assert ea.thread_data.current_es.search.call_count == 1
+    ea.rules[0]['type'].add_data.assert_called_once_with([sources[0], sources[2]])
+    other_rule['type'].add_data.assert_called_once_with([sources[2]])
+
+    query = ea.thread_data.current_es.search.call_args[1]['body']
+    should = query['query']['bool']['filter']['bool']['must'][1]['bool']['should']
+    assert should == [{'bool': {'filter': [{'term': {'foo': 'b'}}], '_name': 'othertest'}},
+                      {'bool': {'filter': [{'term': {'foo': 'a'}}], '_name': 'anytest'}}]
+    assert ea.thread_data.current_es.search.call_args[1]['_source_include'] == ['@timestamp', 'foo']
+
+
+def test_consolidated_query_window_not_covered(ea):
+    ea.rules[0]['consolidate_queries'] = True
+    ea.rules[0]['five'] = True
+    ea.rules[0]['buffer_time'] = datetime.timedelta(minutes=1)
+    ea.thread_data.current_es.search.return_value = generate_hits([END_TIMESTAMP])
+    other_rule = copy.copy(ea.rules[0])
+    other_rule['name'] = 'othertest'
+    other_rule['type'] = mock.Mock()
+    ea.run_query(ea.rules[0], END - datetime.timedelta(minutes=1), END)
+    ea.run_query(other_rule, START, END)
+    assert ea.thread_data.current_es.search.call_count == 2
+
+
+def _consolidated_rules(ea):
+    ea.rules[0]['consolidate_queries'] = True
+    ea.rules[0]['five'] = True
+    ea.rules[0]['buffer_time'] = END - START
+    other_rule = copy.copy(ea.rules[0])
+    other_rule['name'] = 'othertest'
+    other_rule['processed_hits'] = {}
+    other_rule['type'] = mock.Mock()
+    ea.rules.append(other_rule)
+    hits = generate_hits([START_TIMESTAMP, END_TIMESTAMP])
+    for hit in hits['hits']['hits']:
+        hit['matched_queries'] = ['anytest', 'othertest']
+    return other_rule, hits
+
+
+def test_consolidated_query_scroll(ea):
+    other_rule, hits = _consolidated_rules(ea)
+    hits['_scroll_id'] = 'scroll'
+    ea.thread_data.current_es.search.return_value = hits
+    ea.thread_data.current_es.clear_scroll = mock.Mock()
+
+    ea.run_query(ea.rules[0], START, END)
+    ea.run_query(other_rule, START, END)
+    assert ea.thread_data.current_es.search.call_count == 1
+    ea.thread_data.current_es.clear_scroll.assert_called_once_with(scroll_id='scroll')
+    assert ea.rules[0]['type'].add_data.call_count == 1
+    assert other_rule['type'].add_data.call_count == 1
+
+
+def test_consolidated_query_point_in_time(ea):
+    ea.thread_data.current_es.is_atleastseventwelve.return_value = True
+    ea.thread_data.current_es.open_point_in_time = mock.Mock(return_value={'id': 'pit1'})
+    ea.thread_data.current_es.close_point_in_time = mock.Mock()
+    other_rule, hits = _consolidated_rules(ea)
+    hits['pit_id'] = 'pit2'
+    ea.thread_data.current_es.search_point_in_time = mock.Mock(return_value=hits)
+
+    ea.run_query(ea.rules[0], START, END)
+    ea.run_query(other_rule, START, END)
+    assert ea.thread_data.current_es.search_point_in_time.call_count == 1
+    assert ea.thread_data.current_es.search.call_count == 0
+    ea.thread_data.current_es.open_point_in_time.assert_called_once()
+    ea.thread_data.current_es.close_point_in_time.assert_called_once_with('pit2')
+    assert other_rule['type'].add_data.call_count == 1
+
+
+def test_consolidation_key(ea):
+    ea.rules[0]['consolidate_queries'] = True
+    other_rule = copy.copy(ea.rules[0])
+    other_rule['name'] = 'othertest'
+    delayed_rule = copy.copy(ea.rules[0])
+    delayed_rule['name'] = 'delayedtest'
+    delayed_rule['query_delay'] = datetime.timedelta(minutes=5)
+    with mock.patch('elastalert.elastalert.build_es_conn_config', wraps=build_es_conn_config) as conn_config:
+        key = ea.get_consolidation_key(ea.rules[0])
+        assert ea.get_consolidation_key(other_rule) == key
+        # Rules with a different query_delay query up to a different endtime
+        assert ea.get_consolidation_key(delayed_rule) != key
+        # The key is only computed once per rule
+        assert ea.get_consolidation_key(ea.rules[0]) == key
+    assert conn_config.call_count == 3
+
+
+def test_hits_passed_in_chunks(ea):
+    hits = generate_hits([START_TIMESTAMP] * 5)
+    hits_dt = generate_hits([START] * 5)
+    ea.thread_data.current_es.search.return_value = hits
+    ea.rules[0]['hits_chunk_size'] = 2
+    ea.run_query(ea.rules[0], START, END)
+    sources = [x['_source'] for x in hits_dt['hits']['hits']]
+    assert ea.rules[0]['type'].add_data.call_args_list == [
+        mock.call(sources[0:2]), mock.call(sources[2:4]), mock.call(sources[4:])]
+
+
+def test_duplicate_hits_not_passed_in_chunks(ea):
+    hits = generate_hits([START_TIMESTAMP] * 3)
+    ea.rules[0]['processed_hits']['id1'] = START
+    ea.thread_data.current_es.search.return_value = hits
+    ea.rules[0]['hits_chunk_size'] = 1
+    ea.run_query(ea.rules[0], START, END)
+    assert [c[0][0][0]['_id'] for c in ea.rules[0]['type'].add_data.call_args_list] == ['id0', 'id2']
+    assert ea.thread_data.num_dupes == 1
+
+
+def test_scroll_is_iterative(ea):
+    # Deeper than the interpreter's recursion limit, every page must still be delivered
+    pages = 1200
+    first_page = generate_hits([START_TIMESTAMP])
+    first_page['hits']['total'] = pages
+    first_page['_scroll_id'] = 'scroll'
+    ea.thread_data.current_es.search.return_value = first_page
+    ea.thread_data.current_es.scroll = mock.Mock(side_effect=[
+        {'hits': {'hits': [{'_id': 'page{}'.format(i), '_source': {'@timestamp': START_TIMESTAMP}}]}}
+        for i in range(1, pages)])
+    ea.thread_data.current_es.clear_scroll = mock.Mock()
+    ea.rules[0]['max_scrolling_count'] = 0
+
+    assert ea.run_query(ea.rules[0], START, END)
+    assert ea.rules[0]['type'].add_data.call_count == pages
+    assert ea.thread_data.current_es.scroll.call_count == pages - 1
+    ea.thread_data.current_es.clear_scroll.assert_called_once_with(scroll_id='scroll')
+    assert 'scroll_id' not in ea.rules[0]
+
+
+def test_scroll_stops_at_max_scrolling_count(ea):
+    first_page = generate_hits([START_TIMESTAMP])
+    first_page['hits']['total'] = 10
+    first_page['_scroll_id'] = 'scroll'
+    ea.thread_data.current_es.search.return_value = first_page
+    ea.thread_data.current_es.scroll = mock.Mock(side_effect=[
+        {'hits': {'hits': [{'_id': 'page{}'.format(i), '_source': {'@timestamp': START_TIMESTAMP}}]}}
+        for i in range(1, 10)])
+    ea.thread_data.current_es.clear_scroll = mock.Mock()
+    ea.rules[0]['max_scrolling_count'] = 3
+
+    assert ea.run_query(ea.rules[0], START, END)
+    assert ea.rules[0]['type'].add_data.call_count == 3
+    ea.thread_data.current_es.clear_scroll.assert_called_once_with(scroll_id='scroll')
+
+
+def test_point_in_time_pagination(ea):
+    ea.thread_data.current_es.is_atleastseven.return_value = True
+    ea.thread_data.current_es.is_atleastsixsix.return_value = True
+    ea.thread_data.current_es.is_atleastseventwelve.return_value = True
+    ea.thread_data.current_es.open_point_in_time = mock.Mock(return_value={'id': 'pit1'})
+    ea.thread_data.current_es.close_point_in_time = mock.Mock()
+    ea.rules[0]['max_query_size'] = 2
+    ea.rules[0]['max_scrolling_count'] = 0
+
+    def page(ids, pit_id):
+        hits = [{'_id': _id, '_type': '_doc', '_source': {'@timestamp': START_TIMESTAMP}, 'sort': [1411734885000, n]}
+                for n, _id in enumerate(ids)]
+        return {'pit_id': pit_id, 'hits': {'total': {'value': 5, 'relation': 'eq'}, 'hits': hits}}
+
+    bodies = []
+
+    def search_point_in_time(body, **kwargs):
+        bodies.append(copy.deepcopy(body))
+        return [page(['a', 'b'], 'pit2'), page(['c', 'd'], 'pit3'), page(['e'], 'pit3')][len(bodies) - 1]
+
+    ea.thread_data.current_es.search_point_in_time = mock.Mock(side_effect=search_point_in_time)
+    assert ea.run_query(ea.rules[0], START, END)
+
+    ea.thread_data.current_es.open_point_in_time.assert_called_once_with(
+        index='idx', keep_alive='30s', ignore_unavailable=True)
+    assert ea.thread_data.current_es.search.call_count == 0
+    assert [b['pit']['id'] for b in bodies] == ['pit1', 'pit2', 'pit3']
+    assert 'search_after' not in bodies[0]
+    assert bodies[0]['track_total_hits'] is True
+    assert bodies[1]['search_after'] == [1411734885000, 1]
+    assert bodies[2]['search_after'] == [1411734885000, 1]
+    assert ea.rules[0]['type'].add_data.call_count == 3
+    ea.thread_data.current_es.close_point_in_time.assert_called_once_with('pit3')
+    assert 'pit_id' not in ea.rules[0]
+    assert 'search_after' not in ea.rules[0]
+
+
+def test_point_in_time_disabled(ea):
+    ea.thread_data.current_es.is_atleastseventwelve.return_value = True
+    ea.thread_data.current_es.search_point_in_time = mock.Mock()
+    ea.rules[0]['use_point_in_time'] = False
+    ea.thread_data.current_es.search.return_value = {'hits': {'total': 0, 'hits': []}}
+    ea.run_query(ea.rules[0], START, END)
+    assert ea.thread_data.current_es.search.call_count == 1
+    assert ea.thread_data.current_es.search_point_in_time.call_count == 0
+
+
+def test_point_in_time_closed_on_error(ea):
+    ea.thread_data.current_es.is_atleastseventwelve.return_value = True
+    ea.thread_data.current_es.open_point_in_time = mock.Mock(return_value={'id': 'pit1'})
+    ea.thread_data.current_es.close_point_in_time = mock.Mock()
+    ea.thread_data.current_es.search_point_in_time = mock.Mock(side_effect=ElasticsearchException)
+    assert not ea.run_query(ea.rules[0], START, END)
+    ea.thread_data.current_es.close_point_in_time.assert_called_once_with('pit1')
+    assert 'pit_id' not in ea.rules[0]
+
+
 def _duplicate_hits_generator(timestamps, **kwargs):
     """Generator repeatedly returns identical hits dictionaries
     """
@@ -282,6 +648,106 @@ def test_run_rule_calls_garbage_collect(ea):
         mock_gc.assert_any_call(e)
 
 
+def test_run_rule_prefetches_segments(ea):
+    start_time = ts_to_dt('2014-09-26T00:00:00Z')
+    end_time = ts_to_dt('2014-09-26T06:00:00Z')
+    ea.rules[0]['buffer_time'] = datetime.timedelta(hours=1)
+    ea.rules[0]['segment_prefetch'] = 3
+    segment_threads = set()
+    done = dict((hour, threading.Event()) for hour in range(6))
+    # The five catch-up segments are prefetched three at a time, the last one is queried on its own. Earlier
+    # segments only finish after a later one in flight at the same time, but must still be handed over first.
+    finishes_after = {0: 2, 1: 2, 3: 4}
+
+    def search(body=None, **kwargs):
+        gt = body['query']['filtered']['filter']['bool']['must'][0]['range']['@timestamp']['gt']
+        hour = ts_to_dt(gt).hour
+        segment_threads.add(threading.current_thread())
+        if hour in finishes_after:
+            assert done[finishes_after[hour]].wait(10)
+        done[hour].set()
+        return {'hits': {'total': 1, 'hits': [{'_id': gt, '_type': 'logs', '_source': {'@timestamp': gt}}]}}
+
+    ea.current_es.search.side_effect = search
+    with mock.patch.object(ea, 'get_elasticsearch_client', return_value=ea.current_es):
+        with mock.patch.object(ea.rules[0]['type'], 'garbage_collect') as mock_gc:
+            ea.run_rule(ea.rules[0], end_time, start_time)
+
+    hours = [start_time + datetime.timedelta(hours=i) for i in range(7)]
+    assert [c[0][0][0]['@timestamp'] for c in ea.rules[0]['type'].add_data.call_args_list] == hours[:6]
+    assert mock_gc.call_args_list == [mock.call(hour) for hour in hours[1:]]
+    assert len(segment_threads) > 1
+    assert ea.rules[0]['starttime'] == hours[5]
+
+
+def test_run_rule_prefetch_waits_for_segments_on_failure(ea):
+    start_time = ts_to_dt('2014-09-26T00:00:00Z')
+    end_time = ts_to_dt('2014-09-26T06:00:00Z')
+    ea.rules[0]['buffer_time'] = datetime.timedelta(hours=1)
+    ea.rules[0]['segment_prefetch'] = 3
+    in_flight = threading.Semaphore(0)
+    release = threading.Event()
+    finished = []
+
+    def search(body=None, **kwargs):
+        gt = body['query']['filtered']['filter']['bool']['must'][0]['range']['@timestamp']['gt']
+        if ts_to_dt(gt).hour == 0:
+            # Fail once the other two segments are running
+            assert in_flight.acquire(timeout=10) and in_flight.acquire(timeout=10)
+            raise ElasticsearchException('segment failed')
+        in_flight.release()
+        assert release.wait(10)
+        finished.append(gt)
+        return {'hits': {'total': 0, 'hits': []}}
+
+    ea.current_es.search.side_effect = search
+    result = []
+    with mock.patch.object(ea, 'get_elasticsearch_client', return_value=ea.current_es):
+        runner = threading.Thread(target=lambda: result.append(ea.run_rule(ea.rules[0], end_time, start_time)))
+        runner.start()
+        # run_rule waits for the segments in flight instead of returning while they still run
+        runner.join(0.2)
+        assert runner.is_alive()
+        release.set()
+        runner.join(10)
+
+    assert result == [0]
+    assert len(finished) == 2
+    # The segments which had not started were never queried
+    assert ea.current_es.search.call_count == 3
+    assert ea.rules[0]['type'].add_data.call_count == 0
+
+
+def test_run_rule_adaptive_segments(ea):
+    start_time = ts_to_dt('2014-09-26T00:00:00Z')
+    ea.rules[0]['buffer_time'] = datetime.timedelta(hours=1)
+    ea.rules[0]['adaptive_segment_size'] = True
+
+    def run_query(rule, start, end):
+        # No hits, so every segment should be twice the size of the previous one
+        ea.thread_data.total_hits = 0
+        return True
+
+    with mock.patch.object(ea, 'run_query', side_effect=run_query) as mock_run_query:
+        ea.run_rule(ea.rules[0], start_time + datetime.timedelta(hours=10), start_time)
+    hours = [c[0][1:] for c in mock_run_query.call_args_list]
+    assert hours == [(start_time + datetime.timedelta(hours=start), start_time + datetime.timedelta(hours=end))
+                     for start, end in [(0, 1), (1, 3), (3, 7), (7, 10)]]
+
+
+def test_get_adaptive_segment_size(ea):
+    hour = datetime.timedelta(hours=1)
+    rule = ea.rules[0]
+    assert ea.get_adaptive_segment_size(rule, hour, None) == hour
+    assert ea.get_adaptive_segment_size(rule, hour, 40000) == hour / 4
+    assert ea.get_adaptive_segment_size(rule, hour, 5000) == hour * 2
+    rule['segment_target_hits'] = 100
+    rule['segment_size_min'] = datetime.timedelta(minutes=30)
+    assert ea.get_adaptive_segment_size(rule, hour, 40000) == datetime.timedelta(minutes=30)
+    rule['segment_size_max'] = datetime.timedelta(minutes=90)
+    assert ea.get_adaptive_segment_size(rule, hour, 0) == datetime.timedelta(minutes=90)
+
+
 def run_rule_query_exception(ea, mock_es):
     with mock.patch('elastalert.elastalert.elasticsearch_client') as mock_es_init:
         mock_es_init.return_value = mock_es
@@ -297,6 +763,7 @@ def run_rule_query_exception(ea, mock_es):
 
 def test_query_exception(ea):
     mock_es = mock.Mock()
+    mock_es.is_atleastseventwelve.return_value = False
     mock_es.search.side_effect = ElasticsearchException
     run_rule_query_exception(ea, mock_es)
 
@@ -419,9 +886,9 @@ def test_agg_matchtime(ea):
 
     with mock.patch('elastalert.elastalert.elasticsearch_client') as mock_es:
         ea.send_pending_alerts()
-        # Assert that current_es was refreshed from the aggregate rules
-        assert mock_es.called_with(host='', port='')
-        assert mock_es.call_count == 2
+        # Assert that current_es was set to the rule's shared client, not a new one
+        assert mock_es.call_count == 0
+        assert ea.thread_data.current_es is ea.get_elasticsearch_client(ea.rules[0])
     assert_alerts(ea, [hits_timestamps[:2], hits_timestamps[2:]])
 
     call1 = ea.writeback_es.deprecated_search.call_args_list[7][1]['body']
@@ -588,9 +1055,9 @@ def test_agg_with_aggregation_key(ea):
     with mock.patch('elastalert.elastalert.elasticsearch_client') as mock_es:
         mock_es.return_value = ea.thread_data.current_es
         ea.send_pending_alerts()
-        # Assert that current_es was refreshed from the aggregate rules
-        assert mock_es.called_with(host='', port='')
-        assert mock_es.call_count == 2
+        # Assert that current_es was set to the rule's shared client, not a new one
+        assert mock_es.call_count == 0
+        assert ea.thread_data.current_es is ea.get_elasticsearch_client(ea.rules[0])
     assert_alerts(ea, [[hits_timestamps[0], hits_timestamps[2]], [hits_timestamps[1]]])
 
     call1 = ea.writeback_es.deprecated_search.call_args_list[7][1]['body']
@@ -778,6 +1245,175 @@ def test_count(ea):
         start = start + ea.run_every
 
 
+def test_count_msearch(ea):
+    ea.rules[0]['use_count_query'] = True
+    ea.rules[0]['use_msearch'] = True
+    ea.rules[0]['five'] = True
+    ea.thread_data.current_es.is_atleastsix.return_value = True
+    ea.thread_data.current_es.is_atleastseven.return_value = True
+    ea.thread_data.current_es.count = mock.Mock()
+    ea.msearch_batcher.search = mock.Mock(return_value={'hits': {'total': {'value': 7}, 'hits': []}})
+    assert ea.get_hits_count(ea.rules[0], START, END, 'idx') == {END: 7}
+    body = ea.msearch_batcher.search.call_args[0][2]
+    assert body['size'] == 0
+    assert body['track_total_hits'] is True
+    assert ea.thread_data.current_es.count.call_count == 0
+
+
+def test_count_histogram_backfill(ea):
+    rule = ea.rules[0]
+    rule['use_count_query'] = True
+    rule['count_histogram_backfill'] = True
+    rule['doc_type'] = 'doctype'
+    rule['five'] = True
+    rule['type'] = mock.Mock(matches=[])
+    es = ea.thread_data.current_es
+    start_ms = dt_to_unixms(START)
+    interval_ms = int(ea.run_every.total_seconds() * 1000)
+    # Buckets start a millisecond after each segment start, the last one holds a document at the very end
+    es.deprecated_search.return_value = {'aggregations': {'counts': {'buckets': [
+        {'key': start_ms + 1, 'doc_count': 3}, {'key': start_ms + interval_ms + 1, 'doc_count': 5},
+        {'key': start_ms + 142 * interval_ms + 1, 'doc_count': 1}]}}}
+    es.count = mock.Mock(return_value={'count': 1})
+    with mock.patch.object(ea, 'get_elasticsearch_client', return_value=es):
+        ea.run_rule(rule, END, START)
+
+    # Every run_every segment but the last is counted with a single query
+    assert es.deprecated_search.call_count == 1
+    query = es.deprecated_search.call_args[1]['body']
+    assert query['aggs']['counts']['date_histogram'] == {
+        'field': '@timestamp', 'interval': '%dms' % interval_ms, 'offset': '%dms' % ((start_ms + 1) % interval_ms),
+        'min_doc_count': 0, 'extended_bounds': {'min': start_ms + 1, 'max': start_ms + 143 * interval_ms}}
+    assert query['query']['bool']['filter']['bool']['must'][0]['range']['@timestamp'] == {
+        'gt': dt_to_ts(START), 'lte': dt_to_ts(START + 143 * ea.run_every)}
+    assert es.count.call_count == 1
+
+    calls = [c[0][0] for c in rule['type'].add_count_data.call_args_list]
+    assert len(calls) == 144
+    assert calls[:3] == [{START + ea.run_every: 3}, {START + 2 * ea.run_every: 5}, {START + 3 * ea.run_every: 0}]
+    # A document timestamped exactly at the end of the backfill is counted in the last histogram segment
+    assert calls[-2] == {START + 143 * ea.run_every: 1}
+    assert calls[-1] == {END: 1}
+
+
+def test_terms_composite_paging(ea):
+    rule = ea.rules[0]
+    rule['use_terms_query'] = True
+    rule['query_key'] = 'host'
+    rule['composite_page_size'] = 2
+    rule['five'] = True
+    rule['type'] = mock.Mock()
+    ea.thread_data.current_es.deprecated_search.side_effect = [
+        {'aggregations': {'composite_aggs': {'buckets': [{'key': {'key_0': 'a'}, 'doc_count': 3},
+                                                         {'key': {'key_0': 'b'}, 'doc_count': 1}],
+                                             'after_key': {'key_0': 'b'}}}},
+        {'aggregations': {'composite_aggs': {'buckets': [{'key': {'key_0': 'c'}, 'doc_count': 2}],
+                                             'after_key': {'key_0': 'c'}}}},
+    ]
+    assert ea.run_query(rule, START, END)
+
+    calls = ea.thread_data.current_es.deprecated_search.call_args_list
+    assert len(calls) == 2
+    composite = calls[0][1]['body']['aggs']['composite_aggs']['composite']
+    assert composite['sources'] == [{'key_0': {'terms': {'field': 'host'}}}]
+    assert 'after' not in composite
+    assert calls[1][1]['body']['aggs']['composite_aggs']['composite']['after'] == {'key_0': 'b'}
+    assert rule['type'].add_terms_data.call_args_list == [
+        mock.call({END: [{'key': 'a', 'doc_count': 3}, {'key': 'b', 'doc_count': 1}]}),
+        mock.call({END: [{'key': 'c', 'doc_count': 2}]}),
+    ]
+    assert 'composite_after' not in rule
+
+
+def test_aggregation_composite_nesting(ea):
+    rule = ea.rules[0]
+    rule['aggregation_query_element'] = {'metric_cpu_avg': {'avg': {'field': 'cpu'}}}
+    rule['query_key'] = 'host,port'
+    rule['composite_page_size'] = 10
+    rule['five'] = True
+    ea.thread_data.current_es.deprecated_search.return_value = {'aggregations': {'composite_aggs': {'buckets': [
+        {'key': {'key_0': 'a', 'key_1': 80}, 'doc_count': 3, 'metric_cpu_avg': {'value': 1}},
+        {'key': {'key_0': 'a', 'key_1': 443}, 'doc_count': 1, 'metric_cpu_avg': {'value': 2}},
+        {'key': {'key_0': 'b', 'key_1': 80}, 'doc_count': 2, 'metric_cpu_avg': {'value': 3}},
+    ]}}}
+    data = ea.get_hits_composite(rule, START, END, 'idx')
+
+    body = ea.thread_data.current_es.deprecated_search.call_args[1]['body']
+    assert body['aggs']['composite_aggs']['aggs'] == {'metric_cpu_avg': {'avg': {'field': 'cpu'}}}
+    assert data == {END: {'bucket_aggs': {'buckets': [
+        {'key': 'a', 'doc_count': 4, 'bucket_aggs': {'buckets': [
+            {'key': 80, 'doc_count': 3, 'metric_cpu_avg': {'value': 1}},
+            {'key': 443, 'doc_count': 1, 'metric_cpu_avg': {'value': 2}}]}},
+        {'key': 'b', 'doc_count': 2, 'bucket_aggs': {'buckets': [
+            {'key': 80, 'doc_count': 2, 'metric_cpu_avg': {'value': 3}}]}},
+    ]}}}
+    # A page smaller than composite_page_size is the last one
+    assert 'composite_after' not in rule
+
+
+def test_frequency_histogram(ea_sixsix):
+    rule = ea_sixsix.rules[0]
+    rule['query_key'] = 'host'
+    rule['frequency_bucket_interval'] = datetime.timedelta(minutes=1)
+    rule['type'] = FrequencyRule({'num_events': 5, 'timeframe': datetime.timedelta(minutes=10),
+                                  'timestamp_field': '@timestamp', 'query_key': 'host'})
+    for attach_related in (True, False):
+        new_rule = copy.copy(rule)
+        new_rule['attach_related'] = attach_related
+        ea_sixsix.init_rule(new_rule, True)
+        assert new_rule.get('use_terms_query', False) is not attach_related
+
+    start_ms = dt_to_unixms(START)
+    ea_sixsix.thread_data.current_es = ea_sixsix.current_es
+    ea_sixsix.thread_data.current_es.deprecated_search.return_value = {'aggregations': {'composite_aggs': {'buckets': [
+        {'key': {'interval_key': start_ms, 'key_0': 'a'}, 'doc_count': 3},
+        {'key': {'interval_key': start_ms, 'key_0': 'b'}, 'doc_count': 1},
+        {'key': {'interval_key': start_ms + 60000, 'key_0': 'a'}, 'doc_count': 2},
+    ]}}}
+    data = ea_sixsix.get_hits_composite(new_rule, START, END, 'idx')
+
+    composite = ea_sixsix.thread_data.current_es.deprecated_search.call_args[1]['body']['aggs']['composite_aggs']['composite']
+    assert composite['size'] == 1000
+    assert composite['sources'] == [{'interval_key': {'date_histogram': {'field': '@timestamp', 'interval': '60000ms'}}},
+                                    {'key_0': {'terms': {'field': 'host'}}}]
+    assert list(data.items()) == [
+        (START + datetime.timedelta(minutes=1), [{'key': 'a', 'doc_count': 3}, {'key': 'b', 'doc_count': 1}]),
+        (START + datetime.timedelta(minutes=2), [{'key': 'a', 'doc_count': 2}]),
+    ]
+
+    # Counts are added to the per key windows in time order
+    new_rule['type'].add_terms_data(data)
+    assert new_rule['type'].occurrences['b'].count() == 1
+    assert len(new_rule['type'].matches) == 1
+    assert new_rule['type'].matches[0]['host'] == 'a'
+
+
+def test_hits_msearch(ea):
+    ea.rules[0]['use_msearch'] = True
+    ea.thread_data.current_es.is_atleastsix.return_value = True
+    hits = generate_hits([START_TIMESTAMP, END_TIMESTAMP])
+    hits_dt = generate_hits([START, END])
+    ea.msearch_batcher.search = mock.Mock(return_value=hits)
+    ea.run_query(ea.rules[0], START, END)
+    assert ea.thread_data.current_es.search.call_count == 0
+    ea.rules[0]['type'].add_data.assert_called_with([x['_source'] for x in hits_dt['hits']['hits']])
+    body = ea.msearch_batcher.search.call_args[0][2]
+    assert body['size'] == 10000
+    assert body['_source'] == ['@timestamp']
+
+
+def test_hits_msearch_incomplete_page_runs_alone(ea):
+    ea.rules[0]['use_msearch'] = True
+    ea.thread_data.current_es.is_atleastsix.return_value = True
+    page = generate_hits([START_TIMESTAMP])
+    page['hits']['total'] = 2
+    ea.msearch_batcher.search = mock.Mock(return_value=page)
+    ea.thread_data.current_es.search.return_value = generate_hits([START_TIMESTAMP, END_TIMESTAMP])
+    ea.run_query(ea.rules[0], START, END)
+    assert ea.thread_data.current_es.search.call_count == 1
+    assert len(ea.rules[0]['type'].add_data.call_args[0][0]) == 2
+
+
 def run_and_assert_segmented_queries(ea, start, end, segment_size):
     with mock.patch.object(ea, 'run_query') as mock_run_query:
         ea.run_rule(ea.rules[0], end, start)
@@ -995,6 +1631,7 @@ def test_kibana_dashboard(ea):
 
 
 def test_rule_changes(ea):
+    ea.get_elasticsearch_client = mock.Mock(return_value=ea.current_es)
     ea.rule_hashes = {'rules/rule1.yaml': 'ABC',
                       'rules/rule2.yaml': 'DEF'}
     run_every = datetime.timedelta(seconds=1)
@@ -1112,6 +1749,64 @@ def test_count_keys(ea):
     assert counts['top_events_that'] == {'d': 10, 'c': 12}
 
 
+def test_count_keys_single_query(ea):
+    ea.rules[0]['five'] = True
+    ea.rules[0]['doc_type'] = 'blah'
+    ea.thread_data.current_es.deprecated_search.return_value = {'aggregations': {
+        'counts_0': {'buckets': [{'key': 'a', 'doc_count': 10}, {'key': 'b', 'doc_count': 5}]},
+        'counts_1': {'buckets': [{'key': 'd', 'doc_count': 10}, {'key': 'c', 'doc_count': 12}]}}}
+    counts = ea.get_top_counts(ea.rules[0], START, END, ['this', 'that'])
+    assert ea.thread_data.current_es.deprecated_search.call_count == 1
+    body = ea.thread_data.current_es.deprecated_search.call_args[1]['body']
+    assert body['aggs']['counts_0']['terms'] == {'field': 'this', 'size': 5, 'min_doc_count': 1}
+    assert body['aggs']['counts_1']['terms'] == {'field': 'that', 'size': 5, 'min_doc_count': 1}
+    assert counts == {'top_events_this': {'a': 10, 'b': 5}, 'top_events_that': {'d': 10, 'c': 12}}
+
+    # The same window is served from the cache, a different one is queried
+    counts['top_events_this']['a'] = 0
+    assert ea.get_top_counts(ea.rules[0], START, END, ['this', 'that'])['top_events_this'] == {'a': 10, 'b': 5}
+    assert ea.thread_data.current_es.deprecated_search.call_count == 1
+    ea.rules[0]['query_key'] = 'user'
+    ea.get_top_counts(ea.rules[0], START, END, ['this', 'that'], qk='foo')
+    assert ea.thread_data.current_es.deprecated_search.call_count == 2
+
+
+def test_count_keys_compound_query_key(ea):
+    ea.rules[0]['five'] = True
+    ea.rules[0]['query_key'] = 'user,host.keyword'
+    ea.rules[0]['compound_query_key'] = ['user', 'host.keyword']
+    ea.thread_data.current_es.deprecated_search.return_value = {'aggregations': {'counts_0': {'buckets': []}}}
+    ea.get_top_counts(ea.rules[0], START, END, ['this.keyword'], qk='alice,web1')
+    body = ea.thread_data.current_es.deprecated_search.call_args[1]['body']
+    filters = body['query']['bool']['filter']['bool']['must']
+    # Each key of the compound gets the .keyword postfix unless it already has it, whatever the top count key is
+    assert {'term': {'user.keyword': 'alice'}} in filters
+    assert {'term': {'host.keyword': 'web1'}} in filters
+
+
+def test_count_keys_future_window_not_cached(ea):
+    ea.rules[0]['five'] = True
+    ea.thread_data.current_es.deprecated_search.return_value = {'aggregations': {'counts_0': {'buckets': []}}}
+    with mock.patch('elastalert.elastalert.ts_now', return_value=END - datetime.timedelta(minutes=1)):
+        ea.get_top_counts(ea.rules[0], START, END, ['this'])
+        ea.get_top_counts(ea.rules[0], START, END, ['this'])
+    assert ea.thread_data.current_es.deprecated_search.call_count == 2
+    with mock.patch('elastalert.elastalert.ts_now', return_value=END):
+        ea.get_top_counts(ea.rules[0], START, END, ['this'])
+        ea.get_top_counts(ea.rules[0], START, END, ['this'])
+    assert ea.thread_data.current_es.deprecated_search.call_count == 3
+
+
+def test_count_keys_window_rounded(ea):
+    ea.rules[0]['top_count_keys'] = ['username']
+    ea.rules[0]['timeframe'] = datetime.timedelta(minutes=10)
+    matches = [{'@timestamp': ts_to_dt('2014-09-26T12:34:05Z')}, {'@timestamp': ts_to_dt('2014-09-26T12:34:55Z')}]
+    with mock.patch.object(ea, 'get_top_counts', return_value={}) as mock_top_counts:
+        ea.send_alert(matches, ea.rules[0])
+    assert mock_top_counts.call_args_list[0][0][1:3] == (ts_to_dt('2014-09-26T12:24:00Z'), ts_to_dt('2014-09-26T12:45:00Z'))
+    assert mock_top_counts.call_args_list[0][0][1:3] == mock_top_counts.call_args_list[1][0][1:3]
+
+
 def test_exponential_realert(ea):
     ea.rules[0]['exponential_realert'] = datetime.timedelta(days=1)  # 1 day ~ 10 * 2**13 seconds
     ea.rules[0]['realert'] = datetime.timedelta(seconds=10)
@@ -1437,7 +2132,7 @@ def test_get_elasticsearch_client_same_rule(ea):
     assert x is y, "Should return same client for the same rule"
 
 
-def test_get_elasticsearch_client_different_rule(ea):
+def test_get_elasticsearch_client_different_rule_same_cluster(ea):
     x_rule = ea.rules[0]
     x = ea.get_elasticsearch_client(x_rule)
 
@@ -1445,7 +2140,35 @@ def test_get_elasticsearch_client_different_rule(ea):
     y_rule['name'] = 'different_rule'
     y = ea.get_elasticsearch_client(y_rule)
 
-    assert x is not y, 'Should return unique client for each rule'
+    assert x is y, 'Should share the client between rules connecting to the same cluster'
+
+
+def test_get_elasticsearch_client_different_cluster(ea):
+    x_rule = ea.rules[0]
+    x = ea.get_elasticsearch_client(x_rule)
+
+    y_rule = copy.copy(x_rule)
+    y_rule['es_host'] = 'otherhost'
+    y = ea.get_elasticsearch_client(y_rule)
+
+    z_rule = copy.copy(x_rule)
+    z_rule['es_username'] = 'otheruser'
+    z_rule['es_password'] = 'otherpassword'
+    z = ea.get_elasticsearch_client(z_rule)
+
+    assert x is not y, 'Should return unique client for each cluster'
+    assert x is not z, 'Should return unique client for each set of credentials'
+
+
+def test_remove_unused_es_clients(ea):
+    x = ea.get_elasticsearch_client(ea.rules[0])
+    other_rule = copy.copy(ea.rules[0])
+    other_rule['es_host'] = 'otherhost'
+    ea.get_elasticsearch_client(other_rule)
+    assert len(ea.es_clients) == 2
+
+    ea.remove_unused_es_clients()
+    assert list(ea.es_clients.values()) == [x]
 
 
 def test_base_enhancement_process_error(ea):
@@ -1494,3 +2217,297 @@ def test_get_kibana_discover_external_url_formatter_smoke(ea):
     formatter = ea.get_kibana_discover_external_url_formatter(rule)
     assert type(formatter) is ShortKibanaExternalUrlFormatter
     assert formatter.security_tenant == 'global'
+
+
+def test_unknown_execution_engine(ea):
+    conf = copy.copy(ea.conf)
+    conf['execution_engine'] = 'fibers'
+    with mock.patch('elastalert.elastalert.load_conf') as load_conf:
+        load_conf.return_value = conf
+        with pytest.raises(EAException):
+            ElastAlerter(['--pin_rules'])
+
+
+def test_process_execution_engine(ea):
+    conf = copy.copy(ea.conf)
+    conf['execution_engine'] = 'process'
+    conf['worker_processes'] = 2
+    rules = [dict(copy.deepcopy(ea.rules[0]), name='rule%d' % i, rule_file='rule%d.yaml' % i) for i in range(10)]
+    for rule in rules:
+        rule.pop('type')
+
+    def load(conf, args, rule_filter=None):
+        return [copy.deepcopy(rule) for rule in rules if rule_filter is None or rule_filter(rule['rule_file'])]
+
+    conf['rules_loader'].load.reset_mock()
+    conf['rules_loader'].load.side_effect = load
+    conf['rules_loader'].get_hashes.return_value = {rule['rule_file']: 'hash' for rule in rules}
+    with mock.patch('elastalert.elastalert.load_conf') as load_conf:
+        load_conf.return_value = conf
+        supervisor = ElastAlerter(['--pin_rules'])
+        assert not conf['rules_loader'].load.called
+        workers = [ElastAlerter(['--pin_rules'], worker_index=i) for i in range(2)]
+
+    assert supervisor.is_supervisor
+    assert supervisor.rules == []
+    assert supervisor.rule_hashes == {}
+    # Each worker only loads the rule files of its shard
+    for worker, call in zip(workers, conf['rules_loader'].load.call_args_list):
+        assert call[1]['rule_filter'] == worker.owns_rule_file
+
+    # Every rule runs in exactly one worker
+    rule_files = [rule['rule_file'] for worker in workers for rule in worker.rules]
+    assert sorted(rule_files) == sorted(rule['rule_file'] for rule in rules)
+    assert all(worker.rules for worker in workers)
+    for worker in workers:
+        assert not worker.is_supervisor
+        assert set(worker.rule_hashes) == set(rule['rule_file'] for rule in worker.rules)
+
+    # Failed workers are restarted, workers which exit cleanly are not
+    failed = mock.Mock(exitcode=1, sentinel=1)
+    failed.is_alive.return_value = False
+    done = mock.Mock(exitcode=0, sentinel=2)
+    done.is_alive.return_value = False
+    supervisor.worker_restart_delay = 0
+    with mock.patch.object(supervisor, 'start_worker') as start_worker:
+        start_worker.side_effect = [failed, done, done]
+        with mock.patch('elastalert.elastalert.multiprocessing.connection.wait'):
+            supervisor.supervise_workers()
+    assert start_worker.call_args_list == [mock.call(0), mock.call(1), mock.call(0)]
+
+
+def test_process_execution_engine_restart_backoff(ea):
+    conf = copy.copy(ea.conf)
+    conf['execution_engine'] = 'process'
+    conf['worker_processes'] = 2
+    conf['max_worker_restarts'] = 2
+    with mock.patch('elastalert.elastalert.load_conf') as load_conf:
+        load_conf.return_value = conf
+        supervisor = ElastAlerter(['--pin_rules'])
+
+    failed = mock.Mock(exitcode=1, sentinel=1)
+    failed.is_alive.return_value = False
+    done = mock.Mock(exitcode=0, sentinel=2)
+    done.is_alive.return_value = False
+    clock = [0]
+    timeouts = []
+
+    def wait(sentinels, timeout=None):
+        timeouts.append(timeout)
+        clock[0] += timeout or 0
+
+    with mock.patch.object(supervisor, 'start_worker') as start_worker:
+        start_worker.side_effect = [failed, done, failed, failed]
+        with mock.patch('elastalert.elastalert.multiprocessing.connection.wait', side_effect=wait), \
+                mock.patch('elastalert.elastalert.time.monotonic', side_effect=lambda: clock[0]):
+            with pytest.raises(EAException):
+                supervisor.supervise_workers()
+    # Each restart of the failing worker waits twice as long, and it is not restarted after max_worker_restarts
+    assert timeouts == [None, 1, None, 2, None]
+    assert start_worker.call_args_list == [mock.call(0), mock.call(1), mock.call(0), mock.call(0)]
+
+
+def test_stop_workers(ea):
+    stopping = mock.Mock(pid=101)
+    stopping.is_alive.side_effect = [True, False]
+    stuck = mock.Mock(pid=102)
+    stuck.is_alive.return_value = True
+    ea.workers = {0: stopping, 1: stuck}
+    with mock.patch('elastalert.elastalert.os.kill') as mock_kill:
+        ea.stop_workers(timeout=0)
+    assert mock_kill.call_args_list == [mock.call(101, signal.SIGINT), mock.call(102, signal.SIGINT)]
+    assert not stopping.terminate.called
+    stuck.terminate.assert_called_once_with()
+    assert ea.workers == {}
+
+    # The supervisor stops its workers when it is interrupted
+    with mock.patch.object(ea, 'stop_workers') as mock_stop_workers, mock.patch('elastalert.elastalert.os._exit'):
+        handle_signal(signal.SIGINT, None, client=ea)
+    mock_stop_workers.assert_called_once_with()
+
+
+def test_process_execution_engine_prometheus(ea):
+    conf = copy.copy(ea.conf)
+    conf['execution_engine'] = 'process'
+    conf['worker_processes'] = 2
+    conf['rules_loader'].load.return_value = []
+    conf['rules_loader'].get_hashes.return_value = {}
+    with mock.patch('elastalert.elastalert.load_conf') as load_conf, \
+            mock.patch('elastalert.elastalert.PrometheusWrapper') as mock_wrapper, \
+            mock.patch('elastalert.elastalert.signal.signal'), \
+            mock.patch.object(ElastAlerter, 'start'):
+        load_conf.return_value = conf
+        main(['--pin_rules', '--prometheus_port', '9000'])
+        # The supervisor runs no rules, so only the workers serve metrics, each on a port of its own
+        assert not mock_wrapper.called
+        run_worker(['--pin_rules', '--prometheus_port', '9000'], 1)
+        assert mock_wrapper.call_args[0][0].prometheus_port == 9001
+
+
+def test_run_queued_rules(ea, caplog):
+    rule = ea.rules[0]
+    stale = dict(rule, name='stale')
+    ea.enqueue_rule(stale)
+    ea.enqueue_rule(rule)
+    ea.enqueue_rule(rule)
+    assert 'Skipping scheduled run of anytest' in caplog.text
+    assert len(ea.rule_queue) == 2
+
+    def stop(rule):
+        ea.running = False
+
+    ea.running = True
+    with mock.patch.object(ea, 'handle_rule_execution', side_effect=stop) as handle_rule_execution:
+        ea.run_queued_rules()
+    # Rules which are no longer loaded are dropped
+    handle_rule_execution.assert_called_once_with(rule)
+    assert rule['schedule_lag'] >= 0
+    assert len(ea.rule_queue) == 0
+    assert ea.rule_queue.put(rule)
+
+
+def test_enqueue_rule_overdue(ea):
+    rule = ea.rules[0]
+    ea.enqueue_rule(rule)
+    assert ea.rule_queue.get(timeout=0)[1] < 1
+    ea.rule_queue.done(rule)
+
+    # The previous run ended 20 seconds after this run was due
+    rule['previous_endtime'] = ts_now() - rule['run_every'] - datetime.timedelta(seconds=20)
+    assert 20 <= ea.get_overdue_seconds(rule) < 21
+    ea.enqueue_rule(rule)
+    assert 20 <= ea.rule_queue.get(timeout=0)[1] < 21
+    ea.rule_queue.done(rule)
+
+    # The previous run queried up to query_delay before it ran
+    rule['query_delay'] = datetime.timedelta(seconds=30)
+    assert ea.get_overdue_seconds(rule) == 0
+
+
+def test_schedule_offset(ea):
+    rule = ea.rules[0]
+    offset = ea.get_schedule_offset(rule)
+    assert offset == ea.get_schedule_offset(dict(rule))
+    assert 0 <= offset < 15
+    assert offset != ea.get_schedule_offset(dict(rule, name='other'))
+    ea.schedule_spread = datetime.timedelta(seconds=5)
+    assert 0 <= ea.get_schedule_offset(rule) < 5
+
+
+def test_cluster_mode(ea):
+    conf = copy.copy(ea.conf)
+    conf['cluster_mode'] = True
+    conf['cluster_instance_id'] = 'a'
+    with mock.patch('elastalert.elastalert.load_conf') as load_conf:
+        load_conf.return_value = conf
+        ea_cluster = ElastAlerter(['--pin_rules'])
+    rule = ea_cluster.rules[0]
+    rule['starttime'] = ts_now() - datetime.timedelta(hours=1)
+    rule['previous_endtime'] = rule['starttime']
+    lease = {'cluster_instance': 'b', 'cluster_shard': None}
+    ea_cluster.writeback_es.deprecated_search.return_value = {'hits': {'hits': [{'_source': lease}]}}
+
+    ea_cluster.send_cluster_heartbeat()
+    _, kwargs = ea_cluster.writeback_es.index.call_args
+    assert kwargs['id'] == 'cluster_instance_a'
+    assert kwargs['body']['cluster_instance'] == 'a'
+    assert ea_cluster.cluster.instances == ['a', 'b']
+
+    names = ['rule%d' % i for i in range(20)]
+    rule['name'] = [name for name in names if ea_cluster.cluster.owns(name)][0]
+    # A newly owned rule waits for the previous owner to notice
+    assert not ea_cluster.owns_rule(rule)
+    assert not ea_cluster.take_over_rule(rule)
+    ea_cluster.cluster.changed_at -= ea_cluster.cluster_heartbeat_interval * 2
+    assert ea_cluster.owns_rule(rule)
+    # Checking ownership leaves the rule as it is, it is only reset when it is taken over to run
+    assert 'starttime' in rule
+    assert ea_cluster.take_over_rule(rule)
+    # It then continues from the last run in elastalert_status
+    assert 'starttime' not in rule
+    assert 'previous_endtime' not in rule
+
+    # Rules owned by another instance are skipped
+    rule['name'] = [name for name in names if not ea_cluster.cluster.owns(name)][0]
+    with mock.patch.object(ea_cluster, 'run_rule') as run_rule:
+        ea_cluster.handle_rule_execution(rule)
+    assert not run_rule.called
+    assert not rule['cluster_owned']
+
+    # The lease is deleted on shutdown
+    ea_cluster.stop()
+    ea_cluster.writeback_es.delete.assert_called_once_with(index='wb', doc_type='elastalert_status', id='cluster_instance_a')
+    assert not ea_cluster.cluster.owns(rule['name'])
+
+
+def test_cluster_heartbeat_with_busy_scheduler(ea):
+    conf = copy.copy(ea.conf)
+    conf['cluster_mode'] = True
+    conf['cluster_instance_id'] = 'a'
+    conf['run_every'] = datetime.timedelta(milliseconds=50)
+    conf['cluster_heartbeat_interval'] = datetime.timedelta(milliseconds=50)
+    with mock.patch('elastalert.elastalert.load_conf') as load_conf:
+        load_conf.return_value = conf
+        ea_cluster = ElastAlerter(['--pin_rules'])
+
+    release = threading.Event()
+    blocked = threading.Semaphore(0)
+    heartbeats = queue.Queue()
+    heartbeat_delayed = []
+
+    def block():
+        blocked.release()
+        release.wait(5)
+
+    def sleep_for(duration):
+        # Hold both scheduler threads with slow config change and pending alert checks
+        assert blocked.acquire(timeout=5)
+        assert blocked.acquire(timeout=5)
+        while not heartbeats.empty():
+            heartbeats.get()
+        try:
+            heartbeats.get(timeout=5)
+            heartbeats.get(timeout=5)
+        except queue.Empty:
+            heartbeat_delayed.append(True)
+        release.set()
+        ea_cluster.running = False
+
+    with mock.patch.object(ea_cluster, 'wait_until_responsive'), \
+            mock.patch.object(ea_cluster, 'handle_config_change', side_effect=block), \
+            mock.patch.object(ea_cluster, 'handle_pending_alerts', side_effect=block), \
+            mock.patch.object(ea_cluster, 'send_cluster_heartbeat', side_effect=lambda: heartbeats.put(True)), \
+            mock.patch.object(ea_cluster, 'sleep_for', side_effect=sleep_for):
+        try:
+            ea_cluster.start()
+        finally:
+            release.set()
+            ea_cluster.scheduler.shutdown()
+    assert not heartbeat_delayed
+
+
+def test_rule_jobs_executor(ea, caplog):
+    with mock.patch('elastalert.elastalert.load_conf') as load_conf:
+        load_conf.return_value = copy.copy(ea.conf)
+        ea_jobs = ElastAlerter(['--pin_rules'])
+    # Queueing rules does not wait behind the pending alert and config change checks
+    job = ea_jobs.scheduler.get_job(ea_jobs.rules[0]['name'])
+    assert job.executor == 'rules'
+
+    ea_jobs.log_missed_job(mock.Mock(job_id='testrule', scheduled_run_time=START))
+    assert caplog.record_tuples[-1][1] == logging.WARNING
+    assert 'Missed scheduled run of testrule' in caplog.record_tuples[-1][2]
+
+
+def test_filtered_responses_without_hits(ea_sixsix):
+    # Responses filtered with filter_path leave out the hits when there are none
+    ea_sixsix.thread_data.current_es = ea_sixsix.current_es
+    ea_sixsix.thread_data.current_es.search.return_value = {'hits': {'total': 0}}
+    assert ea_sixsix.run_query(ea_sixsix.rules[0], START, END)
+
+    ea_sixsix.writeback_es.is_atleastsixtwo.return_value = True
+    ea_sixsix.writeback_es.search.return_value = {}
+    assert not ea_sixsix.is_silenced(ea_sixsix.rules[0]['name'])
+    assert ea_sixsix.get_starttime(ea_sixsix.rules[0]) is None
+    assert ea_sixsix.writeback_es.search.call_args[1]['filter_path'] == ea_sixsix.source_filter_path
+    assert ea_sixsix.writeback_es.index.call_count == 0
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+from elastalert.cluster import ClusterMembership
+from elastalert.util import ts_now
+
+
+def test_rules_owned_by_one_instance():
+    names = ['rule%d' % i for i in range(100)]
+    members = [ClusterMembership(instance) for instance in ('a', 'b', 'c')]
+    for member in members:
+        member.renewed(ts_now() + datetime.timedelta(minutes=1))
+        member.update(['a', 'b', 'c'])
+    for name in names:
+        assert sum(member.owns(name) for member in members) == 1
+    assert all(any(member.owns(name) for name in names) for member in members)
+
+
+def test_rebalance_moves_only_lost_rules():
+    names = ['rule%d' % i for i in range(100)]
+    member = ClusterMembership('a')
+    assert member.update(['a', 'b', 'c'])
+    assert not member.update(['c', 'b'])
+    owners = {name: member.owner(name) for name in names}
+
+    # c dies, only its rules move
+    assert member.update(['a', 'b'])
+    for name in names:
+        if owners[name] != 'c':
+            assert member.owner(name) == owners[name]
+        else:
+            assert member.owner(name) in ('a', 'b')
+
+
+def test_no_rules_owned_without_lease():
+    member = ClusterMembership('a')
+    assert not member.owns('rule')
+    member.renewed(ts_now() + datetime.timedelta(minutes=1))
+    assert member.owns('rule')
+    member.renewed(ts_now() - datetime.timedelta(seconds=1))
+    assert not member.owns('rule')
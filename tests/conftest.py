@@ -8,6 +8,8 @@ import pytest
 
 import elastalert.elastalert
 import elastalert.util
+from elastalert import es_version_cache
+from elastalert.auth import clear_aws_cache
 from elastalert.util import dt_to_ts
 from elastalert.util import ts_to_dt
 
@@ -52,6 +54,18 @@ def reset_loggers():
         logger.removeHandler(handler)
 
 
+@pytest.fixture(scope='function', autouse=True)
+def reset_es_version_cache():
+    """Prevent cluster versions cached by one test from leaking into the next."""
+    es_version_cache.refresh()
+
+
+@pytest.fixture(scope='function', autouse=True)
+def reset_aws_cache():
+    """Prevent AWS sessions and credentials created by one test from leaking into the next."""
+    clear_aws_cache()
+
+
 class mock_es_indices_client(object):
     def __init__(self):
         self.exists = mock.Mock(return_value=True)
@@ -76,6 +90,9 @@ class mock_es_client(object):
         self.is_atleastsixtwo = mock.Mock(return_value=False)
         self.is_atleastsixsix = mock.Mock(return_value=False)
         self.is_atleastseven = mock.Mock(return_value=False)
+        self.is_atleastseventwo = mock.Mock(return_value=False)
+        self.is_atleastseventwelve = mock.Mock(return_value=False)
+        self.refresh_es_version = mock.Mock()
         self.resolve_writeback_index = mock.Mock(return_value=writeback_index)
 
 
@@ -98,6 +115,9 @@ class mock_es_sixsix_client(object):
         self.is_atleastsixtwo = mock.Mock(return_value=False)
         self.is_atleastsixsix = mock.Mock(return_value=True)
         self.is_atleastseven = mock.Mock(return_value=False)
+        self.is_atleastseventwo = mock.Mock(return_value=False)
+        self.is_atleastseventwelve = mock.Mock(return_value=False)
+        self.refresh_es_version = mock.Mock()
 
         def writeback_index_side_effect(index, doc_type):
             if doc_type == 'silence':
@@ -187,6 +207,8 @@ def ea():
     ea.writeback_es.search.return_value = {'hits': {'hits': []}, 'total': 0}
     ea.writeback_es.deprecated_search.return_value = {'hits': {'hits': []}}
     ea.writeback_es.index.return_value = {'_id': 'ABCD', 'created': True}
+    # The tests provide the rule clients themselves
+    ea.es_clients.clear()
     ea.current_es = mock_es_client('', '')
     ea.thread_data.current_es = ea.current_es
     ea.thread_data.num_hits = 0
@@ -241,6 +263,7 @@ def ea_sixsix():
     ea_sixsix.writeback_es.search.return_value = {'hits': {'hits': []}}
     ea_sixsix.writeback_es.deprecated_search.return_value = {'hits': {'hits': []}}
     ea_sixsix.writeback_es.index.return_value = {'_id': 'ABCD'}
+    ea_sixsix.es_clients.clear()
     ea_sixsix.current_es = mock_es_sixsix_client('', -1)
     return ea_sixsix
 
@@ -222,6 +222,16 @@ def test_file_rules_loader_get_names():
     assert len(paths) == 2
 
 
+def test_load_rule_filter():
+    rules_loader = FileRulesLoader({})
+    with mock.patch.object(rules_loader, 'get_names', return_value=['a.yaml', 'b.yaml']):
+        with mock.patch.object(rules_loader, 'load_configuration') as mock_load:
+            mock_load.side_effect = lambda rule_file, conf, args: {'name': rule_file}
+            rules = rules_loader.load({}, rule_filter=lambda rule_file: rule_file == 'b.yaml')
+    assert rules == [{'name': 'b.yaml'}]
+    mock_load.assert_called_once_with('b.yaml', {}, None)
+
+
 def test_load_rules():
     test_rule_copy = copy.deepcopy(test_rule)
     test_config_copy = copy.deepcopy(test_config)
@@ -399,6 +409,118 @@ def test_query_key_with_no_values():
     assert 'compound_query_key' not in test_rule_copy
 
 
+def test_derive_include():
+    rules_loader = FileRulesLoader(copy.deepcopy(test_config))
+    test_rule_copy = copy.deepcopy(test_rule)
+    test_rule_copy.pop('use_count_query')
+    test_rule_copy.pop('include')
+    test_rule_copy['derive_include'] = True
+    test_rule_copy['field_value'] = 'bytes'
+    test_rule_copy['alert_subject_args'] = ['host.name']
+    test_rule_copy['alert_text_kw'] = {'user': 'username'}
+    test_rule_copy['summary_table_fields'] = ['status']
+    rules_loader.load_options(test_rule_copy, test_config, 'filename.yaml')
+    assert sorted(test_rule_copy['include']) == ['@timestamp', 'bytes', 'comparekey', 'host.name', 'status', 'testkey',
+                                                 'user']
+
+
+def test_derive_include_alerter_fields():
+    rules_loader = FileRulesLoader(copy.deepcopy(test_config))
+    test_rule_copy = copy.deepcopy(test_rule)
+    test_rule_copy.pop('use_count_query')
+    test_rule_copy.pop('include')
+    test_rule_copy['derive_include'] = True
+    test_rule_copy['email_from_field'] = 'user.email'
+    test_rule_copy['slack_alert_fields'] = [{'title': 'Host', 'value': 'host.name', 'short': True}]
+    test_rule_copy['mattermost_msg_fields'] = [{'title': 'Stack', 'value': '{0} {1}', 'args': ['type', 'msg.status']}]
+    rules_loader.load_options(test_rule_copy, test_config, 'filename.yaml')
+    assert sorted(test_rule_copy['include']) == ['@timestamp', 'comparekey', 'host.name', 'msg.status', 'testkey', 'type',
+                                                 'user.email']
+
+    # A field option which is not known may be read from the match, so whole documents are downloaded
+    test_rule_copy = copy.deepcopy(test_rule)
+    test_rule_copy.pop('use_count_query')
+    test_rule_copy.pop('include')
+    test_rule_copy['derive_include'] = True
+    test_rule_copy['my_alerter_field'] = 'user.name'
+    rules_loader.load_options(test_rule_copy, test_config, 'filename.yaml')
+    assert '*' in test_rule_copy['include']
+
+
+def test_derive_include_jinja():
+    rules_loader = FileRulesLoader(copy.deepcopy(test_config))
+    test_rule_copy = copy.deepcopy(test_rule)
+    test_rule_copy.pop('use_count_query')
+    test_rule_copy.pop('include')
+    test_rule_copy['derive_include'] = True
+    test_rule_copy['alert_text_type'] = 'alert_text_jinja'
+    test_rule_copy['alert_text'] = '{{ source.ip }} sent {% for b in bytes %}{{ b }}{% endfor %}'
+    rules_loader.load_options(test_rule_copy, test_config, 'filename.yaml')
+    assert sorted(test_rule_copy['include']) == ['@timestamp', 'bytes', 'comparekey', 'source', 'testkey']
+
+    test_rule_copy = copy.deepcopy(test_rule)
+    test_rule_copy.pop('use_count_query')
+    test_rule_copy.pop('include')
+    test_rule_copy['derive_include'] = True
+    test_rule_copy['alert_text_type'] = 'alert_text_jinja'
+    test_rule_copy['alert_text'] = "{{ _data['source.ip'] }}"
+    rules_loader.load_options(test_rule_copy, test_config, 'filename.yaml')
+    assert '*' in test_rule_copy['include']
+
+
+@pytest.mark.parametrize('option, value', [
+    ('match_enhancements', ['my.enhancement']),
+    ('type', 'my.custom.RuleType'),
+    ('alert', ['post']),
+])
+def test_derive_include_whole_documents(option, value):
+    rules_loader = FileRulesLoader(copy.deepcopy(test_config))
+    test_rule_copy = copy.deepcopy(test_rule)
+    test_rule_copy.pop('use_count_query')
+    test_rule_copy.pop('include')
+    test_rule_copy['derive_include'] = True
+    test_rule_copy[option] = value
+    rules_loader.load_options(test_rule_copy, test_config, 'filename.yaml')
+    assert '*' in test_rule_copy['include']
+
+
+def test_derive_include_explicit_include():
+    rules_loader = FileRulesLoader(copy.deepcopy(test_config))
+    test_rule_copy = copy.deepcopy(test_rule)
+    test_rule_copy.pop('use_count_query')
+    test_rule_copy['derive_include'] = True
+    test_rule_copy['alert_text_args'] = ['host.name']
+    rules_loader.load_options(test_rule_copy, test_config, 'filename.yaml')
+    assert sorted(test_rule_copy['include']) == ['@timestamp', 'comparekey', 'testkey']
+
+
+def test_cardinality_aggregation_buffer_time():
+    test_config_copy = copy.deepcopy(test_config)
+    test_config_copy['buffer_time'] = datetime.timedelta(minutes=10)
+    rules_loader = FileRulesLoader(test_config_copy)
+    test_rule_copy = copy.deepcopy(test_rule)
+    test_rule_copy.pop('use_count_query')
+    test_rule_copy.update({'type': 'cardinality', 'cardinality_field': 'user', 'max_cardinality': 5,
+                           'timeframe': {'hours': 1}, 'use_cardinality_aggregation': True})
+    with mock.patch('elastalert.ruletypes.elastalert_logger') as mock_logger:
+        rules_loader.load_options(test_rule_copy, test_config_copy, 'filename.yaml')
+        rules_loader.load_modules(test_rule_copy)
+    assert test_rule_copy['buffer_time'] == datetime.timedelta(hours=1)
+    # The global buffer_time is not the rule's own, so replacing it is not worth a warning
+    assert not mock_logger.warning.called
+
+    test_rule_copy = copy.deepcopy(test_rule)
+    test_rule_copy.pop('use_count_query')
+    test_rule_copy.update({'type': 'cardinality', 'cardinality_field': 'user', 'max_cardinality': 5,
+                           'timeframe': {'hours': 1}, 'use_cardinality_aggregation': True,
+                           'buffer_time': {'minutes': 5}})
+    with mock.patch('elastalert.ruletypes.elastalert_logger') as mock_logger:
+        rules_loader.load_options(test_rule_copy, test_config_copy, 'filename.yaml')
+        rules_loader.load_modules(test_rule_copy)
+    assert test_rule_copy['buffer_time'] == datetime.timedelta(hours=1)
+    assert mock_logger.warning.called
+
+
 def test_name_inference():
     test_config_copy = copy.deepcopy(test_config)
     rules_loader = FileRulesLoader(test_config_copy)
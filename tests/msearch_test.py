@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+import threading
+from unittest import mock
+
+import pytest
+from elasticsearch.exceptions import TransportError
+
+from elastalert.msearch import cluster_key
+from elastalert.msearch import MultiSearchBatcher
+
+
+def mock_client(host='es'):
+    client = mock.Mock()
+    client.conf = {'es_host': host, 'es_port': 9200}
+    return client
+
+
+def test_searches_sent_in_one_msearch():
+    client = mock_client()
+    client.msearch.return_value = {'responses': [{'hits': {'hits': []}, 'id': i} for i in range(3)]}
+    batcher = MultiSearchBatcher(wait_time=10, max_size=3)
+    results = {}
+
+    def search(i):
+        results[i] = batcher.search(client, 'idx%d' % i, {'query': i}, ignore_unavailable=True)
+
+    threads = [threading.Thread(target=search, args=(i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert client.msearch.call_count == 1
+    body = client.msearch.call_args[1]['body']
+    assert len(body) == 6
+    assert {'index': body[0]['index'], 'ignore_unavailable': True} == body[0]
+    assert sorted(body[1::2], key=lambda b: b['query']) == [{'query': 0}, {'query': 1}, {'query': 2}]
+    # Every caller gets the response matching the position of its own search
+    for header, search_body in zip(body[0::2], body[1::2]):
+        position = body.index(search_body) // 2
+        assert results[search_body['query']]['id'] == position
+        assert header['index'] == 'idx%d' % search_body['query']
+
+
+def test_batch_sent_after_wait_time():
+    client = mock_client()
+    client.msearch.return_value = {'responses': [{'hits': {'hits': []}}]}
+    batcher = MultiSearchBatcher(wait_time=0.01, max_size=100)
+    assert batcher.search(client, 'idx', {}) == {'hits': {'hits': []}}
+    assert client.msearch.call_count == 1
+
+
+def test_error_response_raised_for_its_search():
+    client = mock_client()
+    client.msearch.return_value = {'responses': [
+        {'error': {'type': 'index_not_found_exception', 'reason': 'no such index'}, 'status': 404}]}
+    batcher = MultiSearchBatcher(wait_time=0.01, max_size=1)
+    with pytest.raises(TransportError) as error:
+        batcher.search(client, 'idx', {})
+    assert error.value.status_code == 404
+    assert error.value.error == 'index_not_found_exception'
+
+
+def test_request_error_raised_for_every_search():
+    client = mock_client()
+    client.msearch.side_effect = TransportError('N/A', 'connection refused')
+    batcher = MultiSearchBatcher(wait_time=0.01, max_size=1)
+    with pytest.raises(TransportError):
+        batcher.search(client, 'idx', {})
+
+
+def test_cluster_key():
+    assert cluster_key(mock_client('a')) == cluster_key(mock_client('a'))
+    assert cluster_key(mock_client('a')) != cluster_key(mock_client('b'))
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from elastalert.rule_queue import RuleQueue
+
+
+def test_rule_queued_once():
+    now = [0]
+    queue = RuleQueue(clock=lambda: now[0])
+    rule = {'name': 'rule'}
+    assert queue.put(rule)
+    assert not queue.put(rule)
+    assert len(queue) == 1
+
+    now[0] = 3
+    assert queue.get(timeout=0) == (rule, 3)
+    assert len(queue) == 0
+    # Not queued again while it is running
+    assert not queue.put(rule)
+    queue.done(rule)
+    assert queue.put(rule)
+
+
+def test_get_timeout():
+    queue = RuleQueue()
+    assert queue.get(timeout=0) == (None, None)
+
+
+def test_most_overdue_first():
+    now = [0]
+    queue = RuleQueue(clock=lambda: now[0])
+    first = {'name': 'first'}
+    second = {'name': 'second'}
+    queue.put(first)
+    now[0] = 1
+    queue.put(second)
+    now[0] = 2
+    assert queue.lag() == 2
+    assert queue.get(timeout=0) == (first, 2)
+    assert queue.get(timeout=0) == (second, 1)
+    assert queue.lag() == 0
+
+
+def test_priority_weighted():
+    now = [0]
+    queue = RuleQueue(clock=lambda: now[0])
+    bulk = {'name': 'bulk'}
+    critical = {'name': 'critical', 'schedule_priority': 10}
+    queue.put(bulk)
+    now[0] = 8
+    queue.put(critical)
+
+    # The critical rule has waited 1 second, weighted 10, the bulk rule 9 seconds
+    now[0] = 9
+    assert queue.get(timeout=0)[0] is critical
+    queue.put(critical)
+    # The bulk rule is eventually run before a critical rule which has only just been queued
+    now[0] = 9.5
+    assert queue.get(timeout=0)[0] is bulk
+
+
+def test_overdue_when_queued():
+    now = [10]
+    queue = RuleQueue(clock=lambda: now[0])
+    first = {'name': 'first'}
+    skipped = {'name': 'skipped'}
+    queue.put(first)
+    # Overdue since before first was queued, for instance while its previous run was still running
+    queue.put(skipped, overdue=5)
+    now[0] = 11
+    assert queue.lag() == 6
+    assert queue.get(timeout=0) == (skipped, 6)
+    assert queue.get(timeout=0) == (first, 1)
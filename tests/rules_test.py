@@ -5,6 +5,7 @@ import datetime
 from unittest import mock
 import pytest
 
+from elastalert import ElasticSearchClient
 from elastalert.ruletypes import AnyRule
 from elastalert.ruletypes import BaseAggregationRule
 from elastalert.ruletypes import BlacklistRule
@@ -20,6 +21,7 @@ from elastalert.ruletypes import PercentageMatchRule
 from elastalert.ruletypes import RuleType
 from elastalert.ruletypes import SpikeRule
 from elastalert.ruletypes import WhitelistRule
+from elastalert.util import build_es_conn_config
 from elastalert.util import dt_to_ts
 from elastalert.util import EAException
 from elastalert.util import ts_now
@@ -572,9 +574,9 @@ def test_new_term(version, expected_is_five_or_above):
                                                                      {'key': 'key2', 'doc_count': 5}]}}}}
 
     with mock.patch('elastalert.ruletypes.elasticsearch_client') as mock_es:
-        mock_es.return_value = mock.Mock()
-        mock_es.return_value.search.return_value = mock_res
-        mock_es.return_value.info.return_value = version
+        mock_es.return_value = ElasticSearchClient(build_es_conn_config(rules))
+        mock_es.return_value.search = mock.Mock(return_value=mock_res)
+        mock_es.return_value.info = mock.Mock(return_value=version)
         call_args = []
 
         # search is called with a mutable dict containing timestamps, this is required to test
@@ -626,14 +628,16 @@ def test_new_term(version, expected_is_five_or_above):
     # Missing_field
     rules['alert_on_missing_field'] = True
     with mock.patch('elastalert.ruletypes.elasticsearch_client') as mock_es:
-        mock_es.return_value = mock.Mock()
-        mock_es.return_value.search.return_value = mock_res
-        mock_es.return_value.info.return_value = version
+        mock_es.return_value = ElasticSearchClient(build_es_conn_config(rules))
+        mock_es.return_value.search = mock.Mock(return_value=mock_res)
+        mock_es.return_value.info = mock.Mock(return_value=version)
         rule = NewTermsRule(rules)
     rule.add_data([{'@timestamp': ts_now(), 'a': 'key2'}])
     assert len(rule.matches) == 1
     assert rule.matches[0]['missing_field'] == 'b'
     assert rule.is_five_or_above() == expected_is_five_or_above
+    # The version of the cluster is only requested once, and shared with the second rule's client
+    assert mock_es.return_value.info.call_count == 0
 
 
 def test_new_term_nested_field():
@@ -1021,6 +1025,51 @@ def test_cardinality_qk():
     assert rule.matches[1]['foo'] == 'fiz'
 
 
+def test_cardinality_aggregation():
+    rules = {'max_cardinality': 2,
+             'min_cardinality': 1,
+             'timeframe': datetime.timedelta(minutes=10),
+             'buffer_time': datetime.timedelta(minutes=1),
+             'cardinality_field': 'foo',
+             'timestamp_field': '@timestamp',
+             'query_key': 'user',
+             'use_cardinality_aggregation': True}
+    rule = CardinalityRule(rules)
+    assert rule.rules['aggregation_query_element'] == {'cardinality_value': {'cardinality': {'field': 'foo'}}}
+    assert rule.rules['buffer_time'] == datetime.timedelta(minutes=10)
+    assert rule.rules['composite_page_size'] == 1000
+
+    timestamp = datetime.datetime.now()
+    rule.add_aggregation_data({timestamp: {'bucket_aggs': {'buckets': [
+        {'key': 'foo', 'doc_count': 5, 'cardinality_value': {'value': 2}},
+        {'key': 'bar', 'doc_count': 9, 'cardinality_value': {'value': 3}},
+        {'key': 'baz', 'doc_count': 1, 'cardinality_value': {'value': 0}},
+    ]}}})
+    assert [match['user'] for match in rule.matches] == ['bar', 'baz']
+
+    rules.pop('query_key')
+    rule = CardinalityRule(rules)
+    rule.add_aggregation_data({timestamp: {'cardinality_value': {'value': 3}}})
+    assert len(rule.matches) == 1
+    assert 'user' not in rule.matches[0]
+
+
+def test_cardinality_aggregation_buffer_time(caplog):
+    rules = {'name': 'test',
+             'max_cardinality': 2,
+             'timeframe': datetime.timedelta(minutes=10),
+             'buffer_time': datetime.timedelta(minutes=1),
+             'cardinality_field': 'foo',
+             'use_cardinality_aggregation': True}
+    CardinalityRule(dict(rules))
+    assert 'buffer_time of 0:01:00 is replaced by its timeframe of 0:10:00' in caplog.text
+    assert 'composite_page_size' not in rules
+
+    rules['allow_buffer_time_overlap'] = False
+    with pytest.raises(EAException):
+        CardinalityRule(rules)
+
+
 def test_cardinality_nested_cardinality_field():
     rules = {'max_cardinality': 4,
              'timeframe': datetime.timedelta(minutes=10),
@@ -1261,6 +1310,25 @@ def test_metric_aggregation_complex_query_key_bucket_interval():
     assert rule.matches[1]['sub_qk'] == 'sub_qk_val1'
 
 
+def test_metric_aggregation_threshold_pushdown():
+    rules = {'buffer_time': datetime.timedelta(minutes=5),
+             'timestamp_field': '@timestamp',
+             'metric_agg_type': 'avg',
+             'metric_agg_key': 'cpu_pct',
+             'min_threshold': 0.1,
+             'max_threshold': 0.8}
+    rule = MetricAggregationRule(rules)
+    assert 'aggregation_bucket_selector' not in rule.rules
+
+    rules['threshold_pushdown'] = True
+    rule = MetricAggregationRule(rules)
+    assert rule.rules['aggregation_query_element'] == {'metric_cpu_pct_avg': {'avg': {'field': 'cpu_pct'}}}
+    assert rule.rules['aggregation_bucket_selector'] == {'threshold_selector': {'bucket_selector': {
+        'buckets_path': {'value': 'metric_cpu_pct_avg'},
+        'script': {'source': 'params.value > params.max_threshold || params.value < params.min_threshold',
+                   'params': {'max_threshold': 0.8, 'min_threshold': 0.1}}}}}
+
+
 def test_percentage_match():
     rules = {'match_bucket_filter': {'term': 'term_val'},
              'buffer_time': datetime.timedelta(minutes=5),
@@ -1337,6 +1405,24 @@ def test_percentage_match():
     assert rule.matches[0]['subdict1']['subdict2'] == 'qk_val'
 
 
+def test_percentage_match_threshold_pushdown():
+    rules = {'match_bucket_filter': {'term': 'term_val'},
+             'buffer_time': datetime.timedelta(minutes=5),
+             'timestamp_field': '@timestamp',
+             'max_percentage': 75,
+             'min_denominator': 10,
+             'threshold_pushdown': True}
+    rule = PercentageMatchRule(rules)
+    selector = rule.rules['aggregation_bucket_selector']
+    assert selector['match_percentage']['bucket_script']['buckets_path'] == {
+        'match': "percentage_match_aggs['match_bucket']>_count",
+        'other': "percentage_match_aggs['_other_']>_count"}
+    script = selector['percentage_selector']['bucket_selector']['script']
+    assert script['source'].endswith('total >= params.min_denominator && (params.percentage > params.max_percentage)')
+    assert script['params'] == {'min_denominator': 10, 'max_percentage': 75}
+    assert selector['percentage_selector']['bucket_selector']['buckets_path']['percentage'] == 'match_percentage'
+
+
 def test_ruletype_add_data():
     try:
         RuleType.garbage_collect('', '')
@@ -1381,3 +1467,50 @@ def test_comparerule_compare():
         assert False
     except NotImplementedError:
         assert True
+
+
+def test_new_term_composite_paging():
+    rules = {'fields': ['a', ['b', 'c']],
+             'timestamp_field': '@timestamp',
+             'es_host': 'example.com', 'es_port': 10, 'index': 'logstash',
+             'composite_page_size': 2,
+             'ts_to_dt': ts_to_dt, 'dt_to_ts': dt_to_ts}
+    pages = {
+        'a.keyword': [
+            {'aggregations': {'values': {'buckets': [{'key': {'key_0': 'key1'}, 'doc_count': 1},
+                                                     {'key': {'key_0': 'key2'}, 'doc_count': 5}],
+                                         'after_key': {'key_0': 'key2'}}}},
+            {'aggregations': {'values': {'buckets': [{'key': {'key_0': 'key3'}, 'doc_count': 1}],
+                                         'after_key': {'key_0': 'key3'}}}},
+        ],
+        'b.keyword': [
+            {'aggregations': {'values': {'buckets': [{'key': {'key_0': 'key1', 'key_1': 'key2'}, 'doc_count': 1}],
+                                         'after_key': {'key_0': 'key1', 'key_1': 'key2'}}}},
+        ],
+    }
+
+    def search(body, index, **kwargs):
+        composite = body['aggs']['values']['composite']
+        field_pages = pages[composite['sources'][0]['key_0']['terms']['field']]
+        return field_pages[1] if 'after' in composite else field_pages[0]
+
+    with mock.patch('elastalert.ruletypes.elasticsearch_client') as mock_es:
+        mock_es.return_value = mock.Mock()
+        mock_es.return_value.search.side_effect = search
+        mock_es.return_value.info.return_value = {'version': {'number': '7.10.0'}}
+        rule = NewTermsRule(rules)
+
+        # Two pages for a, one for [b, c], for each of the 30 days
+        assert rule.es.search.call_count == 90
+        body = rule.es.search.call_args_list[0][1]['body']
+        assert body['size'] == 0
+        assert body['aggs']['values']['composite']['size'] == 2
+
+    assert sorted(rule.seen_values['a']) == ['key1', 'key2', 'key3']
+    assert rule.seen_values[('b', 'c')] == [('key1', 'key2')]
+
+    rule.add_data([{'@timestamp': ts_now(), 'a': 'key3', 'b': 'key1', 'c': 'key2'}])
+    assert rule.matches == []
+    rule.add_data([{'@timestamp': ts_now(), 'a': 'key4'}])
+    assert len(rule.matches) == 1
+    assert rule.matches[0]['new_field'] == 'a'
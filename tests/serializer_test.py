@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import datetime
+from unittest import mock
+
+import pytest
+from elasticsearch.exceptions import ImproperlyConfigured
+from elasticsearch.exceptions import SerializationError
+from elasticsearch.serializer import JSONSerializer
+
+from elastalert.alerts import Alerter
+from elastalert.serializer import FastJSONSerializer
+from elastalert.serializer import get_serializer
+from elastalert.util import elasticsearch_client
+
+
+def test_fast_json_serializer_loads():
+    serializer = FastJSONSerializer()
+    s = '{"hits": {"total": 2, "hits": [{"_id": "1", "_source": {"@timestamp": "2021-01-01T00:00:00Z", "name": "é"}}]}}'
+    assert serializer.loads(s) == JSONSerializer().loads(s)
+    with pytest.raises(SerializationError):
+        serializer.loads('{"hits":')
+
+
+def test_fast_json_serializer_dumps():
+    serializer = FastJSONSerializer()
+    ts = datetime.datetime(2021, 1, 1, 12, 30, tzinfo=datetime.timezone.utc)
+    body = {'@timestamp': ts, 'day': ts.date(), 'name': 'é', 1: 'one'}
+    expected = '{"@timestamp":"2021-01-01T12:30:00+00:00","day":"2021-01-01","name":"é","1":"one"}'
+    assert serializer.dumps(body) == expected
+    assert serializer.dumps('{"already": "json"}') == '{"already": "json"}'
+    # orjson only encodes 64 bit integers
+    assert serializer.dumps({'big': 2 ** 70}) == '{"big":%d}' % (2 ** 70)
+
+
+def test_fast_json_serializer_without_orjson():
+    serializer = FastJSONSerializer()
+    ts = datetime.datetime(2021, 1, 1, 12, 30)
+    with mock.patch('elastalert.serializer.orjson', None):
+        assert serializer.dumps({'@timestamp': ts}) == '{"@timestamp":"2021-01-01T12:30:00"}'
+        assert serializer.loads('{"a": [1, 2]}') == {'a': [1, 2]}
+
+
+def test_get_serializer():
+    assert type(get_serializer('orjson')) is FastJSONSerializer
+    assert type(get_serializer('stdlib')) is JSONSerializer
+    with pytest.raises(ImproperlyConfigured):
+        get_serializer('pickle')
+
+
+@mock.patch.dict('os.environ', {'AWS_DEFAULT_REGION': ''})
+def test_elasticsearch_client_serializer():
+    client = elasticsearch_client({'es_host': 'localhost', 'es_port': 9200})
+    assert type(client.transport.serializer) is FastJSONSerializer
+
+    client = elasticsearch_client({'es_host': 'localhost', 'es_port': 9200, 'es_json_serializer': 'stdlib'})
+    assert type(client.transport.serializer) is JSONSerializer
+
+
+def test_alerter_serialize_payload():
+    ts = datetime.datetime(2021, 1, 1, 12, 30)
+    alerter = Alerter({'name': 'test'})
+    assert alerter.serialize_payload({'@timestamp': ts, 'name': 'é'}) == '{"@timestamp":"2021-01-01T12:30:00","name":"é"}'.encode('utf-8')
+
+    alerter = Alerter({'name': 'test', 'es_json_serializer': 'stdlib'})
+    assert alerter.serialize_payload([{'@timestamp': ts}]) == b'[{"@timestamp":"2021-01-01T12:30:00"}]'
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from elastalert.shared_query import SharedQueryCache
+
+
+def test_first_claim_leads():
+    cache = SharedQueryCache()
+    future, leader = cache.claim('key', 60)
+    assert leader
+    same_future, leader = cache.claim('key', 60)
+    assert not leader
+    assert same_future is future
+    _, leader = cache.claim('other', 60)
+    assert leader
+
+
+def test_result_expires():
+    now = [0]
+    cache = SharedQueryCache(clock=lambda: now[0])
+    future, _ = cache.claim('key', 60)
+    future.set_result(['hit'])
+    now[0] = 59
+    assert cache.claim('key', 60) == (future, False)
+    now[0] = 60
+    new_future, leader = cache.claim('key', 60)
+    assert leader
+    assert new_future is not future
+    assert list(cache.entries) == ['key']
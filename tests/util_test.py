@@ -13,6 +13,7 @@ from unittest import mock
 
 from elastalert.util import add_raw_postfix
 from elastalert.util import build_es_conn_config
+from elastalert.util import conn_config_key
 from elastalert.util import dt_to_int
 from elastalert.util import dt_to_ts
 from elastalert.util import dt_to_ts_with_format
@@ -537,6 +538,60 @@ def test_elasticsearch_client(es_host, es_port, es_bearer, es_api_key):
     assert None is not acutual
 
 
+@mock.patch.dict(os.environ, {'AWS_DEFAULT_REGION': ''})
+def test_elasticsearch_client_pool_maxsize():
+    conf = {'es_host': 'localhost', 'es_port': 9200, 'es_pool_maxsize': 4}
+    client = elasticsearch_client(conf)
+    connection = client.transport.get_connection()
+    adapter = connection.session.get_adapter('http://localhost:9200')
+    assert adapter._pool_maxsize == 4
+    assert adapter._pool_block
+
+
+@mock.patch.dict(os.environ, {'AWS_DEFAULT_REGION': ''})
+def test_elasticsearch_client_http_compress():
+    client = elasticsearch_client({'es_host': 'localhost', 'es_port': 9200})
+    assert 'accept-encoding' not in client.transport.get_connection().session.headers
+
+    client = elasticsearch_client({'es_host': 'localhost', 'es_port': 9200, 'es_http_compress': True})
+    assert client.transport.get_connection().session.headers['accept-encoding'] == 'gzip, deflate'
+
+
+@mock.patch.dict(os.environ, {'AWS_DEFAULT_REGION': ''})
+def test_elasticsearch_client_version_cached_per_cluster():
+    info = {'version': {'number': '7.10.0'}}
+    x = elasticsearch_client({'es_host': 'localhost', 'es_port': 9200, 'es_username': 'x', 'es_password': 'x'})
+    y = elasticsearch_client({'es_host': 'localhost', 'es_port': 9200, 'es_username': 'y', 'es_password': 'y'})
+    other = elasticsearch_client({'es_host': 'otherhost', 'es_port': 9200})
+    for client in (x, y, other):
+        client.info = mock.Mock(return_value=info)
+
+    assert x.is_atleastseven()
+    assert y.is_atleastfive()
+    assert x.info.call_count == 1
+    assert y.info.call_count == 0
+
+    assert other.is_atleastseven()
+    assert other.info.call_count == 1
+
+    y.refresh_es_version()
+    assert y.is_atleastseven()
+    assert y.info.call_count == 1
+
+    with mock.patch('elastalert.es_version_cache.ttl', 0):
+        assert x.is_atleastseven()
+    assert x.info.call_count == 2
+
+
+def test_conn_config_key_json_serializer():
+    conf = {'es_host': 'localhost', 'es_port': 9200}
+    orjson_conf = build_es_conn_config(dict(conf, es_json_serializer='orjson'))
+    json_conf = build_es_conn_config(dict(conf, es_json_serializer='json'))
+    # Clients encoding with different serializers are not shared
+    assert conn_config_key(orjson_conf) != conn_config_key(json_conf)
+    assert conn_config_key(json_conf) == conn_config_key(build_es_conn_config(dict(conf, es_json_serializer='json')))
+
+
 def test_expand_string_into_dict():
     dictionnary = {'@timestamp': '2021-07-06 01:00:00', 'metric_netfilter.ipv4_dst_cardinality': 401}
     string = 'metadata.source.ip'